@@ -0,0 +1,208 @@
+import re
+
+# Parser for email addresses as written in the email fields of requests, i.e. either a plain address
+# (first@provider.tld) or one with a display name (First Last <first@provider.tld>), following the
+# mailbox syntax of RFC 5322. Addresses with UTF-8 local parts or internationalized domain names
+# (RFC 6531) are accepted too. Not supported: comments, domain literals ([127.0.0.1]) & groups.
+#
+# The parser looks at each character a bounded number of times, so the time taken grows linearly
+# with the length of the input. Inputs longer than the longest header line allowed aren't parsed at all.
+MAX_LENGTH = 998
+MAX_ADDRESS_LENGTH = 254
+MAX_LOCAL_PART_LENGTH = 64
+MAX_LABEL_LENGTH = 63
+
+# Runs of characters that an atom (an unquoted word) can be made of: any but controls, whitespace
+# & specials. That includes non-ASCII characters, whether unicode or UTF-8 encoded. '.' separates atoms.
+_ATOM = re.compile(r'[^\x00-\x20\x7f()<>\[\]:;@\\,."]+')
+
+# Display names are allowed to contain '.' (as in obsolete RFC 5322 phrases, e.g. "J. Doe") & ','
+# (as in "Last, First", which should really be quoted)
+_PHRASE_WORD = re.compile(r'[^\x00-\x20\x7f()<>\[\]:;@\\"]+')
+
+_LABEL = re.compile(r'(?:[A-Za-z0-9-]|[^\x00-\x7f])+')
+_WHITESPACE = re.compile(r'[ \t]*')
+
+# A backslash escaping the character after it, in a quoted string
+_QUOTED_PAIR = re.compile(r'\\(.)')
+
+# Fast paths for the most common cases, plain ASCII addresses with or without a simple name. Every part
+# of the patterns is separated from the next by a character it can't match, so they can't backtrack much.
+_PLAIN_ADDRESS = r"""
+    [A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+ (?: \.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+ )*   # local part
+    @
+    (?: [A-Za-z0-9] (?: [A-Za-z0-9-]{0,61} [A-Za-z0-9] )? \. )+                # domain
+    [A-Za-z] (?: [A-Za-z0-9-]{0,61} [A-Za-z0-9] )?                             # top level domain
+"""
+_SIMPLE_EMAIL = re.compile(r"""
+    (?P<email> """ + _PLAIN_ADDRESS + r""" )
+    \Z""", re.VERBOSE)
+_SIMPLE_NAME_EMAIL = re.compile(r"""
+    (?P<name> [A-Za-z0-9.,'-]+ (?: \ [A-Za-z0-9.,'-]+ )* )
+    \ ?
+    < (?P<email> """ + _PLAIN_ADDRESS + r""" ) >
+    \Z""", re.VERBOSE)
+
+def parse(name_email_string):
+    """
+        Parses an email as specified in RFC 5322. Ex: 'First Last <first@provider.tld>' or 'first@provider.tld'
+
+        Args:
+            name_email_string (str) - The email
+
+        Returns:
+            tuple - Of form (name,email_address). The name is None if absent
+
+            None - If the input is invalid
+    """
+    if name_email_string is None or len(name_email_string) > MAX_LENGTH:
+        return None
+
+    match = _SIMPLE_EMAIL.match(name_email_string) or _SIMPLE_NAME_EMAIL.match(name_email_string)
+    if match is not None:
+        groupdict = match.groupdict()
+        email_address = groupdict['email']
+        if len(email_address) > MAX_ADDRESS_LENGTH or email_address.index('@') > MAX_LOCAL_PART_LENGTH:
+            return None
+        return groupdict.get('name'), email_address
+
+    return _Parser(name_email_string).parse_mailbox()
+
+class _Parser(object):
+    """
+        Parser over the characters of one email. Each method consumes what it
+        parsed by moving self.position forward & returns None if the input doesn't match.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+
+    def parse_mailbox(self):
+        # mailbox = addr-spec / [display-name] "<" addr-spec ">"
+        self.skip_whitespace()
+        start = self.position
+        email_address = self.parse_addr_spec()
+        if email_address is not None:
+            self.skip_whitespace()
+            if self.at_end():
+                return None, email_address
+
+        self.position = start
+        name = self.parse_display_name()
+        if not self.consume('<'):
+            return None
+
+        email_address = self.parse_addr_spec()
+        if email_address is None or not self.consume('>'):
+            return None
+
+        self.skip_whitespace()
+        if not self.at_end():
+            return None
+
+        return name, email_address
+
+    def parse_display_name(self):
+        # Words, either atoms or quoted strings, separated by whitespace. Returned joined by single spaces.
+        words = []
+        while True:
+            self.skip_whitespace()
+            if self.peek() == '"':
+                word = self.parse_quoted_string()
+                if word is None:
+                    return None
+                words.append(_QUOTED_PAIR.sub(r'\1', word[1:-1]))
+            else:
+                word = self.take_while(_PHRASE_WORD)
+                if not word:
+                    break
+                words.append(word)
+
+        return ' '.join(words) if words else None
+
+    def parse_addr_spec(self):
+        # addr-spec = local-part "@" domain
+        start = self.position
+
+        if self.peek() == '"':
+            if self.parse_quoted_string() is None:
+                return None
+        elif not self.parse_dot_atom():
+            return None
+
+        if self.position - start > MAX_LOCAL_PART_LENGTH or not self.consume('@'):
+            return None
+
+        if not self.parse_domain():
+            return None
+
+        email_address = self.text[start:self.position]
+        if len(email_address) > MAX_ADDRESS_LENGTH:
+            return None
+
+        return email_address
+
+    def parse_domain(self):
+        # Labels separated by '.'. At least two, none starting or ending with '-' & a top level domain that isn't numeric.
+        labels = 0
+        while True:
+            label = self.take_while(_LABEL)
+            if not label or len(label) > MAX_LABEL_LENGTH or label[0] == '-' or label[-1] == '-':
+                return False
+            labels += 1
+            if not self.consume('.'):
+                break
+
+        return labels >= 2 and not label.isdigit()
+
+    def parse_dot_atom(self):
+        # Atoms separated by single dots
+        while True:
+            if not self.take_while(_ATOM):
+                return False
+            if not self.consume('.'):
+                return True
+
+    def parse_quoted_string(self):
+        # '"' followed by any characters up to the next unescaped '"'. Returned with the quotes.
+        start = self.position
+        self.position += 1
+        while self.position < len(self.text):
+            character = self.text[self.position]
+            if character == '\\':
+                self.position += 2
+            elif character == '"':
+                self.position += 1
+                return self.text[start:self.position]
+            elif character in '\r\n':
+                return None
+            else:
+                self.position += 1
+
+        return None
+
+    def take_while(self, pattern):
+        # Consumes the longest run of characters matching pattern from the current position
+        match = pattern.match(self.text, self.position)
+        if match is None:
+            return ''
+        self.position = match.end()
+        return match.group()
+
+    def skip_whitespace(self):
+        self.take_while(_WHITESPACE)
+
+    def consume(self, character):
+        if self.peek() == character:
+            self.position += 1
+            return True
+        return False
+
+    def peek(self):
+        if self.position < len(self.text):
+            return self.text[self.position]
+        return None
+
+    def at_end(self):
+        return self.position == len(self.text)
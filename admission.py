@@ -0,0 +1,111 @@
+from datetime import datetime
+from rq.job import Job
+import os
+import time
+
+# Requests to /messages are rejected (429) once the queues get too long or too far behind, so that
+# Redis & the workers aren't pushed past what they can handle. The load for requests of a priority
+# only counts its own queue & the ones the workers take jobs from before it (see PRIORITIES), as the
+# jobs behind it don't hold it up. It's the larger of
+#   -- number of jobs waiting in those queues / MAX_QUEUE_DEPTH
+#   -- age of the oldest job waiting in them (in seconds) / MAX_QUEUE_LAG
+MAX_QUEUE_DEPTH = int(os.getenv('MAILR_MAX_QUEUE_DEPTH', 10000))
+MAX_QUEUE_LAG = int(os.getenv('MAILR_MAX_QUEUE_LAG', 300))
+
+# Load above which requests of each priority are rejected. Bulk requests are shed first, while
+# high priority ones are still accepted for a while past the limits.
+SHED_LOAD = {
+    'bulk' : float(os.getenv('MAILR_SHED_LOAD_BULK', 0.5)),
+    'normal' : float(os.getenv('MAILR_SHED_LOAD_NORMAL', 1.0)),
+    'high' : float(os.getenv('MAILR_SHED_LOAD_HIGH', 1.5))
+}
+
+# In the order workers take jobs from their queues. See worker.listen
+PRIORITIES = ('high', 'normal', 'bulk')
+
+# Seconds the client is told to wait before trying again
+RETRY_AFTER = int(os.getenv('MAILR_RETRY_AFTER', 30))
+
+# The queues are looked at no more often than this (in seconds) by each process, so that checking
+# doesn't add calls to Redis to every request.
+OBSERVATION_TTL = 1
+
+# Last observed load for each priority on each connection (i.e. each shard), as connection to
+# [time observed, dict of priority to load]
+_observations = {}
+
+def check(connection, queues, priority='normal'):
+    """
+        Decides whether a request of the given priority can be enqueued
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the queues are on
+            queues (dict) - RQ queue the requests of each priority are enqueued to, by priority
+            priority (str) - Priority of the request, 'high', 'normal' or 'bulk'
+
+        Returns:
+            int - Seconds the client should wait before trying again, if the request should be rejected
+
+            None - If the request can be enqueued
+    """
+    if priority not in SHED_LOAD:
+        priority = 'normal'
+    if get_load(connection, queues, priority) >= SHED_LOAD[priority]:
+        return RETRY_AFTER
+    return None
+
+def get_load(connection, queues, priority):
+    """
+        Returns the current load for requests of the given priority (see MAX_QUEUE_DEPTH & MAX_QUEUE_LAG),
+        as observed at most OBSERVATION_TTL seconds ago
+
+        Args:
+            queues (dict) - RQ queue of each priority, by priority
+    """
+    now = time.time()
+    observation = _observations.setdefault(connection, [0, {}])
+    if now - observation[0] >= OBSERVATION_TTL:
+        priorities = [name for name in PRIORITIES if name in queues]
+        loads = {}
+        depth, lag = 0, 0
+        for name, (queue_depth, queue_lag) in zip(priorities, observe_each(connection, [queues[name] for name in priorities])):
+            depth, lag = depth + queue_depth, max(lag, queue_lag)
+            loads[name] = max(float(depth) / MAX_QUEUE_DEPTH, float(lag) / MAX_QUEUE_LAG)
+        observation[0], observation[1] = now, loads
+
+    return observation[1].get(priority, 0)
+
+def observe(connection, queues):
+    """
+        Returns a tuple of form (total number of jobs waiting in the queues, age in seconds of the oldest one)
+    """
+    observations = observe_each(connection, queues)
+    return sum(depth for depth, lag in observations), max([lag for depth, lag in observations] or [0])
+
+def observe_each(connection, queues):
+    """
+        Returns a list with a tuple of form (number of jobs waiting, age in seconds of the oldest one) for each queue
+    """
+    pipeline = connection.pipeline()
+    for queue in queues:
+        pipeline.llen(queue.key)
+        pipeline.lindex(queue.key, 0)
+    results = pipeline.execute()
+    depths, oldest_job_ids = results[0::2], results[1::2]
+
+    pipeline = connection.pipeline()
+    for job_id in oldest_job_ids:
+        if job_id is not None:
+            pipeline.hget(Job.key_for(job_id), 'enqueued_at')
+    enqueued_ats = iter(pipeline.execute())
+
+    # RQ stores times in UTC, in this format
+    now = datetime.utcnow()
+    observations = []
+    for depth, job_id in zip(depths, oldest_job_ids):
+        enqueued_at = next(enqueued_ats) if job_id is not None else None
+        lag = 0
+        if enqueued_at is not None:
+            lag = max(0, (now - datetime.strptime(enqueued_at, '%Y-%m-%dT%H:%M:%SZ')).total_seconds())
+        observations.append((depth, lag))
+    return observations
@@ -0,0 +1,90 @@
+import os
+import time
+
+# Hourly counts of messages by outcome, provider & sender domain, for dashboards. Each hour is a Redis
+# hash on each shard (see shards.py) with a field per outcome, provider & sender domain, incremented
+# by the worker as it sends (see mailers.send_message). Messages are counted per recepient.
+#   -- accepted: messages of the requests made during the hour. Counted once the worker gets to them.
+#   -- sent: messages handed over to a provider during the hour
+#   -- failed: messages that no provider would take during the hour
+
+# Provider of the outcomes that don't have one, or domain of senders that can't be parsed
+NONE = '-'
+
+# How long, in seconds, the counts of each hour are kept
+TTL = int(os.getenv('MAILR_ANALYTICS_TTL', 90 * 86400))
+
+# Hours covered by a single query at most. See mailr.validate_get_analytics_input()
+MAX_QUERY_HOURS = 31 * 24
+
+BUCKET_SECONDS = 3600
+
+def record_send(connection, sender_domain, recepients, provider=None, accepted_at=None, now=None):
+    """
+        Counts the outcome of sending a message (or a chunk of a request, see mailers.split_recepients())
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection of the shard of the request
+            sender_domain (str) - Domain of the 'from' address
+            recepients (int) - Number of recepients the message was for
+            provider (str) - Optional; class name of the Mailer that sent the message. None if none could
+            accepted_at (float) - Optional; time the request was made. The message isn't counted as accepted when None
+            now (float) - Optional; time of the outcome. The current time by default
+    """
+    if now is None:
+        now = time.time()
+
+    counts = [('sent', provider, now)] if provider is not None else [('failed', NONE, now)]
+    if accepted_at is not None:
+        counts.append(('accepted', NONE, accepted_at))
+
+    pipeline = connection.pipeline()
+    for outcome, outcome_provider, timestamp in counts:
+        key = _get_bucket_key(_get_bucket(timestamp))
+        pipeline.hincrby(key, _get_field(outcome, outcome_provider, sender_domain.lower()), recepients)
+        pipeline.expire(key, TTL)
+    pipeline.execute()
+
+def query(connections, start, end, provider=None, sender_domain=None):
+    """
+        Returns the counts of every hour in a time range, summed over all shards
+
+        Args:
+            connections (list) - Redis connection of each shard
+            start (float) - Start of the range, in seconds since the epoch. Rounded down to the hour
+            end (float) - End of the range (excluded)
+            provider (str) - Optional; only count the outcomes of this provider (or of NONE)
+            sender_domain (str) - Optional; only count the messages sent on behalf of this domain
+
+        Returns:
+            list - A dict for each hour, oldest first, with the start of the hour (in seconds since the epoch)
+                   under 'hour' & the counts under 'counts', as outcome to provider to sender domain to count.
+                   Outcomes without messages are left out.
+    """
+    buckets = range(_get_bucket(start), _get_bucket(end - 1) + 1) if end > start else []
+    hours = [{'hour' : bucket * BUCKET_SECONDS, 'counts' : {}} for bucket in buckets]
+    for connection in connections:
+        pipeline = connection.pipeline()
+        for bucket in buckets:
+            pipeline.hgetall(_get_bucket_key(bucket))
+
+        for hour, fields in zip(hours, pipeline.execute()):
+            for field, count in fields.items():
+                outcome, field_provider, field_domain = field.split(':', 2)
+                if provider is not None and field_provider != provider:
+                    continue
+                if sender_domain is not None and field_domain != sender_domain.lower():
+                    continue
+                counts_by_domain = hour['counts'].setdefault(outcome, {}).setdefault(field_provider, {})
+                counts_by_domain[field_domain] = counts_by_domain.get(field_domain, 0) + int(count)
+
+    return hours
+
+def _get_bucket(timestamp):
+    return int(timestamp) // BUCKET_SECONDS
+
+def _get_bucket_key(bucket):
+    return 'mailr:analytics:{0}'.format(time.strftime('%Y%m%d%H', time.gmtime(bucket * BUCKET_SECONDS)))
+
+def _get_field(outcome, provider, sender_domain):
+    return '{0}:{1}:{2}'.format(outcome, provider, sender_domain)
@@ -0,0 +1,234 @@
+from rq import Queue
+import admission
+import json
+import logging
+import math
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Tells how many worker processes are needed to keep up with the queues, for an external autoscaler
+# (see mailr.get_autoscale() & the command line below). Workers report to the primary shard:
+#   -- a heartbeat at least every HEARTBEAT_INTERVAL seconds, while alive
+#   -- the time they spent busy on jobs & the number of jobs they ran, in per minute buckets
+# From those & the depth & lag of the queues, a number of workers is recommended for each shard so that:
+#   -- the requests arriving are sent with the workers busy TARGET_UTILISATION of the time at most
+#   -- the requests already waiting are sent within TARGET_LATENCY seconds
+# Workers of several shards (see worker.py) are counted for each of them.
+TARGET_LATENCY = float(os.getenv('MAILR_AUTOSCALE_TARGET_LATENCY', 60))
+TARGET_UTILISATION = float(os.getenv('MAILR_AUTOSCALE_TARGET_UTILISATION', 0.8))
+MIN_WORKERS = int(os.getenv('MAILR_AUTOSCALE_MIN_WORKERS', 1))
+MAX_WORKERS = int(os.getenv('MAILR_AUTOSCALE_MAX_WORKERS', 50))
+
+# Busy ratios & throughputs are averaged over about this many seconds (a whole number of buckets)
+WINDOW = int(os.getenv('MAILR_AUTOSCALE_WINDOW', 300))
+BUCKET_SECONDS = 60
+
+# Idle workers that haven't sent a heartbeat for 3 intervals are considered gone. Busy workers can't send
+# heartbeats while they wait for their job, so they're given the job's timeout (see worker.MailrWorker)
+HEARTBEAT_INTERVAL = 30
+
+WORKERS_KEY = 'mailr:autoscale:workers'
+
+# Queues of each shard, in order of priority. See worker.listen
+QUEUE_NAMES = ['high', 'default', 'bulk']
+
+def heartbeat(connection, worker_name, shard, started_at, busy_since=None, timeout=None, now=None):
+    """
+        Records that a worker is alive. Also forgets the workers that stopped sending heartbeats.
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection of the primary shard
+            worker_name (str) - Name of the RQ worker
+            shard (int) - Shard the worker takes jobs from
+            started_at (float) - Time the worker started
+            busy_since (float) - Optional; time the worker started its current job. None while idle
+            timeout (int) - Optional; seconds after which the worker is considered gone without another
+                            heartbeat. 3 * HEARTBEAT_INTERVAL by default
+            now (float) - Optional; the current time by default
+    """
+    if now is None:
+        now = time.time()
+    if timeout is None:
+        timeout = 3 * HEARTBEAT_INTERVAL
+
+    # Workers are scored by the time they're considered gone at
+    pipeline = connection.pipeline()
+    pipeline.zadd(WORKERS_KEY, **{worker_name : now + timeout})
+    pipeline.zremrangebyscore(WORKERS_KEY, '-inf', '(' + repr(now))
+    key = _get_worker_key(worker_name)
+    pipeline.hmset(key, {'shard' : shard, 'started_at' : started_at, 'busy_since' : busy_since or ''})
+    pipeline.expire(key, int(math.ceil(timeout)))
+    _execute(pipeline)
+
+def record_job(connection, worker_name, started, finished):
+    """
+        Records the time a worker spent on a job, split between the buckets it spans
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection of the primary shard
+            worker_name (str) - Name of the RQ worker
+            started (float) - Time the worker started the job
+            finished (float) - Time the job was done
+    """
+    pipeline = connection.pipeline()
+    for bucket in range(_get_bucket(started), _get_bucket(finished) + 1):
+        busy = min(finished, (bucket + 1) * BUCKET_SECONDS) - max(started, bucket * BUCKET_SECONDS)
+        key = _get_bucket_key(bucket)
+        pipeline.hincrbyfloat(key, worker_name + ':busy', busy)
+        if bucket == _get_bucket(finished):
+            pipeline.hincrby(key, worker_name + ':jobs', 1)
+        pipeline.expire(key, WINDOW + 2 * BUCKET_SECONDS)
+    _execute(pipeline)
+
+def remove_worker(connection, worker_name):
+    """
+        Forgets a worker that stopped
+    """
+    pipeline = connection.pipeline()
+    pipeline.zrem(WORKERS_KEY, worker_name)
+    pipeline.delete(_get_worker_key(worker_name))
+    _execute(pipeline)
+
+def get_workers(connection, now=None):
+    """
+        Returns the workers alive & how busy they were over the window
+
+        Returns:
+            list - A dict for each worker, by name, with its 'shard', the 'busy_seconds' & 'jobs' it ran
+                   within the window, its 'busy_ratio' (fraction of the time it has been busy) & its
+                   'throughput' (jobs done per second)
+    """
+    if now is None:
+        now = time.time()
+
+    worker_names = connection.zrangebyscore(WORKERS_KEY, now, '+inf')
+    first_bucket = _get_bucket(now) - WINDOW // BUCKET_SECONDS + 1
+    window_start = first_bucket * BUCKET_SECONDS
+
+    pipeline = connection.pipeline()
+    for worker_name in worker_names:
+        pipeline.hgetall(_get_worker_key(worker_name))
+    for bucket in range(first_bucket, _get_bucket(now) + 1):
+        pipeline.hgetall(_get_bucket_key(bucket))
+    results = pipeline.execute()
+    infos, buckets = results[:len(worker_names)], results[len(worker_names):]
+
+    workers = []
+    for worker_name, info in zip(worker_names, infos):
+        if not info:
+            continue
+        busy = sum(float(bucket.get(worker_name + ':busy', 0)) for bucket in buckets)
+        jobs = sum(int(bucket.get(worker_name + ':jobs', 0)) for bucket in buckets)
+        if info.get('busy_since'):
+            busy += now - max(float(info['busy_since']), window_start) # The job it's still on
+        alive = max(1.0, float(now - max(float(info['started_at']), window_start)))
+
+        workers.append({
+            'name' : worker_name,
+            'shard' : int(info['shard']),
+            'busy_ratio' : round(min(1.0, busy / alive), 3),
+            'throughput' : round(jobs / alive, 3),
+            'busy_seconds' : round(busy, 3),
+            'jobs' : jobs
+        })
+
+    return sorted(workers, key=lambda worker: worker['name'])
+
+def get_signal(connection, queues_by_shard, now=None):
+    """
+        Returns what an autoscaler needs to decide how many workers to run
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection of the primary shard
+            queues_by_shard (list) - RQ queues of each shard
+            now (float) - Optional; the current time by default
+
+        Returns:
+            dict - With, for each shard under 'shards', the 'depth' of its queues, the age of their
+                   oldest job ('oldest_job_age', in seconds), its 'workers', their average 'busy_ratio',
+                   their total 'throughput' (jobs per second) & the 'recommended_workers'.
+                   Each worker is listed under 'workers'. 'recommended_workers' at the top is the
+                   number of worker.py processes needed when each takes jobs from all shards.
+    """
+    workers = get_workers(connection, now)
+
+    shard_signals = []
+    for shard, queues in enumerate(queues_by_shard):
+        depth, lag = admission.observe(queues[0].connection, queues)
+        shard_workers = [worker for worker in workers if worker['shard'] == shard]
+        shard_signals.append({
+            'shard' : shard,
+            'depth' : depth,
+            'oldest_job_age' : round(lag, 3),
+            'workers' : len(shard_workers),
+            'busy_ratio' : round(sum(worker['busy_ratio'] for worker in shard_workers) / len(shard_workers), 3) if shard_workers else 0,
+            'throughput' : round(sum(worker['throughput'] for worker in shard_workers), 3),
+            'recommended_workers' : recommend(depth, lag, shard_workers)
+        })
+
+    return {
+        'shards' : shard_signals,
+        'workers' : workers,
+        'target_latency' : TARGET_LATENCY,
+        'recommended_workers' : max(shard_signal['recommended_workers'] for shard_signal in shard_signals)
+    }
+
+def recommend(depth, lag, workers):
+    """
+        Returns the number of workers a shard needs
+
+        Args:
+            depth (int) - Number of jobs waiting in the queues of the shard
+            lag (float) - Age of the oldest one, in seconds
+            workers (list) - Workers of the shard, as returned by get_workers()
+    """
+    busy = sum(worker['busy_seconds'] for worker in workers)
+    jobs = sum(worker['jobs'] for worker in workers)
+    if jobs == 0 or busy == 0:
+        # Nothing to tell how fast jobs are sent. Keep the workers there are, or start one for waiting jobs.
+        needed = max(len(workers), 1 if depth else 0)
+    else:
+        # Jobs a busy worker sends per second, jobs coming in per second (those sent, as far as the
+        # workers keep up) & the rate needed on top of it to send the jobs waiting within TARGET_LATENCY.
+        # The jobs waiting are late already when the oldest one is.
+        service_rate = jobs / busy
+        arrival_rate = sum(worker['throughput'] for worker in workers)
+        backlog_rate = depth / max(1.0, TARGET_LATENCY - lag)
+        needed = int(math.ceil((arrival_rate / TARGET_UTILISATION + backlog_rate) / service_rate))
+
+    return min(MAX_WORKERS, max(MIN_WORKERS, needed))
+
+def _execute(pipeline):
+    try:
+        pipeline.execute()
+    except Exception:
+        # Not worth failing the worker over. The autoscaler gets a less accurate picture.
+        logger.exception("Couldn't record autoscaling data in Redis")
+
+def _get_bucket(timestamp):
+    return int(timestamp) // BUCKET_SECONDS
+
+def _get_bucket_key(bucket):
+    return 'mailr:autoscale:{0}'.format(bucket)
+
+def _get_worker_key(worker_name):
+    return 'mailr:autoscale:worker:{0}'.format(worker_name)
+
+if __name__ == '__main__':
+    import argparse
+    import redis
+    import shards
+
+    parser = argparse.ArgumentParser(description='Prints the queue depth & lag, the utilisation of the workers & how many workers are needed')
+    parser.add_argument('--count', action='store_true', help='Only print the recommended number of worker.py processes')
+    args = parser.parse_args()
+
+    connections = [redis.from_url(redis_url) for redis_url in shards.REDIS_URLS]
+    signal = get_signal(connections[shards.PRIMARY],
+        [[Queue(name, connection=connection) for name in QUEUE_NAMES] for connection in connections])
+    if args.count:
+        print(signal['recommended_workers'])
+    else:
+        print(json.dumps(signal, indent=2, sort_keys=True))
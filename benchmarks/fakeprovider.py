@@ -0,0 +1,108 @@
+"""
+    Local stand-in for the MailGun & Mandril APIs, used by the benchmarks.
+
+    Serves the resources used by MailGunMailer & MandrilMailer under /mailgun & /mandril respectively,
+    with a configurable latency & error rate. Can be run on its own:
+
+        python benchmarks/fakeprovider.py --port 8025 --latency 0.05 --error-rate 0.01
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+class FakeProviderServer(ThreadingMixIn, HTTPServer):
+    """
+        Threaded HTTP server answering like MailGun & Mandril would
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, status='delivered'):
+        """
+            Args:
+                port (int) - Port to listen on. 0 picks a free one
+                latency (float) - Seconds to wait before answering each call
+                error_rate (float) - Fraction (0 to 1) of calls answered with a 500
+                status (str) - MailGun event returned for every status call ('accepted', 'delivered', 'failed' ...)
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeProviderHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.status = status
+        self.calls = 0
+
+    @property
+    def baseurl(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def start(self):
+        """
+            Starts serving in a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/mailgun/events':
+            self._respond({'items' : [{'event' : self.server.status}]})
+        else:
+            self._respond({'message' : 'Not found'}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+
+        if url.path == '/mailgun/messages':
+            self._respond({'id' : '<{0}@fake.mailgun.org>'.format(uuid.uuid4()), 'message' : 'Queued. Thank you.'})
+
+        elif url.path == '/mandril/messages/send.json':
+            recepients = json.loads(body)['message']['to']
+            self._respond([{'email' : recepient['email'], '_id' : uuid.uuid4().hex, 'status' : 'sent'}
+                for recepient in recepients])
+
+        elif url.path == '/mandril/messages/info.json':
+            mandril_states = {'delivered' : 'sent', 'failed' : 'bounced'}
+            self._respond({'state' : mandril_states.get(self.server.status)})
+
+        else:
+            self._respond({'message' : 'Not found'}, 404)
+
+    def _respond(self, body, status=200):
+        self.server.calls += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if random.random() < self.server.error_rate:
+            body, status = {'message' : 'Injected failure'}, 500
+
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Keep benchmark output readable
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the MailGun & Mandril APIs')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of calls answered with a 500')
+    parser.add_argument('--status', default='delivered', help='MailGun event returned by status calls')
+    args = parser.parse_args()
+
+    server = FakeProviderServer(args.port, args.latency, args.error_rate, args.status)
+    server.serve_forever()
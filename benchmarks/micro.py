@@ -0,0 +1,140 @@
+"""
+    Micro-benchmarks for the code that runs once per email address on every request.
+
+    Each function is timed over recepient lists of growing size (1 to 100k by default) & the results
+    are compared against the baselines stored in benchmarks/baselines.json. The run fails (exit code 1)
+    if any of them got slower than its baseline by more than the tolerance. Run from the root of the
+    repository:
+
+        python benchmarks/micro.py                 # Compare against the baselines
+        python benchmarks/micro.py --save          # Store the results as the new baselines
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import types
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# mailers.py reads the provider URLs & keys from the config module. None of the benchmarked
+# functions talk to the providers, so placeholder values do when there is no config module.
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    config.MAILGUN_BASEURL = config.MANDRIL_BASEURL = 'http://localhost'
+    config.MAILGUN_KEY = config.MANDRIL_KEY = 'benchmark'
+    sys.modules['config'] = config
+
+from mailers import MailerUtils, MailGunMailer, MandrilMailer
+from mailr import validate_send_message_input
+
+DEFAULT_BASELINE_PATH = os.path.join(ROOT_DIR, 'benchmarks', 'baselines.json')
+DEFAULT_SIZES = [1, 10, 100, 1000, 10000, 100000]
+
+def make_emails(size):
+    # Mix of plain addresses & ones with names, as seen in requests
+    return ['Recepient Number{0} <recepient{0}@mailr.com>'.format(i) if i % 2 else 'recepient{0}@mailr.com'.format(i)
+        for i in range(size)]
+
+def get_cases(size):
+    """
+        Returns a dict of benchmark name to a function running it once over a recepient list of the given size
+    """
+    emails = make_emails(size)
+    name_email_tuples = MailerUtils.get_name_email_tuples(emails)
+    addresses = [email_address for name, email_address in name_email_tuples]
+
+    send_input = {
+        'from' : 'Benchmark <benchmark@mailr.com>',
+        'to' : emails,
+        'subject' : 'Benchmark',
+        'text' : 'Benchmark'
+    }
+
+    mailgun_mailer = MailGunMailer()
+    mailgun_response = json.dumps({'id' : '<benchmark@mailr.mailgun.org>', 'message' : 'Queued. Thank you.'})
+
+    mandril_mailer = MandrilMailer()
+    mandril_response = json.dumps([{'email' : address, '_id' : str(i), 'status' : 'sent'}
+        for i, address in enumerate(addresses)])
+
+    return {
+        'MailerUtils.get_name_email_tuple' : lambda: [MailerUtils.get_name_email_tuple(email) for email in emails],
+        'MailerUtils.get_name_email_tuples' : lambda: MailerUtils.get_name_email_tuples(emails),
+        'MailerUtils.is_email_valid' : lambda: [MailerUtils.is_email_valid(email) for email in emails],
+        'validate_send_message_input' : lambda: validate_send_message_input(send_input),
+        'MandrilMailer._get_recepients_list' : lambda: mandril_mailer._get_recepients_list(name_email_tuples, 'to'),
+        'MailGunMailer._process_response' : lambda: mailgun_mailer._process_response(mailgun_response, addresses),
+        'MandrilMailer._process_response' : lambda: mandril_mailer._process_response(mandril_response)
+    }
+
+def run(sizes, min_time=0.2):
+    """
+        Times every case for every size.
+
+        Args:
+            sizes (list) - Sizes of the recepient lists
+            min_time (float) - Each case is repeated for at least this many seconds
+
+        Returns:
+            dict - Of form {name : {size : seconds}}, size being a string as in the JSON baselines.
+                   The time is the best of the repeats for one run over the whole list
+    """
+    results = {}
+    for size in sizes:
+        for name, case in get_cases(size).items():
+            timer = timeit.Timer(case)
+            number, elapsed = 1, timer.timeit(1)
+            while elapsed * number < min_time / 5:
+                number *= 10
+            best = min(timer.repeat(repeat=7, number=number)) / number
+            results.setdefault(name, {})[str(size)] = float('{0:.4g}'.format(best))
+
+    return results
+
+def compare(results, baselines, tolerance):
+    """
+        Returns a list of descriptions of the results that are slower than tolerance times their baseline
+    """
+    regressions = []
+    for name, timings in sorted(results.items()):
+        for size, seconds in sorted(timings.items(), key=lambda item: int(item[0])):
+            baseline = baselines.get(name, {}).get(size)
+            if baseline is not None and seconds > baseline * tolerance:
+                regressions.append('{0} with {1} recepients: {2:.6f}s, baseline {3:.6f}s ({4:.2f}x)'.format(
+                    name, size, seconds, baseline, seconds / baseline))
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the per email address hot paths')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Sizes of the recepient lists')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='JSON file with the baselines')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='Fail when slower than tolerance times the baseline')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baselines')
+    args = parser.parse_args()
+
+    results = run(args.sizes)
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        sys.stdout.write('Baselines saved to {0}\n'.format(args.baseline))
+        sys.exit(0)
+
+    sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+    if not os.path.exists(args.baseline):
+        sys.stdout.write('No baselines at {0}. Run with --save to store them.\n'.format(args.baseline))
+        sys.exit(0)
+
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.tolerance)
+
+    for regression in regressions:
+        sys.stdout.write('REGRESSION: ' + regression + '\n')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,268 @@
+"""
+    Benchmarks the send & status pipelines end to end.
+
+    Runs the real web app (mailr:app on gunicorn, configured by gunicorn_config.py) & worker.py
+    processes against a local Redis & a local stand-in for MailGun & Mandril (see fakeprovider.py)
+    and measures:
+        -- Enqueue throughput & latency of POST /messages
+        -- End to end send latency, from POST /messages until the status record of the request is written
+        -- Latency of POST /status
+        -- Redis memory retained per message once it has been sent
+
+    The Redis database used is flushed before the run, so point --redis-url at one that holds nothing else.
+    To benchmark several shards (see shards.py), give --redis-url a comma separated list of databases.
+    Run from the root of the repository:
+
+        python benchmarks/pipeline.py --messages 2000 --concurrency 50 --workers 4 --latency 0.05
+"""
+from fakeprovider import FakeProviderServer
+import argparse
+import json
+import os
+import redis
+import requests
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import requestids
+import statusstore
+
+CONFIG_TEMPLATE = """
+MAILGUN_BASEURL = '{baseurl}/mailgun'
+MAILGUN_KEY = 'benchmark'
+MANDRIL_BASEURL = '{baseurl}/mandril'
+MANDRIL_KEY = 'benchmark'
+"""
+
+JSON_HEADERS = {'content-type' : 'application/json'}
+
+def percentiles(values):
+    """
+        Returns a dict of the usual percentiles for a list of values (in seconds), converted to milliseconds
+    """
+    if not values:
+        return {}
+
+    values = sorted(values)
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 3)
+
+    return {
+        'count' : len(values),
+        'p50' : at(0.50),
+        'p90' : at(0.90),
+        'p99' : at(0.99),
+        'max' : round(values[-1] * 1000, 3)
+    }
+
+def run_concurrently(func, items, concurrency):
+    """
+        Calls func on every item using the given number of threads. Returns the results in order.
+    """
+    results = [None] * len(items)
+    lock = threading.Lock()
+    position = [0]
+
+    def run():
+        while True:
+            with lock:
+                index = position[0]
+                position[0] += 1
+            if index >= len(items):
+                return
+            results[index] = func(items[index])
+
+    threads = [threading.Thread(target=run) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+class Pipeline(object):
+    """
+        Starts & stops the processes under test
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.processes = []
+        self.config_dir = None
+        self.web_url = 'http://127.0.0.1:{0}'.format(args.web_port)
+
+    def start(self, provider):
+        # mailers.py reads the provider URLs & keys from the config module
+        self.config_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.config_dir, 'config.py'), 'w') as config_file:
+            config_file.write(CONFIG_TEMPLATE.format(baseurl=provider.baseurl))
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([self.config_dir, ROOT_DIR, env.get('PYTHONPATH', '')])
+        env['MAILR_REDIS_URLS'] = self.args.redis_url
+        env['MAILR_ASYNC'] = '1' if self.args.async_web else '0'
+        env['WEB_CONCURRENCY'] = str(self.args.web_workers)
+
+        self.processes.append(subprocess.Popen(
+            ['gunicorn', 'mailr:app', '-c', 'gunicorn_config.py', '-b', '127.0.0.1:{0}'.format(self.args.web_port)],
+            cwd=ROOT_DIR, env=env))
+        for i in range(self.args.workers):
+            self.processes.append(subprocess.Popen([sys.executable, 'worker.py'], cwd=ROOT_DIR, env=env))
+
+        self._wait_for_web()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        if self.config_dir is not None:
+            shutil.rmtree(self.config_dir)
+
+    def _wait_for_web(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if requests.get(self.web_url + '/').status_code == 200:
+                    return
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.1)
+
+        raise RuntimeError('Web process did not start within {0} seconds'.format(timeout))
+
+def make_message(index, recepients):
+    return {
+        'from' : 'Benchmark <benchmark@mailr.com>',
+        'to' : ['recepient{0}.{1}@mailr.com'.format(index, i) for i in range(recepients)],
+        'subject' : 'Benchmark {0}'.format(index),
+        'text' : 'x' * 1000
+    }
+
+def get_shard(request_id):
+    # Request IDs carry their shard. See requestids.py
+    return requestids.parse(request_id).shard
+
+def get_used_memory(connections):
+    # Shards can be databases of the same server, whose memory is only counted once
+    servers = {}
+    for connection in connections:
+        connection_kwargs = connection.connection_pool.connection_kwargs
+        servers[(connection_kwargs.get('host'), connection_kwargs.get('port'))] = connection
+    return sum(connection.info()['used_memory'] for connection in servers.values())
+
+def benchmark(args):
+    connections = [redis.from_url(redis_url) for redis_url in args.redis_url.split(',')]
+    for connection in connections:
+        connection.flushdb()
+    baseline_memory = get_used_memory(connections)
+
+    provider = FakeProviderServer(latency=args.latency, error_rate=args.error_rate).start()
+    pipeline = Pipeline(args)
+    pipeline.start(provider)
+
+    try:
+        session = requests.Session()
+        sent_at = {}
+        first_recepients = {}
+
+        # Enqueue
+        def post_message(index):
+            message = make_message(index, args.recepients)
+            started = time.time()
+            response = session.post(pipeline.web_url + '/messages', data=json.dumps(message), headers=JSON_HEADERS)
+            elapsed = time.time() - started
+            if response.status_code == 202:
+                request_id = response.json()['id']
+                sent_at[request_id] = started
+                first_recepients[request_id] = message['to'][0]
+            return elapsed, response.status_code
+
+        started = time.time()
+        enqueue_results = run_concurrently(post_message, range(args.messages), args.concurrency)
+        enqueue_duration = time.time() - started
+
+        # Wait for every accepted request to be sent
+        send_latencies = []
+        pending = dict(sent_at)
+        deadline = time.time() + args.timeout
+        while pending and time.time() < deadline:
+            request_ids = list(pending)
+            redis_pipelines = [connection.pipeline() for connection in connections]
+            for request_id in request_ids:
+                redis_pipelines[get_shard(request_id)].exists(statusstore._get_record_key(request_id))
+            now = time.time()
+            results = [iter(redis_pipeline.execute()) for redis_pipeline in redis_pipelines]
+            for request_id in request_ids:
+                if next(results[get_shard(request_id)]):
+                    send_latencies.append(now - pending.pop(request_id))
+            time.sleep(0.01)
+
+        retained_memory = get_used_memory(connections) - baseline_memory
+
+        # Status
+        def post_status(request_id):
+            started = time.time()
+            response = session.post(pipeline.web_url + '/status',
+                data=json.dumps({'id' : request_id, 'email' : first_recepients[request_id]}), headers=JSON_HEADERS)
+            return time.time() - started, response.status_code
+
+        sent_ids = [request_id for request_id in sent_at
+            if statusstore.request_exists(connections[get_shard(request_id)], request_id)]
+        status_results = run_concurrently(post_status, sent_ids * args.status_polls, args.concurrency)
+
+    finally:
+        pipeline.stop()
+        provider.shutdown()
+
+    return {
+        'parameters' : vars(args),
+        'enqueue' : {
+            'throughput_per_second' : round(len(enqueue_results) / enqueue_duration, 1),
+            'latency_ms' : percentiles([elapsed for elapsed, status in enqueue_results]),
+            'errors' : len([status for elapsed, status in enqueue_results if status != 202])
+        },
+        'send' : {
+            'latency_ms' : percentiles(send_latencies),
+            'not_sent' : len(pending)
+        },
+        'status' : {
+            'latency_ms' : percentiles([elapsed for elapsed, status in status_results]),
+            'errors' : len([status for elapsed, status in status_results if status != 200])
+        },
+        'redis' : {
+            'retained_bytes_per_message' : round(float(retained_memory) / max(1, len(sent_ids)), 1)
+        },
+        'provider_calls' : provider.calls
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the send & status pipelines end to end')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15', help='Redis database to use, or comma separated databases of each shard. They are flushed!')
+    parser.add_argument('--messages', type=int, default=1000, help='Number of requests to POST to /messages')
+    parser.add_argument('--recepients', type=int, default=1, help='Number of recepients per request')
+    parser.add_argument('--concurrency', type=int, default=20, help='Number of concurrent clients')
+    parser.add_argument('--status-polls', type=int, default=1, help='Number of /status calls per sent request')
+    parser.add_argument('--workers', type=int, default=2, help='Number of worker.py processes')
+    parser.add_argument('--web-workers', type=int, default=2, help='Number of gunicorn workers')
+    parser.add_argument('--web-port', type=int, default=5099)
+    parser.add_argument('--sync-web', dest='async_web', action='store_false', help='Use synchronous gunicorn workers')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency of the provider stand-in, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of provider calls that fail')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for all requests to be sent')
+    parser.add_argument('--output', help='File to write the results to, as JSON. Printed to stdout by default')
+    args = parser.parse_args()
+
+    results = json.dumps(benchmark(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(results)
+    else:
+        sys.stdout.write(results + '\n')
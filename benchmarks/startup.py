@@ -0,0 +1,140 @@
+"""
+    Benchmarks how long web & worker processes take to become ready.
+
+    Each case runs in a fresh Python process, so nothing is imported or cached in memory yet, & is
+    repeated to get the median. The cases are:
+        -- web: importing mailr, which a gunicorn worker does before it serves anything
+        -- web_first_request: what the first requests add on top of it (validating input & creating a mailer)
+        -- worker: importing worker.py, before it takes its first job
+        -- work_horse: what the work horse forked for each job imports before running it
+        -- schemas_cold: loading the input schemas without the cache (see schemas.py)
+        -- schemas_cached: loading them from the cache
+
+    Run from the root of the repository:
+
+        python benchmarks/startup.py --repeat 20
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = ['web', 'web_first_request', 'worker', 'work_horse', 'schemas_cold', 'schemas_cached']
+
+SEND_INPUT = {
+    'from' : 'Benchmark <benchmark@mailr.com>',
+    'to' : ['recepient@mailr.com'],
+    'subject' : 'Benchmark',
+    'text' : 'Benchmark'
+}
+
+def run_case(case):
+    """
+        Runs a case in the current process. Returns the time it took, in seconds.
+    """
+    sys.path.insert(0, ROOT_DIR)
+
+    # mailers.py reads the provider URLs & keys from the config module. Nothing here talks to the
+    # providers, so placeholder values do when there is no config module.
+    try:
+        import config
+    except ImportError:
+        config = types.ModuleType('config')
+        config.MAILGUN_BASEURL = config.MANDRIL_BASEURL = 'http://localhost'
+        config.MAILGUN_KEY = config.MANDRIL_KEY = 'benchmark'
+        sys.modules['config'] = config
+
+    if case == 'web':
+        start = time.time()
+        importlib.import_module('mailr')
+        return time.time() - start
+
+    if case == 'web_first_request':
+        mailr = importlib.import_module('mailr')
+        start = time.time()
+        mailr.validate_send_message_input(SEND_INPUT)
+        mailr.get_mailer('MailGunMailer')
+        return time.time() - start
+
+    if case == 'worker':
+        start = time.time()
+        importlib.import_module('worker')
+        return time.time() - start
+
+    if case == 'work_horse':
+        importlib.import_module('worker')
+        from rq.utils import import_attribute
+        start = time.time()
+        import_attribute('mailers.send_message') # As rq.job.Job.func does in the work horse
+        return time.time() - start
+
+    importlib.import_module('jsonschema') # Left out of the schema cases, which measure reading & checking the schemas
+    schemas = importlib.import_module('schemas')
+    if case == 'schemas_cold':
+        schemas.CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'schemas.cache.json')
+        try:
+            start = time.time()
+            schemas.get_validator('send')
+            return time.time() - start
+        finally:
+            shutil.rmtree(os.path.dirname(schemas.CACHE_PATH))
+
+    if case == 'schemas_cached':
+        start = time.time()
+        schemas.get_validator('send')
+        return time.time() - start
+
+    raise ValueError('Unknown case: ' + case)
+
+def run(cases, repeat):
+    """
+        Runs each case repeat times, each time in a new process
+
+        Returns:
+            dict - For each case, the median, min & max time taken (in milliseconds) in the process,
+                   & the median time taken by the whole process, including starting Python
+    """
+    # The cached schemas case needs a cache
+    subprocess.check_call([sys.executable, os.path.join(ROOT_DIR, 'schemas.py')])
+
+    results = {}
+    for case in cases:
+        timings = []
+        process_timings = []
+        for i in range(repeat):
+            start = time.time()
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', case], cwd=ROOT_DIR)
+            process_timings.append(time.time() - start)
+            timings.append(float(output))
+
+        timings.sort()
+        process_timings.sort()
+        results[case] = {
+            'median' : round(timings[len(timings) // 2] * 1000, 3),
+            'min' : round(timings[0] * 1000, 3),
+            'max' : round(timings[-1] * 1000, 3),
+            'process_median' : round(process_timings[len(process_timings) // 2] * 1000, 3)
+        }
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks how long web & worker processes take to become ready')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES, help='Cases to run')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs of each case')
+    parser.add_argument('--run', choices=CASES, help=argparse.SUPPRESS) # Runs a single case in this process
+    args = parser.parse_args()
+
+    if args.run:
+        sys.stdout.write('{0!r}\n'.format(run_case(args.run)))
+        sys.exit(0)
+
+    sys.stdout.write(json.dumps(run(args.cases, args.repeat), indent=2, sort_keys=True) + '\n')
@@ -0,0 +1,160 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import dns.resolver
+except ImportError:
+    dns = None # dnspython is optional. See dns_resolver()
+
+logger = logging.getLogger(__name__)
+
+# Requests to /messages can be checked for recepients whose domain can't receive mail at all
+# (typically typos like gmial.com) before they're queued, rather than failing later at the provider.
+# Off unless MAILR_DOMAIN_CHECK is set to 1.
+ENABLED = os.getenv('MAILR_DOMAIN_CHECK', '0') == '1'
+
+# How long, in seconds, the result for a domain is shared by all processes through Redis. Domains
+# that don't resolve are cached for less time, in case they're being set up.
+TTL = int(os.getenv('MAILR_DOMAIN_TTL', 86400))
+NEGATIVE_TTL = int(os.getenv('MAILR_DOMAIN_NEGATIVE_TTL', 3600))
+
+# Each process also keeps results in memory for this long, so that most lookups don't need Redis
+LOCAL_TTL = 60
+LOCAL_MAX_DOMAINS = 100000
+
+# Domains resolved by a single request at most. The other unknown ones are let through (& resolved
+# by later requests), so that a request with thousands of new domains isn't held up.
+MAX_RESOLVES_PER_REQUEST = 20
+
+# They're resolved concurrently & the request waits this long, in seconds, for all of them at most.
+# Those still resolving are let through, & their result is cached for later requests once it's in.
+RESOLVE_DEADLINE = float(os.getenv('MAILR_DOMAIN_RESOLVE_DEADLINE', 0.2))
+
+# Only one process resolves a domain at a time. The others let it through meanwhile.
+RESOLVE_LOCK_TTL_MS = 10000
+
+# Results cached in this process, as domain to (expiry time, result)
+_local_cache = {}
+
+def dns_resolver(domain):
+    """
+        Default resolver. A domain can receive mail if it has an MX record or, failing that, an
+        address record (RFC 5321 section 5.1). MX records are looked up when dnspython is installed.
+
+        Returns:
+            bool - Whether the domain can receive mail
+
+            None - If that couldn't be determined, e.g. the DNS server didn't answer
+    """
+    if dns is not None:
+        try:
+            dns.resolver.query(domain, 'MX')
+            return True
+        except dns.resolver.NXDOMAIN:
+            return False
+        except dns.resolver.NoAnswer:
+            pass # No MX record, try the address
+        except dns.exception.DNSException:
+            return None
+
+    try:
+        socket.getaddrinfo(domain, 25)
+        return True
+    except socket.gaierror as e:
+        if e.errno in (socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)):
+            return False
+        return None
+
+# Called with a domain name. Can be replaced with set_resolver(), e.g. with a stub in tests.
+_resolver = [dns_resolver]
+
+def set_resolver(resolver):
+    """
+        Replaces the function used to find out if a domain can receive mail
+
+        Args:
+            resolver (function) - Called with a domain name. Returns True, False or None as dns_resolver() does
+    """
+    _resolver[0] = resolver
+
+def get_undeliverable_domains(connection, domains):
+    """
+        Returns the domains that are known not to be able to receive mail
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection results are shared with
+            domains (iterable) - Domain names
+
+        Returns:
+            set - The undeliverable domains, lowercased
+    """
+    now = time.time()
+    results = {}
+    unknown = []
+    for domain in set(domain.lower() for domain in domains):
+        cached = _local_cache.get(domain)
+        if cached is not None and cached[0] > now:
+            results[domain] = cached[1]
+        else:
+            unknown.append(domain)
+
+    if unknown:
+        pipeline = connection.pipeline()
+        for domain in unknown:
+            pipeline.get(_get_domain_key(domain))
+        unresolved = []
+        for domain, result in zip(unknown, pipeline.execute()):
+            if result is None:
+                unresolved.append(domain)
+            else:
+                results[domain] = result == '1'
+                _cache_locally(domain, results[domain], now)
+
+        results.update(_resolve_all(connection, unresolved[:MAX_RESOLVES_PER_REQUEST]))
+
+    return set(domain for domain, deliverable in results.items() if not deliverable)
+
+def _resolve_all(connection, domains):
+    # Returns the domains resolved within RESOLVE_DEADLINE, by domain. Each one is resolved in a thread
+    # of its own (a greenlet under gevent), which carries on after the deadline if it has to.
+    resolved = {}
+    threads = []
+    for domain in domains:
+        thread = threading.Thread(target=_resolve, args=(connection, domain, resolved))
+        thread.daemon = True # Mustn't keep the process alive
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.time() + RESOLVE_DEADLINE
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    return dict(resolved) # Not to be changed by the threads still running
+
+def _resolve(connection, domain, resolved):
+    key = _get_domain_key(domain)
+    try:
+        if not connection.set(key + ':lock', 1, px=RESOLVE_LOCK_TTL_MS, nx=True):
+            return
+
+        try:
+            result = _resolver[0](domain)
+            if result is not None:
+                connection.set(key, '1' if result else '0', ex=TTL if result else NEGATIVE_TTL)
+                _cache_locally(domain, result, time.time())
+                resolved[domain] = result
+        finally:
+            connection.delete(key + ':lock')
+    except Exception:
+        # Nobody waits for the thread to fail. The domain is let through.
+        logger.exception("Couldn't resolve %s", domain)
+
+def _cache_locally(domain, result, now):
+    if len(_local_cache) >= LOCAL_MAX_DOMAINS:
+        _local_cache.clear()
+    _local_cache[domain] = (now + LOCAL_TTL, result)
+
+def _get_domain_key(domain):
+    return 'mailr:domain:{0}'.format(domain)
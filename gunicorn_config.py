@@ -0,0 +1,33 @@
+import os
+
+# Gunicorn settings for the web process (see Procfile)
+#
+# By default the web process runs gevent workers. gunicorn monkey patches the standard library
+# before loading the app, so Redis calls (enqueue, status records) & the calls made to the email
+# service providers from /status only block the request that made them, not the whole worker
+# process. A single worker can then serve thousands of concurrent /status polls.
+#
+# Set MAILR_ASYNC=0 to fall back to gunicorn's default synchronous workers.
+
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+
+if os.getenv('MAILR_ASYNC', '1') == '1':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('MAILR_WORKER_CONNECTIONS', 1000)) # Concurrent requests per worker
+
+def worker_exit(server, worker):
+    # Web processes only flush their metrics every few seconds. Don't lose the last ones.
+    import metrics
+    import mailr
+    metrics.flush(mailr.conn, metrics.WEB_KEY)
+
+def post_worker_init(worker):
+    # Enqueue the requests kept in the outbox while Redis was unreachable, including the ones left
+    # by earlier processes
+    import outbox
+    import mailr
+    outbox.start_drainer(mailr.connections)
+
+    # Keep a copy of the suppression list's filter, without making requests wait for it
+    import suppression
+    suppression.start_refresher(mailr.conn)
@@ -0,0 +1,225 @@
+import os
+import sys
+import threading
+import time
+
+# Latency critical messages (password resets, one time codes...) can be sent with hedging: when the
+# first provider hasn't answered within its usual latency (95th percentile), the message is also sent
+# through a second one & whichever accepts it first wins. Only for requests with priority 'high'.
+# Off unless MAILR_HEDGING is set to 1.
+ENABLED = os.getenv('MAILR_HEDGING', '0') == '1'
+PRIORITIES = ('high',)
+
+# Both providers may end up sending the message. To keep that rare & harmless:
+#   -- only messages with few recepients are hedged
+#   -- only so many messages are hedged per minute on each shard. Late ones past that just wait.
+#   -- both attempts carry the same Message-Id header, which receiving systems deduplicate by
+MAX_RECEPIENTS = int(os.getenv('MAILR_HEDGE_MAX_RECEPIENTS', 5))
+BUDGET_PER_MINUTE = int(os.getenv('MAILR_HEDGE_BUDGET', 60))
+
+# Latency of each provider is kept as its last SAMPLES send times in a Redis list. Its 95th percentile
+# is shared through Redis for DELAY_TTL seconds. Until a provider has MIN_SAMPLES, DEFAULT_DELAY is used.
+PERCENTILE = 0.95
+SAMPLES = 1000
+MIN_SAMPLES = 20
+DELAY_TTL = 60
+DEFAULT_DELAY = float(os.getenv('MAILR_HEDGE_DEFAULT_DELAY', 1))
+
+# Once a message is sent, the other attempt is left to finish in the background (see in_background())
+# & waited for this long (in seconds) at most, to find out whether the message was sent twice
+LOSER_WAIT = 10
+
+# Threads started by in_background() in this process
+_background = []
+
+def is_eligible(params):
+    """
+        Returns True if a message should be sent with hedging
+
+        Args:
+            params (dict) - Parameters of the message, as passed to mailers.send_message()
+    """
+    recepients = sum(len(params.get(field) or []) for field in ('to', 'cc', 'bcc'))
+    return ENABLED and params.get('priority') in PRIORITIES and recepients <= MAX_RECEPIENTS
+
+def record_latency(connection, provider, seconds):
+    """
+        Adds a sample to the latency of a provider
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection of the shard of the message
+            provider (str) - Class name of the Mailer
+            seconds (float) - Time the provider took to accept a message
+    """
+    key = _get_samples_key(provider)
+    pipeline = connection.pipeline()
+    pipeline.lpush(key, '{0:.4f}'.format(seconds))
+    pipeline.ltrim(key, 0, SAMPLES - 1)
+    pipeline.execute()
+
+def get_delay(connection, provider):
+    """
+        Returns how long (in seconds) to wait for a provider before hedging, i.e. its 95th percentile latency
+    """
+    delay_key = _get_delay_key(provider)
+    delay = connection.get(delay_key)
+    if delay is not None:
+        return float(delay)
+
+    samples = sorted(float(sample) for sample in connection.lrange(_get_samples_key(provider), 0, -1))
+    if len(samples) < MIN_SAMPLES:
+        delay = DEFAULT_DELAY
+    else:
+        delay = samples[min(len(samples) - 1, int(len(samples) * PERCENTILE))]
+    connection.set(delay_key, delay, ex=DELAY_TTL)
+    return delay
+
+def take_budget(connection, now=None):
+    """
+        Uses up one hedge of the budget of the current minute. Returns False if there was none left.
+    """
+    if now is None:
+        now = time.time()
+
+    key = 'mailr:hedge:budget:{0}'.format(int(now) // 60)
+    pipeline = connection.pipeline()
+    pipeline.incr(key)
+    pipeline.expire(key, 120)
+    return pipeline.execute()[0] <= BUDGET_PER_MINUTE
+
+class Attempt(object):
+    """
+        An attempt at sending a message through one provider, run in a thread of its own. Only the
+        outcome is kept. Metrics & logs are left to the caller, in its own thread.
+    """
+
+    def __init__(self, name, send):
+        """
+            Args:
+                name (str) - Class name of the Mailer
+                send (function) - Called without arguments. Returns the messages_info, as Mailer.send_message()
+        """
+        self.name = name
+        self.started = None
+        self.finished = None
+        self.messages_info = None
+        self.exc_info = None
+        self._send = send
+
+    @property
+    def sent(self):
+        return self.finished is not None and self.exc_info is None
+
+    def run(self, race):
+        try:
+            self.messages_info = self._send()
+        except Exception:
+            self.exc_info = sys.exc_info()
+        race.finish(self)
+
+class Race(object):
+    """
+        Races a first & a second attempt at sending the same message. See run()
+    """
+
+    def __init__(self, first, second):
+        self.attempts = [first, second]
+        self.hedged = False # Whether the second attempt was started
+        self.over_budget = False # Whether it wasn't although the first one was late
+        self._condition = threading.Condition()
+
+    def run(self, delay, take_budget):
+        """
+            Starts the first attempt & also the second one if the first hasn't finished within delay
+            seconds & take_budget() allows it, or if the first failed. Returns once an attempt succeeds
+            or all the started ones failed.
+
+            Args:
+                delay (float) - Seconds to wait for the first attempt before hedging
+                take_budget (function) - Called without arguments before hedging. Returns False to not hedge.
+
+            Returns:
+                Attempt - The attempt that sent the message
+
+                None - If all started attempts failed
+        """
+        first, second = self.attempts
+        self._start(first)
+
+        with self._condition:
+            deadline = time.time() + delay
+            while first.finished is None and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+            first_is_late = first.finished is None
+
+        if first_is_late:
+            if take_budget():
+                self.hedged = True
+                self._start(second)
+            else:
+                self.over_budget = True
+        elif not first.sent:
+            self._start(second) # Plain failover, which can't send the message twice
+
+        with self._condition:
+            while True:
+                started = self.get_started()
+                sent = sorted((attempt for attempt in started if attempt.sent), key=lambda attempt: attempt.finished)
+                if sent:
+                    return sent[0]
+                if all(attempt.finished is not None for attempt in started):
+                    return None
+                # With a timeout, the wait can be interrupted (e.g. by the job timeout) although the attempts can't
+                self._condition.wait(1)
+
+    def wait(self, timeout):
+        """
+            Waits up to timeout seconds for all started attempts to finish
+        """
+        with self._condition:
+            deadline = time.time() + timeout
+            while any(attempt.finished is None for attempt in self.get_started()) and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+
+    def get_started(self):
+        return [attempt for attempt in self.attempts if attempt.started is not None]
+
+    def finish(self, attempt):
+        with self._condition:
+            attempt.finished = time.time()
+            self._condition.notify_all()
+
+    def _start(self, attempt):
+        attempt.started = time.time()
+        thread = threading.Thread(target=attempt.run, args=(self,))
+        thread.daemon = True # The other attempt mustn't keep the work horse alive
+        thread.start()
+
+def in_background(function, *args):
+    """
+        Calls function with args in a thread of its own, e.g. to wait for the attempt that lost a race
+        without holding up the job. The work horse waits for these threads once its job is done, but the
+        worker doesn't (see worker.MailrWorker).
+    """
+    thread = threading.Thread(target=function, args=args)
+    thread.daemon = True
+    thread.start()
+    _background.append(thread)
+
+def wait_for_background(timeout=LOSER_WAIT):
+    """
+        Waits up to timeout seconds for the threads started by in_background() to finish. Returns True
+        if there were any.
+    """
+    deadline = time.time() + timeout
+    threads = _background[:]
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    del _background[:]
+    return len(threads) > 0
+
+def _get_samples_key(provider):
+    return 'mailr:hedge:latency:{0}'.format(provider)
+
+def _get_delay_key(provider):
+    return 'mailr:hedge:delay:{0}'.format(provider)
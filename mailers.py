@@ -2,14 +2,31 @@ from email import utils
 from mailrexceptions import MailNotSentException
 from random import shuffle
 from requests.exceptions import ConnectTimeout
-from rq import get_current_job
+from rq import get_current_job, Queue
 import abc
+import addresses
+import analytics
 import config
 import datetime
+import functools
+import hedging
 import json
-import re
+import logging
+import metrics
+import os
+import requestids
 import requests
+import statusstore
 import time
+import tracing
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Requests with more recepients than this are split into chunks, each sent by its own job, so that
+# no call to a provider goes over its per message recepient limit (1000 for MailGun) & a failure
+# only has to be retried for the chunk it happened in
+CHUNK_SIZE = int(os.getenv('MAILR_CHUNK_SIZE', 1000))
 
 class Mailer(object):
     """
@@ -29,6 +46,8 @@ class Mailer(object):
                 text (str) - Main text that should go in the body of the message
                 cc (list) - Optional; list of emails to send the message to, with the 'cc' header
                 bcc (list) - Optional; list of emails to send the message to, with the 'bcc' header
+                message_id (str) - Optional; value of the Message-Id header, e.g. to send the same message
+                                   through several Mailers (see hedging.py)
 
                 All email fields are as specified in RFC-822
 
@@ -54,7 +73,10 @@ class Mailer(object):
                                         -- 'id', the ID for the request to send that message, provided by the email service provider
             Returns:
                 dict - With one field, 'status' that gives the status of the request for the specified message.
-                The status can have values 'accepted','sent' or 'failed'
+                The status can have values 'accepted','sent' or 'failed'. Also has 'suppress' set to True
+                when the provider reports a hard bounce or a complaint, after which nothing more should
+                be sent to the email address, & 'temporary' set to True when a 'failed' message is still
+                retried by the provider (e.g. for a full mailbox), so that it may be sent yet.
 
                 None - When the Mailer can't connect to the underlying email service provider
         """
@@ -100,7 +122,7 @@ class MailGunMailer(Mailer):
             'failed' : 'failed',
             'accepted' : 'accepted',
             'delivered' : 'sent',
-            'compained' : 'sent'
+            'complained' : 'sent'
             # Other event types haven't been enabled for this MailGun subscription
         }
 
@@ -111,7 +133,9 @@ class MailGunMailer(Mailer):
         auth=("api", config.MAILGUN_KEY)
         data={
             "from": params.get('from_email'),
-            "to": params.get('to'),
+            # MailGun needs a 'to' recepient. Chunks with only 'cc' & 'bcc' recepients (see split_recepients())
+            # are sent to the sender, who isn't a recepient of the request & is left out of messages_info.
+            "to": params.get('to') or [params.get('from_email')],
             "subject": params.get('subject'),
             "text": params.get('text')
         }
@@ -134,6 +158,9 @@ class MailGunMailer(Mailer):
             bcc_tuples = MailerUtils.get_name_email_tuples(params.get('bcc'))
             recepient_email_addresses.extend(single_bcc_tuple[1] for single_bcc_tuple in bcc_tuples)
 
+        if 'message_id' in params:
+            data['h:Message-Id'] = params.get('message_id')
+
         # Make & process request
         response = requests.post(url, auth=auth, data=data)
         if(response.status_code == 200):
@@ -164,8 +191,15 @@ class MailGunMailer(Mailer):
             )
 
             response_dict = json.loads(info_response.content)
-            event = response_dict.get('items',[{}])[0].get('event')
+            item = response_dict.get('items',[{}])[0]
+            event = item.get('event')
             status = {'status' : self._event_status_map.get(event)}
+
+            # Failures can be temporary (e.g. a full mailbox), which MailGun retries
+            if(event == 'failed' and item.get('severity') == 'temporary'):
+                status['temporary'] = True
+            if(event == 'complained' or (event == 'failed' and item.get('severity') == 'permanent')):
+                status['suppress'] = True
             return status
 
         except ConnectTimeout:
@@ -241,6 +275,9 @@ class MandrilMailer(Mailer):
             "to": recepients
         }
 
+        if 'message_id' in params:
+            message['headers'] = {'Message-Id': params.get('message_id')}
+
         data = {
             "key": config.MANDRIL_KEY,
             "message": message
@@ -301,6 +338,10 @@ class MandrilMailer(Mailer):
             response_dict = json.loads(info_response.content)
             event = response_dict.get('state')
             status = {'status':self._event_status_map.get(event,'accepted')} #Default is accepted because if the mail isn't delivered, response won't have the state field (null)
+
+            # Soft bounces are reported as 'soft-bounced' & messages Mandril refuses to send as 'rejected'
+            if(event == 'bounced'):
+                status['suppress'] = True
             return status
 
         except ConnectTimeout:
@@ -345,7 +386,7 @@ class MailerUtils:
     def get_name_email_tuple(name_email_string):
         """
             Takes an email string in form as specified by RFC-822 and returns (name,email_address)
-            tuple corresponding to it
+            tuple corresponding to it. See addresses.parse()
 
             Args:
                 name_email_string (string) - String representing an email as specified in RFC-822. Ex: 'First Last <first@provider.tld>''
@@ -356,42 +397,7 @@ class MailerUtils:
 
                 None - If the input string is invalid
         """
-        if(name_email_string is None):
-            return None 
-        
-        # RegExp credit: http://pymotw.com/2/re/
-        pattern = re.compile(
-        '''
-
-        # A name is made up of letters, and may include "." for title
-        # abbreviations and middle initials.
-        ((?P<name>
-           ([\w.,]+\s+)*[\w.,]+)
-           \s*
-           # Email addresses are wrapped in angle brackets: < >
-           # but we only want one if we found a name, so keep
-           # the start bracket in this group.
-           <
-        )? # the entire name is optional
-
-        # The address itself: username@domain.tld
-        (?P<email>
-          [\w\d.+-]+       # username
-          @
-          ([\w\d.]+\.)+    # domain name prefix
-          (com|org|edu)    # TODO: Add more TLDs
-        )
-
-        >? # optional closing angle bracket
-        ''',
-        re.UNICODE | re.VERBOSE)
-
-        match = pattern.search(name_email_string)
-        if match:
-            groupdict = match.groupdict()
-            return groupdict['name'],groupdict['email']
-        else:
-            return None
+        return addresses.parse(name_email_string)
 
     @staticmethod
     def is_email_valid(name_email_string):
@@ -406,14 +412,7 @@ class MailerUtils:
             Returns:
                 bool - Returns result of check of the input string against expected format.
         """
-        if name_email_string is None:
-            return False
-        
-        validation_result = MailerUtils.get_name_email_tuple(name_email_string)
-        if(validation_result is None or validation_result[1] == None):
-            return False
-
-        return True
+        return addresses.parse(name_email_string) is not None
 
 def get_available_mailers():
     """
@@ -436,9 +435,99 @@ def send_message(**params):
             cc (list) - Optional; list of emails to send the message to, with the 'cc' header
             bcc (list) - Optional; list of emails to send the message to, with the 'bcc' header
             retries (int) - Optional; number of times each Mailer implementation should try to send the message
+            retention (str) - Optional; retention tier for the status record of the request. See statusstore.RETENTION_TIERS
+            request_id (str) - Optional; set for the chunks of a request that was split (see split_recepients()),
+                               to the ID of the request they're part of
     
             All email fields are as specified in RFC-822
     """
+    # Continue the trace started by the web app, if the request is traced. The time the job spent
+    # waiting in the queue is recorded as part of it.
+    trace_context = params.get('trace')
+    with tracing.start('mailers.send_message', trace_context) as span:
+        if trace_context is not None:
+            span.add_child('queue_wait', trace_context['enqueued_at'], span.start)
+
+        request_id = params.get('request_id')
+        if request_id is None:
+            chunks = split_recepients(params, CHUNK_SIZE)
+            if len(chunks) > 1:
+                _fan_out(span, chunks)
+                return
+
+        sent_by = _send_message(span, **params)
+        job = get_current_job()
+        if request_id is not None:
+            statusstore.record_chunk_result(job.connection, request_id, sent_by is not None, params.get('retention'))
+        _record_analytics(job, params, sent_by)
+
+def split_recepients(params, chunk_size=CHUNK_SIZE):
+    """
+        Splits a request into chunks of at most chunk_size recepients each
+
+        'to', 'cc' & 'bcc' recepients are split in that order, so none of them gets the message more
+        than once. The chunks left with only 'cc' & 'bcc' recepients have an empty 'to' list. Mailers
+        whose provider needs a 'to' recepient send them to the sender, as for undisclosed recepients,
+        so one of their places is kept for it.
+
+        Args:
+            params (dict) - Parameters of the request, as passed to send_message()
+            chunk_size (int) - Maximum number of recepients per chunk
+
+        Returns:
+            list - Parameters of each chunk. Just params itself if the request doesn't need to be split
+    """
+    recepients = []
+    for field in ('to', 'cc', 'bcc'):
+        recepients.extend((field, recepient) for recepient in params.get(field) or [])
+    if len(recepients) <= chunk_size:
+        return [params]
+
+    chunks = []
+    start = 0
+    while start < len(recepients):
+        end = start + (chunk_size if recepients[start][0] == 'to' else max(chunk_size - 1, 1))
+        chunk = dict(params)
+        for field in ('to', 'cc', 'bcc'):
+            chunk.pop(field, None)
+        for field, recepient in recepients[start:end]:
+            chunk.setdefault(field, []).append(recepient)
+        chunk.setdefault('to', [])
+        chunks.append(chunk)
+        start = end
+
+    return chunks
+
+def _fan_out(span, chunks):
+    """
+        Enqueues a job to send each chunk of the request being sent by the current job. The chunks are
+        sent in parallel by whichever workers pick them up & all record their results under the ID of
+        the request (see statusstore).
+    """
+    job = get_current_job()
+    queue = Queue(job.origin, connection=job.connection)
+    statusstore.save_chunk_progress(job.connection, job.id, len(chunks), chunks[0].get('retention'))
+
+    with span.child('fan_out', chunks=len(chunks)):
+        for chunk in chunks:
+            chunk['request_id'] = job.id
+            trace_context = span.context(enqueued_at=time.time())
+            if trace_context is not None:
+                chunk['trace'] = trace_context
+            queue.enqueue_call(func=send_message, kwargs=chunk, result_ttl=statusstore.JOB_RESULT_TTL)
+
+def _send_message(span, **params):
+    """
+        Tries each Mailer in turn until one sends the message, as described for send_message()
+
+        Args:
+            span (tracing.Span) - Span to record the attempts under
+
+        Returns:
+            str - Class name of the Mailer that sent the message
+
+            None - If no Mailer could send it
+    """
     retries = params.get('retries', 1) #By default retry 1 time
     
     # TODO: Random shuffling is a crude load-balancing method. Ideally we may want to consider
@@ -446,37 +535,182 @@ def send_message(**params):
     mailers = get_available_mailers()
     shuffle(mailers)
 
+    # Latency critical messages are also sent through the second Mailer if the first one is slow. If
+    # neither sends the message, the usual failover & retries follow.
+    if(hedging.is_eligible(params) and len(mailers) >= 2):
+        mailer_name = _send_hedged(span, params, mailers[0], mailers[1])
+        if mailer_name is not None:
+            return mailer_name
+
     #TODO: Check if rq has any inbuilt retry mechanism that can be leveraged
+    attempts_left = (retries + 1) * len(mailers)
     while retries >= 0:
         for mailer in mailers:
+            mailer_name = mailer.__class__.__name__
+            attempts_left = attempts_left - 1
+            started = time.time()
             try:
-                messages_info = mailer.send_message(**params)
+                with span.child('Mailer.send_message', provider=mailer_name):
+                    messages_info = mailer.send_message(**params)
+                metrics.SEND_LATENCY.observe(time.time() - started, mailer_name)
+                metrics.SENDS.inc(mailer_name, 'sent')
                 
+                # Only keep what /status needs. The job itself (with the body & recepients
+                # in its kwargs) is discarded by RQ once this returns.
                 job = get_current_job()
-                job.meta['handled_by'] = mailer.__class__.__name__
-                job.meta['messages_info'] = messages_info
-                job.save()
-
-                # TODO: Use a better way to store status info & metadata for it
-                return
+                statusstore.save_status_record(job.connection, params.get('request_id', job.id), mailer_name,
+                    messages_info, params.get('retention'))
+                if hedging.ENABLED:
+                    hedging.record_latency(job.connection, mailer_name, time.time() - started)
+                return mailer_name
 
             except MailNotSentException as e:
-                # TODO: Use logging here to log details of why this mail wasn't sent using
-                # e.message & e.status_code. Also, add more details to MailNotSentException
-                # if required
-                pass
+                # TODO: Add more details to MailNotSentException if required
+                logger.warning("%s couldn't send message (status code %s): %s", mailer_name, e.status_code, e.message)
+                metrics.SENDS.inc(mailer_name, 'rejected')
             
             except ConnectTimeout as e:
-                # TODO: log
-                pass
+                logger.warning("%s timed out sending message", mailer_name)
+                metrics.SENDS.inc(mailer_name, 'timeout')
             
             # Catch other Exceptions that can be thrown here
             
             except Exception as e:
                 # If the send_message method fails for any reason whatsoever, we want to use the
-                # next Mailer.
-                # TODO: Log. These logs will be very important as they'll let us know about failures
-                # we're not anticipating
-                pass
+                # next Mailer. These logs are important as they let us know about failures we're
+                # not anticipating
+                logger.exception("%s failed sending message", mailer_name)
+                metrics.SENDS.inc(mailer_name, 'error')
+
+            if attempts_left > 0:
+                metrics.FAILOVERS.inc(mailer_name)
+
+        retries = retries - 1
+        if retries >= 0:
+            metrics.RETRIES.inc()
+
+    logger.error("Message couldn't be sent by any Mailer")
+    metrics.SEND_FAILURES.inc()
+    return None
+
+def _send_hedged(span, params, first, second):
+    """
+        Sends a message through the first Mailer & also through the second one if the first hasn't
+        answered within its 95th percentile latency. The first to send it wins. See hedging.py
+
+        The decision & its outcome are added to the status record of the request (see statusstore.save_hedge_outcome()).
+
+        Args:
+            span (tracing.Span) - Span to record the attempts under
+            params (dict) - Parameters of the message, as passed to send_message()
+            first (Mailer) - Mailer to try first
+            second (Mailer) - Mailer to hedge with
 
-        retries = retries - 1
\ No newline at end of file
+        Returns:
+            str - Class name of the Mailer that sent the message
+
+            None - If neither could send it
+    """
+    job = get_current_job()
+    delay = hedging.get_delay(job.connection, first.__class__.__name__)
+
+    # Both attempts send the very same message, down to the Message-Id receiving systems deduplicate by
+    name_email_tuple = addresses.parse(params.get('from_email'))
+    domain = name_email_tuple[1].rsplit('@', 1)[1] if name_email_tuple is not None else 'mailr'
+    hedged_params = dict(params, message_id='<{0}@{1}>'.format(uuid.uuid4().hex, domain))
+
+    race = hedging.Race(*[hedging.Attempt(mailer.__class__.__name__, functools.partial(mailer.send_message, **hedged_params))
+        for mailer in (first, second)])
+    winner = race.run(delay, lambda: hedging.take_budget(job.connection))
+
+    request_id = params.get('request_id', job.id)
+    if winner is not None:
+        statusstore.save_status_record(job.connection, request_id, winner.name, winner.messages_info, params.get('retention'))
+
+    finished = [attempt for attempt in race.get_started() if attempt.finished is not None]
+    for attempt in finished:
+        _record_hedged_attempt(span, job, attempt)
+
+    sent_twice = winner is not None and all(attempt.sent for attempt in race.attempts)
+    metrics.HEDGES.inc('hedged' if race.hedged else 'over_budget' if race.over_budget else 'not_needed')
+    if sent_twice:
+        metrics.HEDGED_DUPLICATES.inc()
+
+    # The job is deleted as soon as it's done (see statusstore.JOB_RESULT_TTL), so the outcome is kept with
+    # the status record. When neither Mailer sent the message, there's no record & the metrics are all there is.
+    if winner is not None:
+        outcome = {
+            'delay' : delay,
+            'first' : race.attempts[0].name,
+            'second' : race.attempts[1].name,
+            'hedged' : race.hedged,
+            'over_budget' : race.over_budget,
+            'sent_by' : winner.name,
+            'sent_twice' : sent_twice
+        }
+        statusstore.save_hedge_outcome(job.connection, request_id, outcome, params.get('retention'))
+
+        # Whether the message was sent twice is only known once the other attempt finishes. The job
+        # doesn't wait for it.
+        unfinished = [attempt for attempt in race.get_started() if attempt.finished is None]
+        if unfinished:
+            hedging.in_background(_finish_hedged, span, job, race, unfinished, request_id, outcome, params.get('retention'))
+
+    return winner.name if winner is not None else None
+
+def _finish_hedged(span, job, race, unfinished, request_id, outcome, retention):
+    """
+        Waits for the attempts of _send_hedged() that were still running when it returned & records them
+    """
+    try:
+        race.wait(hedging.LOSER_WAIT)
+        for attempt in unfinished:
+            _record_hedged_attempt(span, job, attempt)
+
+        if all(attempt.sent for attempt in race.attempts):
+            metrics.HEDGED_DUPLICATES.inc()
+            statusstore.save_hedge_outcome(job.connection, request_id, dict(outcome, sent_twice=True), retention)
+    except Exception:
+        logger.exception("Couldn't record the outcome of a hedged attempt")
+
+def _record_hedged_attempt(span, job, attempt):
+    """
+        Records the metrics, span & logs of an attempt made by _send_hedged(), as _send_message() does for its own
+    """
+    if attempt.finished is None:
+        return # Given up on
+
+    span.add_child('Mailer.send_message', attempt.started, attempt.finished, provider=attempt.name, hedged=True)
+    if attempt.sent:
+        metrics.SEND_LATENCY.observe(attempt.finished - attempt.started, attempt.name)
+        metrics.SENDS.inc(attempt.name, 'sent')
+        hedging.record_latency(job.connection, attempt.name, attempt.finished - attempt.started)
+        return
+
+    error = attempt.exc_info[1]
+    if isinstance(error, MailNotSentException):
+        logger.warning("%s couldn't send message (status code %s): %s", attempt.name, error.status_code, error.message)
+        metrics.SENDS.inc(attempt.name, 'rejected')
+    elif isinstance(error, ConnectTimeout):
+        logger.warning("%s timed out sending message", attempt.name)
+        metrics.SENDS.inc(attempt.name, 'timeout')
+    else:
+        logger.error("%s failed sending message", attempt.name, exc_info=attempt.exc_info)
+        metrics.SENDS.inc(attempt.name, 'error')
+
+def _record_analytics(job, params, sent_by):
+    """
+        Counts the outcome of the current job in the hourly analytics (see analytics.py). Messages are
+        counted as accepted in the hour their request was made, as told by its ID.
+    """
+    # The message has been handled either way, so failing to count it shouldn't fail the job
+    try:
+        name_email_tuple = addresses.parse(params.get('from_email'))
+        sender_domain = name_email_tuple[1].rsplit('@', 1)[1] if name_email_tuple is not None else analytics.NONE
+        recepients = sum(len(params.get(field) or []) for field in ('to', 'cc', 'bcc'))
+        request_id = requestids.parse(params.get('request_id', job.id))
+
+        analytics.record_send(job.connection, sender_domain, recepients, sent_by,
+            request_id.created_at if request_id is not None else time.time())
+    except Exception:
+        logger.exception("Couldn't record the outcome of the message in the analytics")
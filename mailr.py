@@ -1,25 +1,56 @@
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template
 from flask import jsonify
-from jsonschema import validate, ValidationError
 from mailers import MailerUtils, MailGunMailer, MandrilMailer
 from mailrexceptions import InvalidInputException
 from redis import Redis
 from rq import Queue
-import json
+import admission
+import analytics
+import autoscale
+import domains
 import mailers
 import logging
+import metrics
+import outbox
 import redis
 import os
+import requestids
+import schemas
+import shards
+import statuscache
+import statusstore
+import suppression
 import sys
+import time
+import tracing
 from logging import StreamHandler
 
 # Setup flask
 app = Flask(__name__)
 
 # Setup Redis
-redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
-conn = redis.from_url(redis_url)
-q = Queue(connection=conn)
+# With gevent workers (see gunicorn_config.py) every in-flight request could otherwise open its own
+# connection. A blocking pool caps the connections per process & makes requests wait for a free one.
+# Calls to Redis (including the wait for a connection) give up after MAILR_REDIS_TIMEOUT seconds.
+# When Redis itself can't be reached, requests to /messages then go to the outbox (see outbox.py).
+# When all connections were taken, they're answered with a 503.
+redis_max_connections = int(os.getenv('MAILR_REDIS_MAX_CONNECTIONS', 50))
+redis_timeout = float(os.getenv('MAILR_REDIS_TIMEOUT', 1))
+
+# One connection per shard (see shards.py), in the order of shards.REDIS_URLS
+connections = [redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(redis_url, max_connections=redis_max_connections,
+    timeout=redis_timeout, socket_timeout=redis_timeout, socket_connect_timeout=redis_timeout)) for redis_url in shards.REDIS_URLS]
+
+# The suppression list, domain results & metrics are kept on the primary shard
+conn = connections[shards.PRIMARY]
+
+# Requests are enqueued according to their priority, on the queues of their shard. Workers take jobs
+# from 'high' first & 'bulk' last.
+queues_by_shard = [{
+    'high' : Queue('high', connection=connection),
+    'normal' : Queue(connection=connection),
+    'bulk' : Queue('bulk', connection=connection)
+} for connection in connections]
 
 # Setup mailers
 # When checking status of a message, we'll use the mailers directly as these
@@ -27,24 +58,11 @@ q = Queue(connection=conn)
 # for status in the background automatically.
 # Ideally we should have a worker that polls the underlying email service to get the
 # status of the messages that were sent using it
-mailgun_mailer = MailGunMailer()
-mandril_mailer = MandrilMailer()
+# Each mailer is only created when first needed. See get_mailer()
+mailer_classes = dict((mailer_class.__name__, mailer_class) for mailer_class in (MailGunMailer, MandrilMailer))
+available_mailers = {}
 
-available_mailers = {
-    mailgun_mailer.__class__.__name__ : mailgun_mailer,
-    mandril_mailer.__class__.__name__ : mandril_mailer
-}
-
-# Read JSON schemas for input
-send_input_schema_dict = None
-with open ("./static/send_input_schema.json", "r") as schema_file:
-    send_input_schema_string=schema_file.read()
-    send_input_schema_dict = json.loads(send_input_schema_string)
-
-info_input_schema_dict = None
-with open ("./static/info_input_schema.json", "r") as schema_file:
-    info_input_schema_string=schema_file.read()
-    info_input_schema_dict = json.loads(info_input_schema_string)
+# The JSON schemas for input are loaded on first use. See schemas.py
 
 
 # Index page
@@ -67,22 +85,77 @@ def send_message():
         resp = create_response("Input should be specified in valid JSON format only",400)
         return resp
 
-    # Validate input
-    validate_send_message_input(request.json)
+    with tracing.start('mailr.send_message') as span:
+        # Validate input
+        with span.child('validate'):
+            name_email_tuples = validate_send_message_input(request.json)
+
+        # To use **kwargs, the parameter name 'form' can't be used as it's a python keyword.
+        # So, copy the value from request.json['from'] to request.json['from_email']
+        # Other option: The 'from' field from the input schema can be changed to something that's not a python keyword
+        # I just feel it's more natural from an end user's perspective to remember the name of the from field is 'from'
+        # as opposed to something like from_email
+        request.json['from_email'] = request.json['from']
+
+        # The trace (if the request is traced) is continued by the worker
+        trace_context = span.context(enqueued_at=time.time())
+        if trace_context is not None:
+            request.json['trace'] = trace_context
+
+        priority = request.json.get('priority', 'normal')
+        job_id, shard = shards.new_request_id(request.json.get('retention'))
+        queue = queues_by_shard[shard][priority]
+        enqueued = False
+        suppressed = []
+
+        # While Redis is down, requests go straight to the outbox (see below)
+        if(not outbox.is_redis_down()):
+            try:
+                # Reject recepients whose domain can't receive mail (off by default, see domains.py)
+                if(domains.ENABLED):
+                    with span.child('domains'):
+                        check_recepient_domains(request.json, name_email_tuples)
+
+                # Drop recepients that are on the suppression list, so they're never enqueued
+                with span.child('suppression'):
+                    suppressed = drop_suppressed_recepients(request.json, name_email_tuples)
+
+                # Shed load when the workers can't keep up, lowest priority first
+                retry_after = admission.check(connections[shard], queues_by_shard[shard], priority)
+                if(retry_after is not None):
+                    metrics.ENQUEUED.inc('rejected')
+                    resp = create_response("Too many requests are waiting to be sent. Please try again later.", 429)
+                    resp.headers['Retry-After'] = str(retry_after)
+                    return resp
+
+                # The job is discarded once it's done. What /status needs is kept in a separate, compact
+                # record by mailers.send_message (see statusstore)
+                with span.child('enqueue'), metrics.ENQUEUE_LATENCY.time():
+                    queue.enqueue_call(func=mailers.send_message, kwargs=request.json, result_ttl=statusstore.JOB_RESULT_TTL, job_id=job_id)
+                enqueued = True
+                metrics.ENQUEUED.inc('accepted')
+
+            except redis.exceptions.RedisError as e:
+                if(isinstance(e, redis.exceptions.ConnectionError) and not outbox.is_unreachable(e)):
+                    # All pooled connections are in use. Redis is fine, this process is just too busy.
+                    metrics.ENQUEUED.inc('busy')
+                    resp = create_response("This request cannot be served right now. Please try again.", 503)
+                    resp.headers['Retry-After'] = '1'
+                    return resp
+                if(not outbox.ENABLED or not outbox.is_unreachable(e)):
+                    metrics.ENQUEUED.inc('error')
+                    raise
+                outbox.mark_redis_down()
+
+        # Redis can't be reached. Keep the request on local disk until it can be enqueued.
+        if(not enqueued):
+            with span.child('outbox'):
+                outbox.append(queue.name, 'mailers.send_message', request.json, statusstore.JOB_RESULT_TTL, job_id=job_id, shard=shard)
+            metrics.ENQUEUED.inc('outbox')
 
-    # To use **kwargs, the parameter name 'form' can't be used as it's a python keyword.
-    # So, copy the value from request.json['from'] to request.json['from_email']
-    # Other option: The 'from' field from the input schema can be changed to something that's not a python keyword
-    # I just feel it's more natural from an end user's perspective to remember the name of the from field is 'from'
-    # as opposed to something like from_email
-    request.json['from_email'] = request.json['from']
-
-    job = q.enqueue_call(func=mailers.send_message, kwargs=request.json, result_ttl=86400)  # Store result for 1 day
-    job_id = job.get_id()
-    
-    # TODO: The ID returned for a request should definitely be something better than the job_id 
-    # of the job enqueues for a serious application.
     info = {'id' : job_id}
+    if(len(suppressed) != 0):
+        info['suppressed'] = suppressed
     resp = create_response("Your request has been accepted", 202, info)
     return resp
 
@@ -102,40 +175,176 @@ def get_status():
         resp = create_response("Input should be specified in valid JSON format only",400)
         return resp
             
-    validate_get_status_input(request.json)
+    name, email_address = validate_get_status_input(request.json)
 
-    name, email_address = MailerUtils.get_name_email_tuple(request.json.get('email'))
-
-    # Get the job associated with the given ID from the Queue
+    # Get the status record stored for the recepient of the request with the given ID
     job_id = request.json['id']
-    job = q.fetch_job(job_id)
-    
-    if(job is None):
+    shard = shards.get_shard(job_id)
+    if(shard is None):
         resp = create_response("Cannot find result for supplied ID and email", 404)
         return resp
 
-    # Get relevant metadata from the job
-    mailer_name = job.meta['handled_by'] # Which mailer was used
-    messages_info = job.meta['messages_info'] # Info about all recepients and underlying provider specific ID for the request
-
-    # Get info about the relevant message
-    single_message_info = next(message_info for message_info in messages_info if message_info.get('email_address') == email_address)
-    if(single_message_info is None):
-        resp = create_response("Cannot find message sent to {0} during request with ID {1}".format(email_address,job_id),404)
+    # Told by the ID alone, without calling Redis
+    if(statusstore.is_expired(job_id)):
+        resp = create_response("The status of request with ID {0} has expired".format(job_id), 404)
         return resp
 
-    relevant_mailer = available_mailers[mailer_name]
-    status_info = relevant_mailer.get_message_status(single_message_info)
+    shard_conn = connections[shard]
+    found = statusstore.get_message_info(shard_conn, job_id, email_address)
+
+    if(found is None):
+        # Requests with many recepients are sent in chunks. Report how far along they are.
+        chunk_progress = statusstore.get_chunk_progress(shard_conn, job_id)
+        if(chunk_progress is not None):
+            resp = create_response("Cannot find message sent to {0} during request with ID {1}. {2} of its {3} parts have been processed".format(
+                email_address, job_id, chunk_progress['sent'] + chunk_progress['failed'], chunk_progress['total']), 404, {'chunks' : chunk_progress})
+            return resp
+
+        if(statusstore.request_exists(shard_conn, job_id)):
+            resp = create_response("Cannot find message sent to {0} during request with ID {1}".format(email_address,job_id),404)
+            return resp
+
+        # Requests enqueued before status records were introduced keep their metadata on the job. They
+        # also have IDs from before requestids.py
+        if(requestids.parse(job_id) is None):
+            found = _get_legacy_message_info(queues_by_shard[shard]['normal'], job_id, email_address)
+        if(found is None):
+            resp = create_response("Cannot find result for supplied ID and email", 404)
+            return resp
+
+    mailer_name, single_message_info = found # Which mailer was used & the provider specific ID of the message
+    relevant_mailer = get_mailer(mailer_name)
+    status_info = statuscache.get_message_status(shard_conn, job_id, relevant_mailer, single_message_info, suppression_connection=conn)
     
     if(status_info is None):
         # Must have timed out
         resp = create_response("This request cannot be served right now. Please try again.", 503)
         return resp
 
+    # Requests sent with hedging (see hedging.py) also tell how that went
+    hedge = statusstore.get_hedge_outcome(shard_conn, job_id)
+    if(hedge is not None):
+        status_info = dict(status_info, hedge=hedge)
+
     resp = create_response(None, 200, status_info)
     return resp
 
 
+@app.route('/suppressions', methods=['POST'])
+def add_suppressions():
+    """
+        Adds email addresses to the suppression list, so that no more messages are sent to them.
+        Meant to be called from the bounce & complaint webhooks of the email service providers.
+        Addresses whose messages hard-bounce or get a complaint are added automatically when their
+        status is checked.
+    """
+    # Only accept JSON
+    if not request.json:
+        resp = create_response("Input should be specified in valid JSON format only",400)
+        return resp
+
+    email_addresses = validate_suppressions_input(request.json)
+    suppression.suppress(conn, email_addresses)
+
+    resp = create_response("{0} email(s) suppressed".format(len(email_addresses)), 200)
+    return resp
+
+@app.route('/suppressions', methods=['DELETE'])
+def remove_suppressions():
+    """
+        Removes email addresses from the suppression list, so that messages are sent to them again.
+        Takes the same input as a POST.
+    """
+    # Only accept JSON
+    if not request.json:
+        resp = create_response("Input should be specified in valid JSON format only",400)
+        return resp
+
+    email_addresses = validate_suppressions_input(request.json)
+    suppression.unsuppress(conn, email_addresses)
+
+    resp = create_response("{0} email(s) removed from the suppression list".format(len(email_addresses)), 200)
+    return resp
+
+@app.route('/analytics', methods=['POST'])
+def get_analytics():
+    """
+        Hourly counts of accepted, sent & failed messages by provider & sender domain, for dashboards.
+        The user supplies a time range ('start' & 'end', in seconds since the epoch) & optionally a
+        'provider' or sender 'domain' to count only its messages. See analytics.py
+    """
+    # Only accept JSON
+    if not request.json:
+        resp = create_response("Input should be specified in valid JSON format only",400)
+        return resp
+
+    validate_get_analytics_input(request.json)
+    hours = analytics.query(connections, request.json['start'], request.json['end'],
+        request.json.get('provider'), request.json.get('domain'))
+
+    resp = create_response(None, 200, {'hours' : hours})
+    return resp
+
+@app.route('/autoscale', methods=['GET'])
+def get_autoscale():
+    """
+        Queue depth & lag, utilisation of the workers & the number of workers recommended, for an
+        external autoscaler. See autoscale.get_signal()
+    """
+    signal = autoscale.get_signal(conn, [queues.values() for queues in queues_by_shard])
+    resp = create_response(None, 200, signal)
+    return resp
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+        Metrics of the web app in the Prometheus text format, aggregated over all web processes.
+        Metrics of the workers are served by each worker on its own port (see worker.py)
+    """
+    metrics.flush(conn, metrics.WEB_KEY)
+    content = metrics.render(conn, metrics.WEB_KEY, metrics.get_queue_depth_gauge(
+        dict((shard, queues.values()) for shard, queues in enumerate(queues_by_shard))))
+    return Response(content, mimetype='text/plain')
+
+@app.after_request
+def flush_metrics(response):
+    # Not while Redis is known to be down (see outbox.py), or the request would wait for it to time out.
+    # The values are kept until the next flush.
+    if(outbox.is_redis_down()):
+        return response
+
+    try:
+        metrics.maybe_flush(conn, metrics.WEB_KEY)
+    except redis.RedisError:
+        app.logger.exception("Couldn't flush metrics to Redis")
+    return response
+
+def _get_legacy_message_info(queue, job_id, email_address):
+    """
+        Looks up the message_info for a recepient in the metadata of the job with the given ID,
+        where it was kept before status records were introduced.
+
+        Args:
+            queue (rq.Queue) - A queue on the shard of the request
+            job_id (str) - ID of the request
+            email_address (str) - Email address of the recepient
+
+        Returns:
+            tuple - Of form (handled_by, message_info), as statusstore.get_message_info()
+
+            None - If the job doesn't exist, hasn't been handled yet or didn't send to the email address
+    """
+    job = queue.fetch_job(job_id)
+    if(job is None or 'handled_by' not in job.meta):
+        return None
+
+    single_message_info = next((message_info for message_info in job.meta['messages_info']
+        if message_info.get('email_address') == email_address), None)
+    if(single_message_info is None):
+        return None
+
+    return job.meta['handled_by'], single_message_info
+
 def create_response(text, status, info = {}):
     """
         Creates response in a format consistent throughout the application
@@ -153,49 +362,66 @@ def create_response(text, status, info = {}):
     resp.status_code = status
     return resp
 
+def get_mailer(mailer_name):
+    """
+        Returns the mailer with the given class name, creating it on first use
+
+        Args:
+            mailer_name (str) - Class name of the Mailer, as kept in the meta of jobs under 'handled_by'
+    """
+    mailer = available_mailers.get(mailer_name)
+    if(mailer is None):
+        mailer = available_mailers[mailer_name] = mailer_classes[mailer_name]()
+    return mailer
+
 def validate_send_message_input(input_dict):
     """
         Validates the input supplied for the POST call on the message resource.
+        All problems with the input are reported at once, both schema violations & invalid email addresses.
 
         Args:
             input_dict - JSON input in dictionary form
 
+        Returns:
+            dict - (name,email_address) tuples of the parsed email fields. 'from' maps to a single tuple,
+                   'to', 'cc' and 'bcc' (if present) map to lists of tuples.
+
         Throws:
             InvalidInputException when input is malformed or doesn't match schema
     """
 
     ## Validate against JSON schema
-    try:
-        validate(input_dict, send_input_schema_dict)
-    except ValidationError as e:
-        raise InvalidInputException(e.message)
+    schema_errors = list(schemas.get_validator('send').iter_errors(input_dict))
 
-    ## Validate email addresses
+    ## Parse & validate email addresses in the same pass. Fields of the wrong type have
+    ## already been reported by the schema validation, so they're skipped here.
     invalid_emails = []
-    
-    # Validate from
-    from_email = input_dict.get('from')
-    if(not MailerUtils.is_email_valid(from_email)):
-        invalid_emails.append(from_email)
-
-    # Validate to
-    for to_email in input_dict.get('to'):
-        if(not MailerUtils.is_email_valid(to_email)):
-            invalid_emails.append(to_email)
-
-    # Validate cc
-    for to_email in input_dict.get('cc', []):
-        if(not MailerUtils.is_email_valid(to_email)):
-            invalid_emails.append(to_email)
-
-    # Validate bcc
-    for to_email in input_dict.get('bcc',[]):
-        if(not MailerUtils.is_email_valid(to_email)):
-            invalid_emails.append(to_email)
-    
-    if(len(invalid_emails)!=0):
-        payload = {"invalid_emails":invalid_emails}
-        raise InvalidInputException(message = "Input contains invalid email(s)", payload = payload)
+    name_email_tuples = {}
+
+    if isinstance(input_dict, dict):
+        from_email = input_dict.get('from')
+        if isinstance(from_email, basestring):
+            name_email_tuples['from'] = _parse_email(from_email, invalid_emails)
+
+        for field in ('to', 'cc', 'bcc'):
+            emails = input_dict.get(field)
+            if isinstance(emails, list):
+                name_email_tuples[field] = [_parse_email(email, invalid_emails)
+                    for email in emails if isinstance(email, basestring)]
+
+    if(len(schema_errors) == 0 and len(invalid_emails) == 0):
+        return name_email_tuples
+
+    payload = {}
+    if(len(invalid_emails) != 0):
+        payload['invalid_emails'] = invalid_emails
+        message = "Input contains invalid email(s)"
+
+    if(len(schema_errors) != 0):
+        payload['errors'] = sorted(error.message for error in schema_errors)
+        message = schemas.best_match(schema_errors).message
+
+    raise InvalidInputException(message = message, payload = payload)
 
 def validate_get_status_input(input_dict):
     """
@@ -204,21 +430,136 @@ def validate_get_status_input(input_dict):
         Args:
             input_dict (dict) - JSON input in dictionary form
 
+        Returns:
+            tuple - (name,email_address) tuple of the parsed 'email' field
+
         Throws:
             InvalidInputException when input is malformed or doesn't match schema for this call.
     """
 
     # Validate against JSON schema
-    try:
-        validate(input_dict, info_input_schema_dict)
-    except ValidationError as e:
-        raise InvalidInputException(e.message)
+    schema_errors = list(schemas.get_validator('info').iter_errors(input_dict))
+    if(len(schema_errors) != 0):
+        payload = {'errors' : sorted(error.message for error in schema_errors)}
+        raise InvalidInputException(message = schemas.best_match(schema_errors).message, payload = payload)
 
     # Validate email address
     email = input_dict.get('email')
-    if(not MailerUtils.is_email_valid(email)):
+    name_email_tuple = MailerUtils.get_name_email_tuple(email)
+    if(name_email_tuple is None):
         raise InvalidInputException(message = "Input contains invalid email: "+email)
 
+    return name_email_tuple
+
+def validate_suppressions_input(input_dict):
+    """
+        Validates the input supplied for the POST & DELETE calls on the suppressions resource.
+
+        Args:
+            input_dict (dict) - JSON input in dictionary form
+
+        Returns:
+            list - Email addresses (without names) of the 'emails' field
+
+        Throws:
+            InvalidInputException when input is malformed or doesn't match schema for this call.
+    """
+    schema_errors = list(schemas.get_validator('suppression').iter_errors(input_dict))
+    if(len(schema_errors) != 0):
+        payload = {'errors' : sorted(error.message for error in schema_errors)}
+        raise InvalidInputException(message = schemas.best_match(schema_errors).message, payload = payload)
+
+    invalid_emails = []
+    name_email_tuples = [_parse_email(email, invalid_emails) for email in input_dict['emails']]
+    if(len(invalid_emails) != 0):
+        raise InvalidInputException(message = "Input contains invalid email(s)", payload = {'invalid_emails' : invalid_emails})
+
+    return [email_address for name, email_address in name_email_tuples]
+
+def validate_get_analytics_input(input_dict):
+    """
+        Validates the input supplied for the POST call on the analytics resource.
+
+        Args:
+            input_dict (dict) - JSON input in dictionary form
+
+        Throws:
+            InvalidInputException when input is malformed, doesn't match schema for this call or covers too long a range
+    """
+    schema_errors = list(schemas.get_validator('analytics').iter_errors(input_dict))
+    if(len(schema_errors) != 0):
+        payload = {'errors' : sorted(error.message for error in schema_errors)}
+        raise InvalidInputException(message = schemas.best_match(schema_errors).message, payload = payload)
+
+    if(input_dict['end'] - input_dict['start'] > analytics.MAX_QUERY_HOURS * analytics.BUCKET_SECONDS):
+        raise InvalidInputException(message = "Can't query more than {0} hours at once".format(analytics.MAX_QUERY_HOURS))
+
+def check_recepient_domains(input_dict, name_email_tuples):
+    """
+        Checks that the domains of the 'to', 'cc' & 'bcc' recepients of a validated request to send
+        a message can receive mail. See domains.get_undeliverable_domains()
+
+        Args:
+            input_dict (dict) - JSON input in dictionary form
+            name_email_tuples (dict) - As returned by validate_send_message_input() for input_dict
+
+        Throws:
+            InvalidInputException when the domain of any recepient can't receive mail
+    """
+    fields = [field for field in ('to', 'cc', 'bcc') if field in name_email_tuples]
+    undeliverable = domains.get_undeliverable_domains(conn,
+        [email_address.rsplit('@', 1)[1] for field in fields for name, email_address in name_email_tuples[field]])
+    if(len(undeliverable) == 0):
+        return
+
+    invalid_emails = [email for field in fields for email, (name, email_address) in zip(input_dict[field], name_email_tuples[field])
+        if email_address.rsplit('@', 1)[1].lower() in undeliverable]
+    raise InvalidInputException(message = "Input contains email(s) whose domain can't receive mail",
+        payload = {'invalid_emails' : invalid_emails})
+
+def drop_suppressed_recepients(input_dict, name_email_tuples):
+    """
+        Removes the recepients that are on the suppression list from the 'to', 'cc' & 'bcc' fields of a
+        validated request to send a message
+
+        Args:
+            input_dict (dict) - JSON input in dictionary form. Modified in place
+            name_email_tuples (dict) - As returned by validate_send_message_input() for input_dict
+
+        Returns:
+            list - Email addresses that were removed, sorted
+
+        Throws:
+            InvalidInputException when every 'to' recepient is suppressed
+    """
+    fields = [field for field in ('to', 'cc', 'bcc') if field in name_email_tuples]
+    suppressed = suppression.get_suppressed(conn,
+        [email_address for field in fields for name, email_address in name_email_tuples[field]])
+    if(len(suppressed) == 0):
+        return []
+
+    for field in fields:
+        input_dict[field] = [email for email, (name, email_address) in zip(input_dict[field], name_email_tuples[field])
+            if email_address not in suppressed]
+        if(field != 'to' and len(input_dict[field]) == 0):
+            del input_dict[field]
+
+    if(len(input_dict['to']) == 0):
+        raise InvalidInputException(message = "All recepients in 'to' are on the suppression list",
+            payload = {'suppressed' : sorted(suppressed)})
+
+    return sorted(suppressed)
+
+def _parse_email(email, invalid_emails):
+    """
+        Returns the (name,email_address) tuple for an email, adding it to invalid_emails if it isn't valid
+    """
+    name_email_tuple = MailerUtils.get_name_email_tuple(email)
+    if(name_email_tuple is None):
+        invalid_emails.append(email)
+
+    return name_email_tuple
+
 @app.errorhandler(InvalidInputException)
 def handle_invalid_input(error):
     """
@@ -235,6 +576,8 @@ def handle_invalid_input(error):
     return response
 
 if __name__ == '__main__':
+    outbox.start_drainer(connections)
+    suppression.start_refresher(conn)
     app.debug = True # Only for development, not prod
     app.logger.addHandler(logging.StreamHandler(sys.stdout))
     app.logger.setLevel(logging.DEBUG)
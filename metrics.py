@@ -0,0 +1,248 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Metrics are first aggregated in the process that records them & periodically flushed to a Redis
+# hash, where the values of all processes of the same kind add up. This is needed because the web
+# app runs several gunicorn processes behind one port & RQ performs each job in a short lived forked
+# process. Both /metrics & the worker sidecar render the aggregated values from Redis.
+WEB_KEY = 'mailr:metrics:web'
+WORKER_KEY = 'mailr:metrics:worker'
+
+# Web processes flush at most this often (in seconds). Work horses flush once per job.
+FLUSH_INTERVAL = 5
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# All metrics, in the order they're rendered
+_registry = []
+
+class Counter(object):
+    """
+        A value that only goes up, optionally split by labels
+
+        Updates aren't locked. The web app (gevent) & the work horses record metrics from a single OS
+        thread, so the read-modify-write of an update can't be interleaved with another one.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+            Initializes & registers a new metric
+
+            Args:
+                name (str) - Name of the metric, as exposed to Prometheus
+                documentation (str) - Description of the metric
+                labelnames (tuple) - Names of the labels. Values must be passed in the same order when recording
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labelvalues):
+        """
+            Increments the counter by 1 for the given label values
+        """
+        series = self._series(self.name, labelvalues)
+        self._values[series] = self._values.get(series, 0) + 1
+
+    def collect(self):
+        """
+            Returns the values recorded since the last call, as a dict of series name to value, & resets them
+        """
+        values, self._values = self._values, {}
+        return values
+
+    def _series(self, name, labelvalues, extra_labels=()):
+        labels = list(zip(self.labelnames, labelvalues)) + list(extra_labels)
+        if not labels:
+            return name
+        return '{0}{{{1}}}'.format(name, ','.join('{0}="{1}"'.format(label, value) for label, value in labels))
+
+class Histogram(Counter):
+    """
+        Distribution of observed values (typically latencies in seconds), optionally split by labels
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        Counter.__init__(self, name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labelvalues):
+        """
+            Records a value for the given label values
+        """
+        values = self._values
+        for bucket in self.buckets:
+            # Buckets are cumulative. All of them are set, even to 0, so every series has all its buckets
+            series = self._series(self.name + '_bucket', labelvalues, [('le', bucket)])
+            values[series] = values.get(series, 0) + (1 if value <= bucket else 0)
+
+        series = self._series(self.name + '_bucket', labelvalues, [('le', '+Inf')])
+        values[series] = values.get(series, 0) + 1
+        series = self._series(self.name + '_count', labelvalues)
+        values[series] = values.get(series, 0) + 1
+        series = self._series(self.name + '_sum', labelvalues)
+        values[series] = values.get(series, 0) + value
+
+    def time(self, *labelvalues):
+        """
+            Returns a context manager observing the time spent in its block
+        """
+        return _Timer(self, labelvalues)
+
+class _Timer(object):
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.started, *self.labelvalues)
+
+# Web
+ENQUEUE_LATENCY = Histogram('mailr_enqueue_seconds', 'Time taken to enqueue a request to send a message')
+ENQUEUED = Counter('mailr_enqueued_total', 'Requests to send a message, by result', ('result',))
+STATUS_POLL_LATENCY = Histogram('mailr_provider_status_poll_seconds', 'Time taken to poll a provider for the status of a message', ('provider',))
+STATUS_POLLS = Counter('mailr_provider_status_polls_total', 'Status polls made to providers, by result', ('provider', 'result'))
+
+# Worker
+SEND_LATENCY = Histogram('mailr_provider_send_seconds', 'Time taken by a provider to accept a message', ('provider',))
+SENDS = Counter('mailr_provider_sends_total', 'Attempts to send a message through a provider, by result', ('provider', 'result'))
+RETRIES = Counter('mailr_send_retries_total', 'Times all providers failed & were tried again for a message')
+FAILOVERS = Counter('mailr_send_failovers_total', 'Times a provider failed & the next one was tried', ('provider',))
+SEND_FAILURES = Counter('mailr_send_failures_total', 'Messages that couldn\'t be sent by any provider after all retries')
+HEDGES = Counter('mailr_send_hedges_total', 'Messages eligible for hedging, by whether a second provider was tried', ('decision',))
+HEDGED_DUPLICATES = Counter('mailr_send_hedged_duplicates_total', 'Hedged messages that both providers sent')
+
+_last_flush = [0]
+
+def flush(connection, key):
+    """
+        Adds the values recorded in this process since the last flush to the Redis hash at key
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection to flush to
+            key (str) - WEB_KEY or WORKER_KEY
+    """
+    _last_flush[0] = time.time()
+
+    pipeline = connection.pipeline()
+    for metric in _registry:
+        for series, value in metric.collect().items():
+            pipeline.hincrbyfloat(key, series, value)
+
+    try:
+        pipeline.execute()
+    except Exception:
+        # Losing some metrics is better than failing the request or job that's flushing them
+        logger.exception("Couldn't flush metrics to Redis")
+
+def maybe_flush(connection, key):
+    """
+        Flushes the recorded values if the last flush was more than FLUSH_INTERVAL seconds ago
+    """
+    if time.time() - _last_flush[0] >= FLUSH_INTERVAL:
+        flush(connection, key)
+
+def render(connection, key, gauges=None):
+    """
+        Renders the aggregated values in the Prometheus text exposition format
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the values were flushed to
+            key (str) - WEB_KEY or WORKER_KEY
+            gauges (dict) - Optional; current values of gauges to render along, as a dict of
+                            (name, documentation) to a dict of series name to value
+
+        Returns:
+            str - The rendered metrics
+    """
+    values = connection.hgetall(key)
+    series_by_name = {}
+    for series, value in values.items():
+        name = series.split('{', 1)[0]
+        for suffix in ('_bucket', '_count', '_sum'):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+        series_by_name.setdefault(name, []).append((series, value))
+
+    lines = []
+    for metric in _registry:
+        if metric.name not in series_by_name:
+            continue
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+        lines.extend('{0} {1}'.format(series, _format_value(value))
+            for series, value in sorted(series_by_name[metric.name], key=_get_series_sort_key))
+
+    for (name, documentation), gauge_values in sorted((gauges or {}).items()):
+        lines.append('# HELP {0} {1}'.format(name, documentation))
+        lines.append('# TYPE {0} gauge'.format(name))
+        lines.extend('{0} {1}'.format(series, value) for series, value in sorted(gauge_values.items()))
+
+    return '\n'.join(lines) + '\n'
+
+def get_queue_depth_gauge(queues_by_shard):
+    """
+        Returns the queue depth gauge for the given RQ queues, for render()
+
+        Args:
+            queues_by_shard (dict) - Shard (see shards.py) to the queues on it
+    """
+    return {
+        ('mailr_queue_depth', 'Jobs waiting in the queue') :
+            dict(('mailr_queue_depth{{queue="{0}",shard="{1}"}}'.format(queue.name, shard), queue.count)
+                for shard, queues in queues_by_shard.items() for queue in queues)
+    }
+
+def serve(port, render_metrics):
+    """
+        Serves metrics over HTTP on the given port from a background thread. Used by the worker,
+        which doesn't have a web server of its own.
+
+        Args:
+            port (int) - Port to listen on
+            render_metrics (function) - Called without arguments for every request. Returns the text to serve
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            content = render_metrics()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def _get_series_sort_key(series_value):
+    # Keeps the buckets of a histogram in increasing order
+    series, bucket = series_value[0], None
+    if ',le="' in series or '{le="' in series:
+        series, bucket = series.rsplit('le="', 1)
+        bucket = float(bucket.split('"', 1)[0].replace('+Inf', 'inf'))
+    return series, bucket
+
+def _format_value(value):
+    value = float(value)
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
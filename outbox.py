@@ -0,0 +1,347 @@
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.utils import utcnow
+import errno
+import fcntl
+import json
+import logging
+import os
+import redis
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# When Redis can't be reached (or doesn't answer in time), requests to /messages are written to a
+# local append-only log instead of being enqueued, & still accepted with a 202. A background thread
+# in each web process moves them to their queues in bulk once Redis is back. Set MAILR_OUTBOX=0 to
+# fail those requests instead, e.g. when the web processes have no persistent disk.
+ENABLED = os.getenv('MAILR_OUTBOX', '1') == '1'
+# A relative MAILR_OUTBOX_DIR is taken from the directory of this module, so that every process uses the
+# same log wherever it's started from
+OUTBOX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv('MAILR_OUTBOX_DIR', 'outbox'))
+
+# The log is split into segment files of about this many bytes. A process writes to one segment at a
+# time. Segments are drained whole, oldest first, & deleted once all their requests are enqueued.
+SEGMENT_BYTES = int(os.getenv('MAILR_OUTBOX_SEGMENT_BYTES', 4 * 1024 * 1024))
+
+# Requests are only accepted once they're on disk (fsync). Concurrent requests share an fsync.
+# Under gevent, the fsync runs in gevent's thread pool so that it only blocks the requests waiting for it.
+# Setting MAILR_OUTBOX_FSYNC=0 trades that guarantee for lower latency.
+FSYNC = os.getenv('MAILR_OUTBOX_FSYNC', '1') == '1'
+
+# How often (in seconds) the drainer checks whether Redis is back, & how many requests it enqueues per round trip
+DRAIN_INTERVAL = 1
+DRAIN_BATCH = 500
+
+# Segment being written (locked by the process writing it), segment ready to be drained & how far
+# the draining of a segment got
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.log'
+OFFSET_SUFFIX = '.offset'
+
+class SegmentLog(object):
+    """
+        The outbox of one process. Records are appended as JSON lines to the current segment.
+    """
+
+    def __init__(self, directory=OUTBOX_DIR, segment_bytes=SEGMENT_BYTES, fsync=FSYNC):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+
+        self._lock = threading.Lock() # Held while writing to or switching the segment
+        self._sync_lock = threading.Lock() # Held during an fsync
+        self._file = None
+        self._size = 0
+        self._written = 0 # Records appended so far
+        self._synced = 0 # Records known to be on disk
+
+    def append(self, record):
+        """
+            Appends a record (dict) to the log. Returns once it's on disk, when FSYNC is set.
+        """
+        line = json.dumps(record) + '\n'
+
+        with self._lock:
+            if self._file is None or self._size >= self.segment_bytes:
+                self._seal()
+                self._open()
+            # A single write of a whole line, so that a crash can only leave an incomplete last line
+            os.write(self._file.fileno(), line)
+            self._size += len(line)
+            self._written += 1
+            sequence = self._written
+
+        if self.fsync:
+            self._sync(sequence)
+
+    def seal(self):
+        """
+            Closes the current segment, so that it can be drained. The next append starts a new one.
+        """
+        with self._lock:
+            self._seal()
+
+    def _sync(self, sequence):
+        # Group commit: whoever gets the lock syncs everything written so far, which usually covers
+        # the records of the callers waiting behind it. They then return without an fsync of their own.
+        with self._sync_lock:
+            if self._synced >= sequence:
+                return
+
+            with self._lock:
+                if self._file is None:
+                    return # Sealed, which syncs it
+                written, fd = self._written, self._file.fileno()
+            try:
+                _fsync(fd)
+            except OSError:
+                # The segment was sealed (& synced) meanwhile
+                if self._synced < sequence:
+                    raise
+            self._synced = max(self._synced, written)
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass # Created by another process in the meantime
+
+        name = '{0:020d}-{1}'.format(int(time.time() * 1000000), os.getpid())
+        self._file = open(os.path.join(self.directory, name + OPEN_SUFFIX), 'a')
+        # Held until the segment is sealed. A segment that is open but not locked was left behind
+        # by a process that died. See drain()
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._size = 0
+
+    def _seal(self):
+        if self._file is None:
+            return
+
+        if self.fsync:
+            _fsync(self._file.fileno())
+            self._synced = self._written
+        path = self._file.name
+        os.rename(path, path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        self._file.close()
+        self._file = None
+
+def _fsync(fd):
+    # With the gevent workers of the web app (see gunicorn_config.py) a plain fsync would block the whole
+    # process, every other request included, & no other request could append its record meanwhile. In a
+    # thread of gevent's pool, only the greenlet syncing waits. The records appended by the others
+    # meanwhile then share the next fsync (see SegmentLog._sync()).
+    if _is_gevent_patched():
+        import gevent
+        gevent.get_hub().threadpool.apply(os.fsync, (fd,))
+    else:
+        os.fsync(fd)
+
+def _is_gevent_patched():
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    return gevent_monkey is not None and 'thread' in gevent_monkey.saved
+
+log = SegmentLog()
+
+# Whether Redis is considered down. While it is, requests go straight to the outbox without trying
+# Redis first & waiting for it to time out. It's considered up again once the drainer reaches it.
+_redis_down = [False]
+
+POOL_EXHAUSTED_MESSAGE = 'No connection available.'
+
+def is_redis_down():
+    return _redis_down[0]
+
+def is_unreachable(error):
+    """
+        Returns True if a Redis error means the node can't be reached, i.e. connecting to it or talking to
+        it failed or timed out. Running out of pooled connections under load doesn't count: the node is
+        fine & the request should be answered with a 503 instead. Admission control & the suppression
+        list (see mailr.send_message) are skipped while Redis is down, so that's only for real outages.
+
+        Args:
+            error (redis.exceptions.RedisError) - Error raised by a call to Redis
+    """
+    if isinstance(error, redis.exceptions.TimeoutError):
+        return True
+    # Raised by redis.BlockingConnectionPool after waiting for a free connection in vain
+    return isinstance(error, redis.exceptions.ConnectionError) and str(error) != POOL_EXHAUSTED_MESSAGE
+
+def mark_redis_down():
+    if not _redis_down[0]:
+        logger.warning("Redis is unreachable. Requests will be written to the outbox in %s", log.directory)
+    _redis_down[0] = True
+
+def append(queue_name, func, kwargs, result_ttl=None, job_id=None, shard=0):
+    """
+        Writes a request to the outbox, to be enqueued once Redis is reachable again
+
+        Args:
+            queue_name (str) - Name of the RQ queue to enqueue the job to
+            func (str) - Function the job runs, as module.function
+            kwargs (dict) - Keyword arguments of the job
+            result_ttl (int) - Optional; result_ttl of the job
+            job_id (str) - Optional; ID of the job. A random one by default
+            shard (int) - Optional; shard (see shards.py) the job is enqueued on
+
+        Returns:
+            str - ID of the job that will be enqueued. It can be returned to the user right away.
+    """
+    job_id = job_id or str(uuid.uuid4())
+    log.append({'id' : job_id, 'shard' : shard, 'queue' : queue_name, 'func' : func, 'kwargs' : kwargs, 'result_ttl' : result_ttl})
+    return job_id
+
+def drain(connections, directory=OUTBOX_DIR):
+    """
+        Enqueues the requests of every sealed segment in the outbox directory, including the segments
+        of other & dead processes, & deletes the segments. Segments being drained by another process are skipped.
+
+        Requests are enqueued at least once. If the process dies while draining a segment, up to
+        DRAIN_BATCH of its requests may be enqueued again by the next drain.
+
+        Args:
+            connections (list) - Redis connection of each shard, in the order of shards.REDIS_URLS
+
+        Returns:
+            bool - Whether there's nothing left to drain
+    """
+    if not os.path.isdir(directory):
+        return True
+
+    drained_all = True
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith((OPEN_SUFFIX, SEALED_SUFFIX)):
+            continue
+
+        path = os.path.join(directory, name)
+        segment = _lock_segment(path)
+        if segment is None:
+            drained_all = False # Still being written to, or being drained by another process
+            continue
+
+        try:
+            if name.endswith(OPEN_SUFFIX):
+                # Left behind by a process that died
+                sealed_path = path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX
+                os.rename(path, sealed_path)
+                path = sealed_path
+            _drain_segment(connections, path, segment)
+        finally:
+            segment.close()
+
+    return drained_all
+
+def start_drainer(connections):
+    """
+        Starts a background thread that drains the outbox whenever Redis is reachable. Called in every web process.
+
+        Args:
+            connections (list) - Redis connection of each shard, as for drain()
+    """
+    thread = threading.Thread(target=_drain_forever, args=(connections,))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _drain_forever(connections):
+    while True:
+        time.sleep(DRAIN_INTERVAL)
+        try:
+            if not _redis_down[0] and not _has_segments(log.directory):
+                continue
+
+            for connection in connections:
+                connection.ping()
+            log.seal()
+            if drain(connections, log.directory) and _redis_down[0]:
+                logger.warning("Redis is reachable again & the outbox was drained")
+                _redis_down[0] = False
+        except Exception:
+            # Redis is still down, or draining failed halfway & will be tried again
+            logger.debug("Couldn't drain the outbox", exc_info=True)
+
+def _has_segments(directory):
+    try:
+        return any(name.endswith((OPEN_SUFFIX, SEALED_SUFFIX)) for name in os.listdir(directory))
+    except OSError:
+        return False
+
+def _lock_segment(path):
+    # Returns the segment opened & locked, or None if another process holds the lock or the segment is gone
+    try:
+        segment = open(path, 'r')
+    except IOError:
+        return None
+
+    try:
+        fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        segment.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+
+    if not os.path.exists(path):
+        # Drained & deleted by another process between the open & the lock
+        segment.close()
+        return None
+
+    return segment
+
+def _drain_segment(connections, path, segment):
+    offset_path = path + OFFSET_SUFFIX
+    offset = 0
+    if os.path.exists(offset_path):
+        with open(offset_path) as offset_file:
+            offset = int(offset_file.read() or 0)
+    segment.seek(offset)
+
+    records = []
+    for line in segment:
+        offset += len(line)
+        if not line.endswith('\n'):
+            logger.warning("Skipping incomplete record at the end of %s", path)
+            continue
+        records.append(json.loads(line))
+
+        if len(records) >= DRAIN_BATCH:
+            _enqueue(connections, records)
+            _save_offset(offset_path, offset)
+            records = []
+
+    _enqueue(connections, records)
+    os.remove(path)
+    if os.path.exists(offset_path):
+        os.remove(offset_path)
+
+def _enqueue(connections, records):
+    # What Queue.enqueue_call() does, for many jobs in one round trip per shard & with the IDs already
+    # returned to the users. Records written before sharding go to the primary shard.
+    records_by_shard = {}
+    for record in records:
+        records_by_shard.setdefault(record.get('shard', 0), []).append(record)
+
+    for shard, shard_records in sorted(records_by_shard.items()):
+        _enqueue_on(connections[shard], shard_records)
+
+def _enqueue_on(connection, records):
+    pipeline = connection.pipeline()
+    for record in records:
+        queue = Queue(record['queue'], connection=connection)
+        job = Job.create(record['func'], kwargs=record['kwargs'], connection=connection,
+            result_ttl=record['result_ttl'], status=JobStatus.QUEUED, id=record['id'],
+            origin=queue.name, timeout=Queue.DEFAULT_TIMEOUT)
+        job.enqueued_at = utcnow()
+        job.save(pipeline=pipeline)
+        pipeline.sadd(Queue.redis_queues_keys, queue.key)
+        queue.push_job_id(job.id, pipeline=pipeline)
+    pipeline.execute()
+
+def _save_offset(offset_path, offset):
+    with open(offset_path + '.tmp', 'w') as offset_file:
+        offset_file.write(str(offset))
+    os.rename(offset_path + '.tmp', offset_path)
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Profiling is off until a window is started, either when the worker starts (MAILR_PROFILE set to the
+# length of the window in seconds) or at any time by sending SIGUSR2 to the worker process.
+# During the window, the stack of each job is sampled at a fixed interval. Jobs outside of it run
+# without any profiling overhead.
+# A relative MAILR_PROFILE_DIR is taken from the directory of this module, as for the outbox (see outbox.py)
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv('MAILR_PROFILE_DIR', 'profiles'))
+WINDOW = int(os.getenv('MAILR_PROFILE_WINDOW', 60))
+INTERVAL = float(os.getenv('MAILR_PROFILE_INTERVAL', 0.005))
+
+# Per function stats are reported for this function & everything it calls
+STATS_ROOT = 'mailers.send_message'
+
+# Jobs may still be running when the window ends. Their samples are merged if they finish within this many seconds.
+MERGE_DELAY = 5
+
+# Window currently open, as [id, end time]. Work horses are forked from the worker, so they see
+# the window opened in it. The id includes the pid of the worker, as the work processes of a worker
+# with several shards (see worker.py) all open a window at once & each merges its own.
+_window = [None, 0]
+
+class Sampler(object):
+    """
+        Samples the stack of the thread that created it from a background thread, until stopped
+    """
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.samples = {}
+        self._thread_id = threading.current_thread().ident
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+            Stops sampling & returns the samples, as a dict of collapsed stack to number of samples
+        """
+        self._stopped.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_get_function_name(frame))
+                frame = frame.f_back
+            collapsed = ';'.join(reversed(stack))
+            self.samples[collapsed] = self.samples.get(collapsed, 0) + 1
+
+def _get_function_name(frame):
+    # module.function, or module.Class.method for methods, so that e.g. Mailer.send_message()
+    # isn't mixed up with mailers.send_message()
+    code = frame.f_code
+    module = frame.f_globals.get('__name__')
+    if code.co_argcount and code.co_varnames[0] == 'self':
+        instance = frame.f_locals.get('self')
+        if instance is not None:
+            return '{0}.{1}.{2}'.format(module, instance.__class__.__name__, code.co_name)
+    return '{0}.{1}'.format(module, code.co_name)
+
+def start_window(seconds=WINDOW):
+    """
+        Starts profiling the jobs run in the next given number of seconds. The results are written to
+        PROFILE_DIR once the window is over. See merge_window().
+    """
+    window_id = '{0}.{1}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    _window[0], _window[1] = window_id, time.time() + seconds
+    logger.info("Profiling jobs for %s seconds", seconds)
+
+    timer = threading.Timer(seconds + MERGE_DELAY, merge_window, (window_id,))
+    timer.daemon = True
+    timer.start()
+
+def install_signal_handler():
+    """
+        Makes SIGUSR2 start a profiling window
+    """
+    signal.signal(signal.SIGUSR2, lambda signum, frame: start_window())
+    # Restart system calls interrupted by the signal, e.g. the worker waiting on Redis for jobs
+    signal.siginterrupt(signal.SIGUSR2, False)
+
+def start_job():
+    """
+        Called in the work horse before performing a job
+
+        Returns:
+            Sampler - Sampling the job if a profiling window is open. Pass it to finish_job()
+
+            None - If jobs aren't being profiled
+    """
+    if time.time() >= _window[1]:
+        return None
+    return Sampler()
+
+def finish_job(sampler):
+    """
+        Stops sampling a job & saves its samples for merge_window()
+    """
+    samples = sampler.stop()
+
+    window_dir = os.path.join(PROFILE_DIR, _window[0])
+    if not os.path.isdir(window_dir):
+        try:
+            os.makedirs(window_dir)
+        except OSError:
+            pass # Created by another worker in the meantime
+
+    # One file per job, so no two processes ever write to the same file
+    path = os.path.join(window_dir, 'samples.{0}.{1}'.format(os.getpid(), time.time()))
+    try:
+        with open(path, 'w') as samples_file:
+            samples_file.write(collapse(samples))
+    except (IOError, OSError):
+        logger.exception("Couldn't save profile samples")
+
+def merge_window(window_id):
+    """
+        Merges the samples of all the jobs profiled during a window into
+            -- PROFILE_DIR/<window_id>.collapsed, in the collapsed stack format used by flamegraph.pl,
+               speedscope and most flame graph tools
+            -- PROFILE_DIR/<window_id>.stats.json, per function stats for STATS_ROOT & its callees
+    """
+    window_dir = os.path.join(PROFILE_DIR, window_id)
+    samples = {}
+    if os.path.isdir(window_dir):
+        for name in os.listdir(window_dir):
+            with open(os.path.join(window_dir, name)) as samples_file:
+                for line in samples_file:
+                    stack, count = line.rsplit(' ', 1)
+                    samples[stack] = samples.get(stack, 0) + int(count)
+            os.remove(os.path.join(window_dir, name))
+        os.rmdir(window_dir)
+
+    if not samples:
+        logger.info("No jobs were profiled during window %s", window_id)
+        return
+
+    with open(os.path.join(PROFILE_DIR, window_id + '.collapsed'), 'w') as collapsed_file:
+        collapsed_file.write(collapse(samples))
+
+    with open(os.path.join(PROFILE_DIR, window_id + '.stats.json'), 'w') as stats_file:
+        json.dump(get_stats(samples), stats_file, indent=2)
+
+    logger.info("Profile of window %s written to %s", window_id, PROFILE_DIR)
+
+def collapse(samples):
+    """
+        Returns samples in the collapsed stack format, one 'frame;frame;frame count' line per stack
+    """
+    return ''.join('{0} {1}\n'.format(stack, count) for stack, count in sorted(samples.items()))
+
+def get_stats(samples, root=STATS_ROOT):
+    """
+        Returns per function stats for root & the functions it calls
+
+        Args:
+            samples (dict) - Collapsed stack to number of samples
+            root (str) - Function to report on, as module.function
+
+        Returns:
+            list - One dict per function, with the number & percentage of samples in which it was running
+                   ('self') or on the stack ('total'), sorted by total. Percentages are of the samples taken in root.
+    """
+    totals = {}
+    selfs = {}
+    root_samples = 0
+
+    for stack, count in samples.items():
+        frames = stack.split(';')
+        if root not in frames:
+            continue
+        frames = frames[frames.index(root):]
+        root_samples += count
+
+        for function in set(frames):
+            totals[function] = totals.get(function, 0) + count
+        selfs[frames[-1]] = selfs.get(frames[-1], 0) + count
+
+    stats = []
+    for function, total in totals.items():
+        stats.append({
+            'function' : function,
+            'total' : total,
+            'total_percent' : round(100.0 * total / root_samples, 2),
+            'self' : selfs.get(function, 0),
+            'self_percent' : round(100.0 * selfs.get(function, 0) / root_samples, 2)
+        })
+
+    return sorted(stats, key=lambda function_stats: (-function_stats['total'], function_stats['function']))
@@ -0,0 +1,86 @@
+import binascii
+import collections
+import os
+import time
+
+# IDs returned by /messages for each request. They're made up of, in this order:
+#   -- the time the request was made, in milliseconds since the epoch (10 characters)
+#   -- the shard the request is kept on (2 characters, see shards.py)
+#   -- the retention tier of its status record (1 character, see statusstore.py)
+#   -- a random part (13 characters, 65 bits)
+# each written with Crockford's base32 alphabet, in lowercase. IDs are 26 characters long & sort in the
+# order requests were made, so the requests made in a time range can be found with a range scan.
+ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+TIME_LENGTH = 10
+SHARD_LENGTH = 2
+RETENTION_LENGTH = 1
+RANDOM_LENGTH = 13
+LENGTH = TIME_LENGTH + SHARD_LENGTH + RETENTION_LENGTH + RANDOM_LENGTH
+
+# Retention tiers by their position in the ID. New tiers must be added at the end.
+RETENTION_TIERS = ('short', 'default', 'long')
+
+# What an ID says about its request. retention is None for tiers unknown to this version.
+RequestId = collections.namedtuple('RequestId', ['created_at', 'shard', 'retention'])
+
+_DIGITS = dict((character, value) for value, character in enumerate(ALPHABET))
+
+def new(shard=0, retention=None, now=None):
+    """
+        Returns a new request ID
+
+        Args:
+            shard (int) - Optional; shard the request is kept on
+            retention (str) - Optional; retention tier of the request. 'default' when None or unknown. Requests
+                              are given IDs by shards.new_request_id(), which passes the configured default tier
+            now (float) - Optional; time the request was made. The current time by default
+
+        Returns:
+            str - The ID
+    """
+    if now is None:
+        now = time.time()
+    retention_code = RETENTION_TIERS.index(retention) if retention in RETENTION_TIERS else RETENTION_TIERS.index('default')
+    random_part = int(binascii.hexlify(os.urandom(9)), 16) >> 7
+
+    return (_encode(int(now * 1000), TIME_LENGTH) + _encode(shard, SHARD_LENGTH) +
+        _encode(retention_code, RETENTION_LENGTH) + _encode(random_part, RANDOM_LENGTH))
+
+def parse(request_id):
+    """
+        Parses a request ID
+
+        Returns:
+            RequestId - The time the request was made (in seconds since the epoch), its shard & its retention tier
+
+            None - If the ID wasn't made by new(), e.g. it's from before these IDs were introduced
+    """
+    if len(request_id) != LENGTH or any(character not in _DIGITS for character in request_id):
+        return None
+
+    shard_start = TIME_LENGTH
+    retention_start = shard_start + SHARD_LENGTH
+    retention_code = _decode(request_id[retention_start:retention_start + RETENTION_LENGTH])
+    return RequestId(_decode(request_id[:shard_start]) / 1000.0,
+        _decode(request_id[shard_start:retention_start]),
+        RETENTION_TIERS[retention_code] if retention_code < len(RETENTION_TIERS) else None)
+
+def get_time_prefix(timestamp):
+    """
+        Returns the prefix shared by the IDs of the requests made in the same millisecond as timestamp.
+        IDs of requests made before timestamp sort before it, IDs of later requests after it.
+    """
+    return _encode(int(timestamp * 1000), TIME_LENGTH)
+
+def _encode(value, length):
+    characters = []
+    for i in range(length):
+        characters.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(characters))
+
+def _decode(text):
+    value = 0
+    for character in text:
+        value = (value << 5) | _DIGITS[character]
+    return value
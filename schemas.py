@@ -0,0 +1,116 @@
+import json
+import os
+
+# JSON schemas for the input of each resource, in static/<name>_input_schema.json. They're only loaded
+# & turned into validators when first used (see get_validator()), so processes start without them &
+# without importing jsonschema.
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+NAMES = ('send', 'info', 'suppression', 'analytics')
+
+# All schemas, parsed & already checked against the meta-schema, are cached in a single file along
+# with the modification time & size of each schema file they were read from. The cache is rebuilt
+# whenever a schema file changes. It's written on first use if missing, or ahead of time by running:
+#
+#   python schemas.py
+#
+# It's kept next to this module by default rather than in static/, which Flask serves to anyone.
+CACHE_PATH = os.getenv('MAILR_SCHEMA_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas.cache.json'))
+
+# Schemas by name, once loaded. See load()
+_schemas = {}
+
+# Validators by schema name, once built. See get_validator()
+_validators = {}
+
+def get_validator(name):
+    """
+        Returns the validator for the input schema with the given name, building it on first use
+
+        Args:
+            name (str) - One of NAMES
+
+        Returns:
+            jsonschema.Draft4Validator - The validator
+    """
+    validator = _validators.get(name)
+    if validator is None:
+        # Building a validator is cheap once the schema has been checked. jsonschema.validate() would
+        # check the schema against the meta-schema again & create a new validator on every call.
+        from jsonschema import Draft4Validator
+        validator = _validators[name] = Draft4Validator(load()[name])
+    return validator
+
+def best_match(errors):
+    """
+        Returns the most relevant of the errors reported by a validator. See jsonschema.exceptions.best_match()
+    """
+    from jsonschema.exceptions import best_match
+    return best_match(errors)
+
+def load():
+    """
+        Returns all schemas by name, from the cache when it's up to date & from the schema files otherwise
+
+        Throws:
+            jsonschema.exceptions.SchemaError when a schema file holds an invalid schema
+    """
+    if not _schemas:
+        sources = _get_sources()
+        schemas = _read_cache(sources)
+        if schemas is None:
+            schemas = build(sources)
+        _schemas.update(schemas)
+    return _schemas
+
+def build(sources=None):
+    """
+        Reads & checks the schema files & writes them to the cache. A cache that can't be written
+        (e.g. on a read only file system) is left out.
+
+        Returns:
+            dict - The schemas by name
+    """
+    from jsonschema import Draft4Validator
+
+    if sources is None:
+        sources = _get_sources()
+
+    schemas = {}
+    for name in NAMES:
+        with open(_get_path(name), 'r') as schema_file:
+            schemas[name] = json.load(schema_file)
+        Draft4Validator.check_schema(schemas[name])
+
+    temp_path = '{0}.{1}.tmp'.format(CACHE_PATH, os.getpid())
+    try:
+        with open(temp_path, 'w') as cache_file:
+            json.dump({'sources' : sources, 'schemas' : schemas}, cache_file)
+        os.rename(temp_path, CACHE_PATH) # Atomic, so other processes never read half a cache
+    except (IOError, OSError):
+        pass
+
+    return schemas
+
+def _read_cache(sources):
+    try:
+        with open(CACHE_PATH, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if cache.get('sources') != sources:
+        return None
+    return cache['schemas']
+
+def _get_sources():
+    sources = {}
+    for name in NAMES:
+        stat = os.stat(_get_path(name))
+        sources[name] = [stat.st_mtime, stat.st_size]
+    return sources
+
+def _get_path(name):
+    return os.path.join(SCHEMA_DIR, '{0}_input_schema.json'.format(name))
+
+if __name__ == '__main__':
+    build()
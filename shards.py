@@ -0,0 +1,49 @@
+import os
+import random
+import requestids
+import statusstore
+
+# Requests can be spread over several Redis nodes (shards), listed in MAILR_REDIS_URLS separated by
+# commas. Each request is enqueued on a shard picked at random & everything kept for it (its jobs,
+# status records, cached statuses) stays on that shard. The shard is part of the ID returned for the
+# request, so /status goes straight to it. Workers take jobs from the shards they're assigned (see worker.py).
+#
+# Shards are numbered by their position in the list: nodes must be added at the end & not removed
+# while they still hold requests. Data shared by all requests (the suppression list, domain results
+# & metrics) is kept on the first one, the primary.
+REDIS_URLS = [url.strip() for url in
+    os.getenv('MAILR_REDIS_URLS', os.getenv('REDISTOGO_URL', 'redis://localhost:6379')).split(',') if url.strip()]
+PRIMARY = 0
+
+def new_request_id(retention=None):
+    """
+        Returns a new request ID & the shard the request goes to, as a tuple of form (request_id, shard).
+        The shard is picked at random & kept in the ID, so it's never looked up again. See requestids.py
+
+        Args:
+            retention (str) - Optional; retention tier of the request. The configured default tier
+                              (statusstore.DEFAULT_RETENTION_TIER) when None or unknown
+    """
+    # The tier in the ID must be the one the status record is kept for, or statusstore.is_expired() is wrong
+    if retention not in statusstore.RETENTION_TIERS:
+        retention = statusstore.DEFAULT_RETENTION_TIER
+
+    shard = random.randrange(len(REDIS_URLS))
+    return requestids.new(shard, retention), shard
+
+def get_shard(request_id):
+    """
+        Returns the shard the request with the given ID is kept on
+
+        Returns:
+            int - Position of the shard in REDIS_URLS. Requests made before sharding are on the primary.
+
+            None - If no request can have this ID
+    """
+    parsed = requestids.parse(request_id)
+    if parsed is None:
+        return PRIMARY # Plain RQ job IDs, from before sharding
+
+    if parsed.shard >= len(REDIS_URLS):
+        return None
+    return parsed.shard
@@ -0,0 +1,87 @@
+import metrics
+import os
+import statusstore
+import suppression
+import time
+
+# Statuses after which a message can't change state anymore. These are cached until the status
+# record of the request expires, except failures the provider still retries (see Mailer.get_message_status()).
+TERMINAL_STATUSES = ('sent', 'failed')
+
+# How long, in seconds, other statuses ('accepted', 'processing') are cached before the provider is polled again
+PENDING_STATUS_TTL = int(os.getenv('MAILR_PENDING_STATUS_TTL', 30))
+
+# Only one /status call at a time polls the provider for a given message. The others wait for it to
+# cache the result. The lock outlives the provider timeout in Mailer.get_message_status() so that it
+# can't expire while the provider is still being polled.
+POLL_LOCK_TTL_MS = 5000
+WAIT_TIMEOUT = 3
+WAIT_INTERVAL = 0.05
+
+def get_message_status(connection, request_id, mailer, message_info, suppression_connection=None):
+    """
+        Returns the status of a message, as Mailer.get_message_status() does, from the cache if
+        possible. Otherwise the provider is polled (by a single caller if many ask for the same
+        message concurrently) & the result is cached.
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection to cache statuses with
+            request_id (str) - ID of the request the message was sent as part of
+            mailer (Mailer) - The Mailer that sent the message
+            message_info (dict) - message_info of the message, as returned by statusstore.get_message_info()
+            suppression_connection (redis.StrictRedis) - Optional; Redis connection the suppression list is stored with, if not connection
+
+        Returns:
+            dict - With one field, 'status'. See Mailer.get_message_status()
+
+            None - When the status couldn't be obtained from the provider
+    """
+    key = _get_status_key(request_id, message_info.get('email_address'))
+
+    status = connection.get(key)
+    if status is not None:
+        return {'status' : status}
+
+    lock_key = key + ':lock'
+    if connection.set(lock_key, 1, px=POLL_LOCK_TTL_MS, nx=True):
+        try:
+            mailer_name = mailer.__class__.__name__
+            with metrics.STATUS_POLL_LATENCY.time(mailer_name):
+                status_info = mailer.get_message_status(message_info)
+            metrics.STATUS_POLLS.inc(mailer_name, 'unavailable' if status_info is None else 'ok')
+
+            if status_info is not None and status_info.get('status') is not None:
+                _cache_status(connection, key, request_id, status_info['status'], status_info.pop('temporary', False))
+
+                # Don't send to addresses that hard-bounced or complained again. This only runs once
+                # per message, as the status is cached for good from now on.
+                if(status_info.pop('suppress', False)):
+                    suppression.suppress(suppression_connection or connection, [message_info.get('email_address')])
+            return status_info
+        finally:
+            connection.delete(lock_key)
+
+    # Someone else is polling the provider for this message. Wait for their result.
+    deadline = time.time() + WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+
+        status = connection.get(key)
+        if status is not None:
+            return {'status' : status}
+
+        if not connection.exists(lock_key):
+            # They couldn't get it either
+            break
+
+    return None
+
+def _cache_status(connection, key, request_id, status, temporary=False):
+    ttl = PENDING_STATUS_TTL
+    if status in TERMINAL_STATUSES and not temporary:
+        ttl = statusstore.get_record_ttl(connection, request_id) or ttl
+
+    connection.set(key, status, ex=ttl)
+
+def _get_status_key(request_id, email_address):
+    return 'mailr:status:{0}:{1}'.format(request_id, email_address)
@@ -0,0 +1,248 @@
+import json
+import os
+import requestids
+import time
+
+# How long the status record of a request is kept around, in seconds, for each retention tier.
+# The tier can be chosen per request with the optional 'retention' field of /messages.
+RETENTION_TIERS = {
+    'short' : int(os.getenv('MAILR_RETENTION_SHORT', 3600)),
+    'default' : int(os.getenv('MAILR_RETENTION_DEFAULT', 86400)),
+    'long' : int(os.getenv('MAILR_RETENTION_LONG', 604800))
+}
+DEFAULT_RETENTION_TIER = os.getenv('MAILR_RETENTION_TIER', 'default')
+
+# The RQ job hash holds the whole body & all recipient lists in its kwargs. Once the worker
+# has written the status record for a request we never read the job again, so its result
+# isn't kept at all (RQ deletes the job hash as soon as the job finishes).
+JOB_RESULT_TTL = 0
+
+# Requests are expected to be sent within this many seconds of being made, including any time spent
+# waiting in the queues or in the outbox. Past that plus its retention, a request's status record
+# has expired & /status can tell from the ID alone (see is_expired()).
+MAX_SEND_DELAY = int(os.getenv('MAILR_MAX_SEND_DELAY', 86400))
+
+# Sorted set of the IDs of the requests that have status records, all with the same score. As IDs
+# sort by time (see requestids.py), the requests made in a time range are a range of the set. See get_request_ids()
+REQUESTS_KEY = 'mailr:requests'
+
+# Field of the status record holding the outcome of hedging the send (see save_hedge_outcome())
+HEDGE_FIELD = 'hedge'
+
+def get_retention_ttl(retention=None):
+    """
+        Returns the number of seconds the status record should be kept for the given retention tier
+
+        Args:
+            retention (str) - Optional; name of the retention tier. The default tier is used when None or unknown
+
+        Returns:
+            int - TTL in seconds
+    """
+    return RETENTION_TIERS.get(retention, RETENTION_TIERS[DEFAULT_RETENTION_TIER])
+
+def save_status_record(connection, request_id, handled_by, messages_info, retention=None):
+    """
+        Stores the minimal record needed to answer /status calls for a request, i.e. which Mailer
+        handled it & the provider specific ID for each recepient. Nothing else from the request
+        (body, subject, names) is kept.
+
+        The record is a Redis hash keyed by recepient email address, so that looking up a single
+        recepient costs the same however many recepients the request had. Each value names the Mailer
+        along with the provider specific ID, so recepients of the same request needn't all be sent
+        through the same Mailer.
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection to store the record with
+            request_id (str) - ID of the request returned to the user by /messages
+            handled_by (str) - Class name of the Mailer that sent the message
+            messages_info (list) - message_info dicts as returned by Mailer.send_message()
+            retention (str) - Optional; retention tier deciding how long the record is kept
+    """
+    if not messages_info:
+        return
+
+    key = _get_record_key(request_id)
+    record = dict(
+        (message_info['email_address'], '{0}:{1}'.format(handled_by, message_info['id']))
+        for message_info in messages_info
+    )
+
+    pipeline = connection.pipeline()
+    pipeline.hmset(key, record)
+    pipeline.expire(key, get_retention_ttl(retention))
+    if requestids.parse(request_id) is not None:
+        pipeline.zadd(REQUESTS_KEY, **{request_id : 0})
+        # Drop the IDs whose records have expired for sure, so that the index doesn't grow forever
+        pipeline.zremrangebylex(REQUESTS_KEY, '-', '(' + requestids.get_time_prefix(time.time() - _get_max_record_age()))
+    pipeline.execute()
+
+def get_message_info(connection, request_id, email_address):
+    """
+        Returns the message_info stored for one recepient of a request
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the record was stored with
+            request_id (str) - ID of the request returned to the user by /messages
+            email_address (str) - Email address of the recepient, without the name
+
+        Returns:
+            tuple - Of form (handled_by, message_info) where handled_by is the class name of the Mailer
+                    that sent the message & message_info is the dict to pass to its get_message_status()
+
+            None - If nothing was sent to the email address as part of the request
+    """
+    value = connection.hget(_get_record_key(request_id), email_address)
+    if value is None:
+        return None
+
+    handled_by, message_id = value.split(':', 1)
+    return handled_by, {'email_address' : email_address, 'id' : message_id}
+
+def save_hedge_outcome(connection, request_id, outcome, retention=None):
+    """
+        Adds the outcome of hedging the send of a request (see mailers._send_hedged()) to its status
+        record, under HEDGE_FIELD. Email addresses always have an '@', so the field can't be taken by one.
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the record was stored with
+            request_id (str) - ID of the request returned to the user by /messages
+            outcome (dict) - Whether the message was hedged, which Mailer sent it & whether it was sent twice
+            retention (str) - Optional; retention tier deciding how long the record is kept
+    """
+    key = _get_record_key(request_id)
+
+    pipeline = connection.pipeline()
+    pipeline.hset(key, HEDGE_FIELD, json.dumps(outcome))
+    pipeline.expire(key, get_retention_ttl(retention))
+    pipeline.execute()
+
+def get_hedge_outcome(connection, request_id):
+    """
+        Returns the outcome of hedging the send of a request, as saved by save_hedge_outcome()
+
+        Returns:
+            dict - The outcome
+
+            None - If the request wasn't hedged (or wasn't eligible) or its record has expired
+    """
+    outcome = connection.hget(_get_record_key(request_id), HEDGE_FIELD)
+    if outcome is None:
+        return None
+
+    return json.loads(outcome)
+
+def request_exists(connection, request_id):
+    """
+        Returns True if there is a status record for the request, i.e. it has been sent & hasn't expired yet
+    """
+    return bool(connection.exists(_get_record_key(request_id)))
+
+def is_expired(request_id, now=None):
+    """
+        Returns True if the status record of the request with the given ID has expired for sure,
+        judging by the time & retention tier in the ID alone. Doesn't call Redis.
+
+        Args:
+            request_id (str) - ID of the request returned to the user by /messages
+            now (float) - Optional; the current time
+    """
+    parsed = requestids.parse(request_id)
+    if parsed is None:
+        return False # Not known from the ID
+
+    if now is None:
+        now = time.time()
+    retention_ttl = get_retention_ttl(parsed.retention) if parsed.retention is not None else max(RETENTION_TIERS.values())
+    return now - parsed.created_at > MAX_SEND_DELAY + retention_ttl
+
+def get_request_ids(connection, start, end=None, count=None):
+    """
+        Returns the IDs of the requests made in a time range that still have status records, oldest first.
+        Only requests with IDs made by requestids.py are found.
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the records were stored with
+            start (float) - Start of the range, in seconds since the epoch
+            end (float) - Optional; end of the range (excluded). No end by default
+            count (int) - Optional; maximum number of IDs to return
+
+        Returns:
+            list - Request IDs
+    """
+    maximum = '(' + requestids.get_time_prefix(end) if end is not None else '+'
+    return connection.zrangebylex(REQUESTS_KEY, '[' + requestids.get_time_prefix(start), maximum,
+        start=0 if count is not None else None, num=count)
+
+def get_record_ttl(connection, request_id):
+    """
+        Returns the number of seconds left before the status record of a request expires
+
+        Returns:
+            int - Seconds left
+
+            None - If there is no record for the request or it doesn't expire
+    """
+    ttl = connection.ttl(_get_record_key(request_id))
+    if ttl is None or ttl <= 0:
+        return None
+
+    return ttl
+
+def save_chunk_progress(connection, request_id, total, retention=None):
+    """
+        Starts tracking the progress of a request that was split into chunks, each sent by its own job
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection to store the progress with
+            request_id (str) - ID of the request returned to the user by /messages
+            total (int) - Number of chunks the request was split into
+            retention (str) - Optional; retention tier deciding how long the progress is kept
+    """
+    key = _get_chunks_key(request_id)
+
+    pipeline = connection.pipeline()
+    pipeline.hmset(key, {'total' : total, 'sent' : 0, 'failed' : 0})
+    pipeline.expire(key, get_retention_ttl(retention))
+    pipeline.execute()
+
+def record_chunk_result(connection, request_id, sent, retention=None):
+    """
+        Counts one more chunk of a request as done
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the progress is stored with
+            request_id (str) - ID of the request the chunk is part of
+            sent (bool) - Whether the chunk was sent or all Mailers failed to send it
+            retention (str) - Optional; retention tier deciding how long the progress is kept
+    """
+    key = _get_chunks_key(request_id)
+
+    pipeline = connection.pipeline()
+    pipeline.hincrby(key, 'sent' if sent else 'failed', 1)
+    pipeline.expire(key, get_retention_ttl(retention))
+    pipeline.execute()
+
+def get_chunk_progress(connection, request_id):
+    """
+        Returns the progress of a request that was split into chunks
+
+        Returns:
+            dict - With the number of chunks in 'total' & how many of them were 'sent' or 'failed' so far
+
+            None - If the request wasn't split or its progress has expired
+    """
+    progress = connection.hgetall(_get_chunks_key(request_id))
+    if not progress:
+        return None
+
+    return dict((field, int(progress.get(field, 0))) for field in ('total', 'sent', 'failed'))
+
+def _get_max_record_age():
+    return MAX_SEND_DELAY + max(RETENTION_TIERS.values())
+
+def _get_record_key(request_id):
+    return 'mailr:request:{0}'.format(request_id)
+
+def _get_chunks_key(request_id):
+    return 'mailr:request:{0}:chunks'.format(request_id)
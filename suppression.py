@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Addresses messages shouldn't be sent to anymore, because they hard-bounced or complained. The list
+# itself is a Redis set, which is the only source of truth. To avoid a call to Redis for every recepient
+# of every request, each process first checks a Bloom filter it keeps in memory: most addresses aren't
+# suppressed & the filter says so for sure. Only the few it reports as possibly suppressed are
+# confirmed against the set.
+SUPPRESSED_KEY = 'mailr:suppressed'
+
+# The filter is kept in Redis as a bitmap (updated along with the set) & copied to each process
+# every REFRESH_INTERVAL seconds by a background thread (see start_refresher()), so that no request
+# waits for the copy. 2^27 bits (16MB) with 7 hashes give about 1% false positives for 14 million
+# addresses. Run `python suppression.py rebuild` after changing the size.
+BLOOM_KEY = 'mailr:suppressed:bloom'
+BLOOM_BITS = int(os.getenv('MAILR_SUPPRESSION_BLOOM_BITS', 2 ** 27))
+BLOOM_HASHES = 7
+REFRESH_INTERVAL = int(os.getenv('MAILR_SUPPRESSION_REFRESH', 60))
+
+# Copy of the filter in this process. None until it's first copied, meanwhile every address is
+# checked against the set.
+_bloom = [None]
+
+def suppress(connection, email_addresses):
+    """
+        Adds email addresses to the suppression list
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection to store the list with
+            email_addresses (list) - Email addresses, without names
+    """
+    if not email_addresses:
+        return
+
+    pipeline = connection.pipeline()
+    for email_address in email_addresses:
+        email_address = _normalize(email_address)
+        pipeline.sadd(SUPPRESSED_KEY, email_address)
+        for position in _get_bloom_positions(email_address):
+            pipeline.setbit(BLOOM_KEY, position, 1)
+            _set_local_bit(position) # So that this process knows without waiting for the next refresh
+    pipeline.execute()
+
+def get_suppressed(connection, email_addresses):
+    """
+        Returns which of the given email addresses are on the suppression list
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the list is stored with
+            email_addresses (list) - Email addresses, without names
+
+        Returns:
+            set - The suppressed email addresses, as given
+    """
+    bloom = _bloom[0]
+    candidates = [email_address for email_address in email_addresses if bloom is None or
+        all(_test_bit(bloom, position) for position in _get_bloom_positions(_normalize(email_address)))]
+    if not candidates:
+        return set()
+
+    pipeline = connection.pipeline()
+    for email_address in candidates:
+        pipeline.sismember(SUPPRESSED_KEY, _normalize(email_address))
+    return set(email_address for email_address, suppressed in zip(candidates, pipeline.execute()) if suppressed)
+
+def unsuppress(connection, email_addresses):
+    """
+        Removes email addresses from the suppression list, e.g. when one was added by mistake
+
+        Their bits stay set in the Bloom filter, which may hold them for other addresses too. The set
+        is checked for every address the filter matches, so they're sent to again right away. The
+        filter is cleared of them when it's rebuilt (see rebuild_filter()).
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the list is stored with
+            email_addresses (list) - Email addresses, without names
+    """
+    if not email_addresses:
+        return
+
+    connection.srem(SUPPRESSED_KEY, *[_normalize(email_address) for email_address in email_addresses])
+
+def rebuild_filter(connection):
+    """
+        Rebuilds the Bloom filter in Redis from the suppression list, e.g. after changing BLOOM_BITS
+
+        The new filter is built under another key & then renamed over the old one, so the processes
+        copying it never get an empty or half built filter.
+    """
+    temp_key = BLOOM_KEY + ':rebuild'
+    pipeline = connection.pipeline()
+    pipeline.delete(temp_key)
+    if _set_bloom_bits(connection, pipeline, temp_key):
+        pipeline.rename(temp_key, BLOOM_KEY)
+    else:
+        pipeline.delete(BLOOM_KEY) # Nothing is suppressed
+    pipeline.execute()
+
+    # Addresses suppressed while the filter was built only had their bits set in the old one. They're
+    # all on the list by now, so another pass over it sets them in the new one.
+    _set_bloom_bits(connection, pipeline, BLOOM_KEY)
+    pipeline.execute()
+
+def _set_bloom_bits(connection, pipeline, key):
+    # Returns whether any bit was set
+    found = False
+    for email_address in connection.sscan_iter(SUPPRESSED_KEY, count=1000):
+        found = True
+        for position in _get_bloom_positions(email_address):
+            pipeline.setbit(key, position, 1)
+        if len(pipeline) >= 10000:
+            pipeline.execute()
+    return found
+
+def refresh(connection):
+    """
+        Copies the Bloom filter from Redis to this process
+    """
+    _bloom[0] = bytearray(connection.get(BLOOM_KEY) or '')
+
+def start_refresher(connection):
+    """
+        Starts a background thread that copies the Bloom filter every REFRESH_INTERVAL seconds. Called in
+        every web process.
+
+        Args:
+            connection (redis.StrictRedis) - Redis connection the list is stored with
+    """
+    thread = threading.Thread(target=_refresh_forever, args=(connection,))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _refresh_forever(connection):
+    while True:
+        try:
+            refresh(connection)
+        except Exception:
+            # The last copy is kept. Addresses suppressed since are still found by the process that
+            # suppressed them, & by the others on their next refresh.
+            logger.debug("Couldn't copy the suppression filter", exc_info=True)
+        time.sleep(REFRESH_INTERVAL)
+
+def _get_bloom_positions(email_address):
+    # Double hashing: BLOOM_HASHES positions derived from the two halves of one digest
+    first, second = struct.unpack('<QQ', hashlib.md5(email_address).digest())
+    return [(first + i * second) % BLOOM_BITS for i in range(BLOOM_HASHES)]
+
+def _test_bit(bloom, position):
+    # Bits are numbered as Redis' SETBIT does, from the most significant bit of the first byte.
+    # Redis only stores the bitmap up to its last set bit.
+    byte = position >> 3
+    return byte < len(bloom) and bool(bloom[byte] & (0x80 >> (position & 7)))
+
+def _set_local_bit(position):
+    bloom = _bloom[0]
+    if bloom is None:
+        return # Everything is checked against the set until the filter is copied
+    byte = position >> 3
+    if byte >= len(bloom):
+        bloom.extend(bytearray(byte + 1 - len(bloom)))
+    bloom[byte] |= 0x80 >> (position & 7)
+
+def _normalize(email_address):
+    return email_address.lower().encode('utf-8')
+
+if __name__ == '__main__':
+    import redis
+    import shards
+    import sys
+
+    if sys.argv[1:] != ['rebuild']:
+        sys.exit("Usage: python suppression.py rebuild")
+
+    rebuild_filter(redis.from_url(shards.REDIS_URLS[shards.PRIMARY]))
@@ -1,13 +1,35 @@
 from mailers import MailGunMailer, MandrilMailer, MailerUtils
 from mailrexceptions import InvalidInputException, MailNotSentException
 from mailr import validate_send_message_input
-from mock import patch, Mock
+from mock import patch, MagicMock, Mock
 from requests.exceptions import ConnectTimeout
+import addresses
+import admission
+import analytics
+import autoscale
+import domains
+import hedging
 import json
 import mailr
+import metrics
+import os
+import outbox
+import profiler
+import redis
+import requestids
+import schemas
+import shards
+import shutil
+import statuscache
+import statusstore
+import suppression
+import tempfile
+import threading
 import time
+import tracing
 import unittest
 import mailers
+import worker
 
 ################################################################
 # TODO:
@@ -87,6 +109,32 @@ class MailrTests(unittest.TestCase):
                  "cc" : ["Nishant Shah <nish@gmail.com>"]
             })
 
+    def test_validate_send_message_input_reports_all_errors(self):
+        try:
+            validate_send_message_input(
+                {
+                     "from" : "bad from",
+                     "to" : ["test@test.com", "bad to"],
+                     "text" : "text!",
+                     "extra" : 2
+                })
+            self.fail("InvalidInputException not raised")
+        except InvalidInputException as e:
+            assert len(e.payload['errors']) == 2 # Missing subject & extra property
+            assert e.payload['invalid_emails'] == ["bad from", "bad to"]
+
+    def test_validate_send_message_input_returns_parsed_emails(self):
+        result = validate_send_message_input(
+            {
+                 "from" : "Testing API <test@gmail.com>",
+                 "to" : ["test@test.com"],
+                 "subject" : "Testing API",
+                 "text" : "text!"
+            })
+
+        assert result['from'] == ('Testing API', 'test@gmail.com')
+        assert result['to'] == [(None, 'test@test.com')]
+
     def test_validate_info_input(self):
         
         # Raise exception when email is in invalid format
@@ -149,6 +197,59 @@ class MailrTests(unittest.TestCase):
         assert rv.status_code == 400
         assert 'Input should be specified in valid JSON format only' in rv.data
     
+    @patch('mailr.admission.check', autospec=True)
+    def test_send_message_rejected_when_overloaded(self, check):
+        data = {
+             "from" : "Testing API <test@gmail.com>",
+             "to" : ["test@test.com"],
+             "subject" : "Testing API",
+             "text" : "test",
+             "priority" : "bulk"
+        }
+        check.return_value = 30
+
+        rv = self.app.post('/messages', data = json.dumps(data), content_type = 'application/json')
+
+        assert rv.status_code == 429
+        assert rv.headers['Retry-After'] == '30'
+        assert check.call_args[0][2] == 'bulk'
+
+    @patch('admission.observe_each', autospec=True)
+    @patch('admission.time.time', autospec=True)
+    def test_admission_sheds_lower_priorities_first(self, now, observe_each):
+        now.return_value = 1000
+        queues = {'high' : Mock(), 'normal' : Mock(), 'bulk' : Mock()}
+        # The oldest job, in the normal queue, is at 75% of the maximum lag
+        observe_each.return_value = [(0, 0), (1, admission.MAX_QUEUE_LAG * 0.75), (0, 0)]
+
+        connection = Mock()
+        assert admission.check(connection, queues, 'bulk') == admission.RETRY_AFTER
+        assert admission.check(connection, queues, 'normal') is None
+        assert admission.check(connection, queues, 'high') is None
+        assert observe_each.call_args[0][1] == [queues['high'], queues['normal'], queues['bulk']]
+
+        # The observation is reused for a while
+        observe_each.return_value = [(0, 0), (admission.MAX_QUEUE_DEPTH, 0), (0, 0)]
+        assert admission.check(connection, queues, 'normal') is None
+
+        now.return_value = 1000 + admission.OBSERVATION_TTL
+        assert admission.check(connection, queues, 'normal') == admission.RETRY_AFTER
+        assert observe_each.call_count == 2
+
+        # Each shard is observed on its own
+        assert admission.check(Mock(), queues, 'normal') == admission.RETRY_AFTER
+        assert observe_each.call_count == 3
+
+    @patch('admission.observe_each', autospec=True)
+    def test_admission_ignores_lower_priority_backlog(self, observe_each):
+        queues = {'high' : Mock(), 'normal' : Mock(), 'bulk' : Mock()}
+        observe_each.return_value = [(0, 0), (0, 0), (admission.MAX_QUEUE_DEPTH * 2, admission.MAX_QUEUE_LAG * 2)]
+
+        with patch('admission._observations', {}):
+            assert admission.check(Mock(), queues, 'bulk') == admission.RETRY_AFTER
+            assert admission.check(Mock(), queues, 'normal') is None
+            assert admission.check(Mock(), queues, 'high') is None
+
     """ 
     Commenting this one out as this one really sends messages through the email service providers
     def test_send_message_and_status_with_correct_inputs(self):
@@ -265,6 +366,23 @@ class MailrTests(unittest.TestCase):
         
         assert status_info['status'] == 'sent'
         
+    @patch('mailers.requests.get', autospec=True)
+    def test_mailgun_get_status_tells_permanent_failures(self, get):
+        data = {
+         "id" : "45ccde84-78b2-4e91-b460-609d0c678ad5",
+         "email" : "deepak201@gmail.com"
+        }
+        mailgun_mailer = MailGunMailer()
+
+        get.return_value.content = '{ "items" : [{ "event" : "failed", "severity" : "temporary" }] }'
+        assert mailgun_mailer.get_message_status(data) == {'status' : 'failed', 'temporary' : True}
+
+        get.return_value.content = '{ "items" : [{ "event" : "failed", "severity" : "permanent" }] }'
+        assert mailgun_mailer.get_message_status(data) == {'status' : 'failed', 'suppress' : True}
+
+        get.return_value.content = '{ "items" : [{ "event" : "complained" }] }'
+        assert mailgun_mailer.get_message_status(data) == {'status' : 'sent', 'suppress' : True}
+
     @patch('mailers.requests.get', autospec=True)
     def test_mailgun_get_status_failure(self, get):
         
@@ -280,6 +398,18 @@ class MailrTests(unittest.TestCase):
         
         assert status_info == None
     
+    @patch('mailers.requests.post', autospec=True)
+    def test_mailgun_sends_chunks_without_to_to_the_sender(self, post):
+        post.return_value.status_code = 200
+        post.return_value.content = '{"id" : "<someid>", "message" : "Queued. Thank you."}'
+
+        messages_info = MailGunMailer().send_message(from_email='Sender <s@test.com>', to=[], bcc=['a@test.com', 'b@test.com'],
+            subject='Testing API', text='test')
+
+        assert post.call_args[1]['data']['to'] == ['Sender <s@test.com>']
+        # The sender isn't a recepient of the request, so it gets no status
+        assert [message_info['email_address'] for message_info in messages_info] == ['a@test.com', 'b@test.com']
+
     ##########################
     # MandriMailer tests
     ##########################
@@ -358,8 +488,10 @@ class MailrTests(unittest.TestCase):
         assert MailerUtils.is_email_valid("blah") == False
         assert MailerUtils.is_email_valid("") == False
         assert MailerUtils.is_email_valid(None) == False
-        # TODO:
-        ## assert MailerUtils.is_email_valid("Amit ami#t@rupare.com") == False -- This case needs to be fixed
+        assert MailerUtils.is_email_valid("Amit ami#t@rupare.com") == False
+        assert MailerUtils.is_email_valid("deep@ak201@gmail.com") == False
+        assert MailerUtils.is_email_valid("tes<t@t>est.com") == False
+        assert MailerUtils.is_email_valid("ami@t.io") == True
     
     def test_get_name_email_tuples(self):
         result = MailerUtils.get_name_email_tuples(['amitruparel@gmail.com','Amit Ruparel <aa@gmail.com>'])
@@ -373,6 +505,23 @@ class MailrTests(unittest.TestCase):
         result = MailerUtils.get_name_email_tuples(None)
         assert result == []
         
+    def test_parse_address(self):
+        assert addresses.parse('"Ruparel, Amit" <amit@ruparel.co.uk>') == ('Ruparel, Amit', 'amit@ruparel.co.uk')
+        assert addresses.parse('J. Doe <"j doe"@test.com>') == ('J. Doe', '"j doe"@test.com')
+        assert addresses.parse(u'J\xf6rg <j\xf6rg@m\xfcller.de>') == (u'J\xf6rg', u'j\xf6rg@m\xfcller.de')
+        assert addresses.parse(' <test@test.com> ') == (None, 'test@test.com')
+        assert addresses.parse('test@test.com extra') is None
+        assert addresses.parse('te..st@test.com') is None
+        assert addresses.parse('test@test') is None
+        assert addresses.parse('test@-test.com') is None
+        assert addresses.parse('a' * 65 + '@test.com') is None
+
+    def test_parse_address_takes_linear_time(self):
+        started = time.time()
+        for adversarial in ['a ' * 490 + '<', '"' + '\\' * 490, 'a.' * 490 + '@', 'a@' + 'b-' * 490, 'a' * 10 ** 6]:
+            assert addresses.parse(adversarial) is None
+        assert time.time() - started < 0.5
+
     ##########################
     # mailers.py tests
     ##########################
@@ -404,6 +553,844 @@ class MailrTests(unittest.TestCase):
         assert mock_mailer_2.send_message.call_count == 1
         assert mock_mailer_3.send_message.call_count == 1
         assert mock_mailer_4.send_message.call_count == 0
+
+    @patch('mailers.statusstore.save_status_record', autospec=True)
+    @patch('mailers.get_available_mailers', autospec=True)
+    @patch('mailers.get_current_job', autospec=True)
+    def test_send_message_saves_status_record(self,gcj,get_available_mailers,save_status_record):
+        messages_info = [{'email_address' : 'test@test.com', 'id' : 'someid'}]
+        mock_mailer = Mock()
+        mock_mailer.send_message.return_value = messages_info
+        get_available_mailers.return_value = [mock_mailer]
+        gcj.return_value.id = 'jobid'
+
+        mailers.send_message(to=['test@test.com'], retention='short')
+
+        save_status_record.assert_called_once_with(gcj.return_value.connection, 'jobid',
+            mock_mailer.__class__.__name__, messages_info, 'short')
+
+    @patch('mailers.tracing._export', autospec=True)
+    @patch('mailers.get_available_mailers', autospec=True)
+    @patch('mailers.get_current_job', autospec=True)
+    @patch('mailers.shuffle', autospec=True)
+    def test_send_message_continues_trace(self,shuffle,gcj,get_available_mailers,export):
+        mock_mailer_1 = Mock()
+        mock_mailer_1.send_message.side_effect = MailNotSentException('b','c')
+        mock_mailer_2 = Mock()
+        mock_mailer_2.send_message.return_value = []
+        get_available_mailers.return_value = [mock_mailer_1,mock_mailer_2]
+
+        trace_context = {'trace_id' : 'traceid', 'span_id' : 'parentid', 'enqueued_at' : time.time() - 1}
+        mailers.send_message(to=['test@test.com'], trace=trace_context)
+
+        spans = [span.to_dict() for span in export.call_args[0][0]]
+        assert [span['name'] for span in spans] == ['mailers.send_message', 'queue_wait', 'Mailer.send_message', 'Mailer.send_message']
+        assert all(span['trace_id'] == 'traceid' for span in spans)
+        assert spans[0]['parent_id'] == 'parentid'
+        assert all(span['parent_id'] == spans[0]['span_id'] for span in spans[1:])
+        assert spans[1]['duration_ms'] >= 1000
+        assert spans[2]['attributes'] == {'provider' : 'Mock', 'error' : 'MailNotSentException'}
+
+    def test_split_recepients(self):
+        params = {'from' : 's@test.com', 'to' : ['a@test.com', 'b@test.com', 'c@test.com'], 'bcc' : ['d@test.com', 'e@test.com'], 'subject' : 'Test'}
+
+        assert mailers.split_recepients(params, 5) == [params]
+
+        chunks = mailers.split_recepients(params, 2)
+        assert [chunk['to'] for chunk in chunks] == [['a@test.com', 'b@test.com'], ['c@test.com'], []]
+        assert [chunk.get('bcc') for chunk in chunks] == [None, ['d@test.com'], ['e@test.com']]
+        assert all(chunk['subject'] == 'Test' for chunk in chunks)
+
+    def test_split_recepients_with_large_bcc_list(self):
+        bcc = ['{0}@test.com'.format(i) for i in range(7)]
+        params = {'from' : 's@test.com', 'to' : ['a@test.com'], 'cc' : ['c@test.com'], 'bcc' : bcc}
+
+        chunks = mailers.split_recepients(params, 3)
+
+        assert len(chunks) == 4
+        assert all(len(chunk['to'] + chunk.get('cc', []) + chunk.get('bcc', [])) <= 3 for chunk in chunks)
+        assert chunks[0] == {'from' : 's@test.com', 'to' : ['a@test.com'], 'cc' : ['c@test.com'], 'bcc' : bcc[:1]}
+        assert all(chunk['to'] == [] and 'cc' not in chunk for chunk in chunks[1:])
+        assert sum((chunk['bcc'] for chunk in chunks), []) == bcc
+
+    @patch('mailers.statusstore.save_chunk_progress', autospec=True)
+    @patch('mailers.Queue', autospec=True)
+    @patch('mailers.get_available_mailers', autospec=True)
+    @patch('mailers.get_current_job', autospec=True)
+    def test_send_message_fans_out_large_requests(self,gcj,get_available_mailers,Queue,save_chunk_progress):
+        gcj.return_value.id = 'jobid'
+        gcj.return_value.origin = 'bulk'
+
+        with patch('mailers.CHUNK_SIZE', 2):
+            mailers.send_message(to=['a@test.com', 'b@test.com', 'c@test.com'], retention='long')
+
+        assert get_available_mailers.call_count == 0
+        Queue.assert_called_once_with('bulk', connection=gcj.return_value.connection)
+        save_chunk_progress.assert_called_once_with(gcj.return_value.connection, 'jobid', 2, 'long')
+
+        enqueued = [call[1]['kwargs'] for call in Queue.return_value.enqueue_call.call_args_list]
+        assert [chunk['to'] for chunk in enqueued] == [['a@test.com', 'b@test.com'], ['c@test.com']]
+        assert all(chunk['request_id'] == 'jobid' for chunk in enqueued)
+
+    @patch('mailers.statusstore.record_chunk_result', autospec=True)
+    @patch('mailers.statusstore.save_status_record', autospec=True)
+    @patch('mailers.get_available_mailers', autospec=True)
+    @patch('mailers.get_current_job', autospec=True)
+    def test_send_message_chunk_records_under_request_id(self,gcj,get_available_mailers,save_status_record,record_chunk_result):
+        mock_mailer = Mock()
+        mock_mailer.send_message.return_value = []
+        get_available_mailers.return_value = [mock_mailer]
+        gcj.return_value.id = 'chunkjobid'
+
+        mailers.send_message(to=['a@test.com'], request_id='reqid', retries=0)
+
+        assert save_status_record.call_args[0][1] == 'reqid'
+        record_chunk_result.assert_called_once_with(gcj.return_value.connection, 'reqid', True, None)
+
+        mock_mailer.send_message.side_effect = Exception
+        mailers.send_message(to=['a@test.com'], request_id='reqid', retries=0)
+        record_chunk_result.assert_called_with(gcj.return_value.connection, 'reqid', False, None)
+
+    @patch('mailers.analytics.record_send', autospec=True)
+    @patch('mailers.statusstore.save_status_record', autospec=True)
+    @patch('mailers.get_available_mailers', autospec=True)
+    @patch('mailers.get_current_job', autospec=True)
+    def test_send_message_records_analytics(self,gcj,get_available_mailers,save_status_record,record_send):
+        mock_mailer = Mock()
+        mock_mailer.send_message.return_value = []
+        get_available_mailers.return_value = [mock_mailer]
+        gcj.return_value.id = requestids.new(now=1430000000)
+
+        mailers.send_message(from_email='Test <test@Test.com>', to=['a@test.com', 'b@test.com'], cc=['c@test.com'])
+        record_send.assert_called_once_with(gcj.return_value.connection, 'Test.com', 3, 'Mock', 1430000000)
+
+        mock_mailer.send_message.side_effect = Exception
+        mailers.send_message(from_email='test@test.com', to=['a@test.com'], retries=0)
+        assert record_send.call_args[0][1:4] == ('test.com', 1, None)
+
+    @patch('mailers.hedging.take_budget', autospec=True, return_value=True)
+    @patch('mailers.hedging.get_delay', autospec=True, return_value=0.05)
+    @patch('mailers.statusstore.save_hedge_outcome', autospec=True)
+    @patch('mailers.statusstore.save_status_record', autospec=True)
+    @patch('mailers.get_available_mailers', autospec=True)
+    @patch('mailers.get_current_job', autospec=True)
+    @patch('mailers.shuffle', autospec=True)
+    def test_send_message_hedges_slow_mailer(self,shuffle,gcj,get_available_mailers,save_status_record,save_hedge_outcome,get_delay,take_budget):
+        def slow_send(**params):
+            time.sleep(0.3)
+            return [{'email_address' : 'a@test.com', 'id' : 'slowid'}]
+        slow_mailer = type('SlowMailer', (Mock,), {})()
+        slow_mailer.send_message.side_effect = slow_send
+        fast_mailer = type('FastMailer', (Mock,), {})()
+        fast_mailer.send_message.return_value = [{'email_address' : 'a@test.com', 'id' : 'fastid'}]
+        get_available_mailers.return_value = [slow_mailer, fast_mailer]
+        gcj.return_value.id = 'jobid'
+        gcj.return_value.meta = {}
+
+        with patch('hedging.ENABLED', True):
+            started = time.time()
+            mailers.send_message(to=['a@test.com'], priority='high', retries=0)
+            assert time.time() - started < 0.3 # The slow mailer is left to finish in the background
+
+        assert save_status_record.call_args[0][2:4] == ('FastMailer', [{'email_address' : 'a@test.com', 'id' : 'fastid'}])
+        # Kept with the status record, as the job itself is deleted once done
+        outcome = {'delay' : 0.05, 'first' : 'SlowMailer', 'second' : 'FastMailer', 'hedged' : True, 'over_budget' : False,
+            'sent_by' : 'FastMailer', 'sent_twice' : False}
+        assert save_hedge_outcome.call_args[0][1:] == ('jobid', outcome, None)
+        # Updated once the slow mailer is done
+        assert hedging.wait_for_background()
+        assert save_hedge_outcome.call_args[0][1:] == ('jobid', dict(outcome, sent_twice=True), None)
+        message_ids = [mailer.send_message.call_args[1]['message_id'] for mailer in (slow_mailer, fast_mailer)]
+        assert message_ids[0] == message_ids[1]
+
+        # Not past the budget, nor for other priorities
+        take_budget.return_value = False
+        with patch('hedging.ENABLED', True):
+            mailers.send_message(to=['a@test.com'], priority='high', retries=0)
+        assert save_hedge_outcome.call_args[0][2]['sent_by'] == 'SlowMailer'
+        assert save_hedge_outcome.call_args[0][2]['over_budget']
+        assert fast_mailer.send_message.call_count == 1
+
+        with patch('hedging.ENABLED', True):
+            mailers.send_message(to=['a@test.com'], priority='normal', retries=0)
+        assert take_budget.call_count == 2
+        assert get_delay.call_count == 2
+
+    def test_hedging_race_fails_over_without_hedging(self):
+        first = hedging.Attempt('First', Mock(side_effect=MailNotSentException('b', 'c')))
+        second = hedging.Attempt('Second', Mock(return_value=[]))
+        take_budget = Mock()
+
+        race = hedging.Race(first, second)
+        assert race.run(10, take_budget) is second
+        assert not race.hedged
+        assert take_budget.call_count == 0
+        assert isinstance(first.exc_info[1], MailNotSentException)
+
+    def test_untraced_requests_use_null_span(self):
+        with patch('tracing.SAMPLE_RATE', 0):
+            span = tracing.start('test')
+        assert span is tracing.NULL_SPAN
+        assert span.child('child') is tracing.NULL_SPAN
+        assert span.context() is None
+
+    ##########################
+    # statusstore.py tests
+    ##########################
+    def test_save_status_record_is_keyed_by_email_address(self):
+        connection = Mock()
+        pipeline = connection.pipeline.return_value
+
+        statusstore.save_status_record(connection, 'reqid', 'MailGunMailer',
+            [{'email_address' : 'a@test.com', 'id' : 'id:1'}, {'email_address' : 'b@test.com', 'id' : 'id2'}], 'short')
+
+        pipeline.hmset.assert_called_once_with('mailr:request:reqid',
+            {'a@test.com' : 'MailGunMailer:id:1', 'b@test.com' : 'MailGunMailer:id2'})
+        pipeline.expire.assert_called_once_with('mailr:request:reqid', statusstore.RETENTION_TIERS['short'])
+
+    @patch('mailr.statuscache.get_message_status', autospec=True, return_value={'status' : 'sent'})
+    @patch('mailr.statusstore.get_message_info', autospec=True, return_value=('MailGunMailer', {'email_address' : 'a@test.com', 'id' : 'id1'}))
+    def test_hedge_outcome_is_kept_with_status_record(self, get_message_info, get_message_status):
+        connection = Mock()
+        pipeline = connection.pipeline.return_value
+        outcome = {'hedged' : True, 'sent_by' : 'MandrilMailer', 'sent_twice' : False}
+
+        statusstore.save_hedge_outcome(connection, 'reqid', outcome, 'short')
+        pipeline.hset.assert_called_once_with('mailr:request:reqid', statusstore.HEDGE_FIELD, json.dumps(outcome))
+        pipeline.expire.assert_called_once_with('mailr:request:reqid', statusstore.RETENTION_TIERS['short'])
+
+        # Read back through /status
+        connection.hget.side_effect = lambda key, field: pipeline.hset.call_args[0][2] if field == statusstore.HEDGE_FIELD else None
+        assert statusstore.get_hedge_outcome(connection, 'reqid') == outcome
+        with patch('mailr.connections', [connection]):
+            rv = self.app.post('/status', data = json.dumps({'id' : 'reqid', 'email' : 'a@test.com'}), content_type = 'application/json')
+        assert rv.status_code == 200
+        assert json.loads(rv.data) == {'status' : 'sent', 'hedge' : outcome}
+
+        connection.hget.side_effect = None
+        connection.hget.return_value = None
+        assert statusstore.get_hedge_outcome(connection, 'reqid') is None
+
+    def test_get_message_info(self):
+        connection = Mock()
+        connection.hget.return_value = 'MandrilMailer:id:1'
+
+        result = statusstore.get_message_info(connection, 'reqid', 'a@test.com')
+        assert result == ('MandrilMailer', {'email_address' : 'a@test.com', 'id' : 'id:1'})
+
+        connection.hget.return_value = None
+        assert statusstore.get_message_info(connection, 'reqid', 'a@test.com') is None
+
+    ##########################
+    # suppression.py tests
+    ##########################
+    def test_suppression_confirms_bloom_filter_hits(self):
+        connection = Mock()
+        with patch('suppression._bloom', [bytearray()]):
+            suppression.suppress(connection, ['Bounced@Test.com'])
+            bitmap = str(suppression._bloom[0])
+
+        pipeline = connection.pipeline.return_value
+        pipeline.sadd.assert_called_once_with(suppression.SUPPRESSED_KEY, 'bounced@test.com')
+        assert pipeline.setbit.call_count == suppression.BLOOM_HASHES
+
+        connection = Mock()
+        connection.get.return_value = bitmap
+        connection.pipeline.return_value.execute.return_value = [True]
+        with patch('suppression._bloom', [None]):
+            suppression.refresh(connection)
+            result = suppression.get_suppressed(connection, ['ok@test.com', 'bounced@test.com'])
+
+        assert result == set(['bounced@test.com'])
+        # Only what the filter matched is confirmed in Redis
+        connection.pipeline.return_value.sismember.assert_called_once_with(suppression.SUPPRESSED_KEY, 'bounced@test.com')
+
+    def test_suppression_checks_all_addresses_until_filter_is_copied(self):
+        connection = Mock()
+        connection.pipeline.return_value.execute.return_value = [False, True]
+        with patch('suppression._bloom', [None]):
+            result = suppression.get_suppressed(connection, ['ok@test.com', 'bounced@test.com'])
+
+        assert result == set(['bounced@test.com'])
+        assert connection.get.call_count == 0 # Requests never copy the filter
+        assert connection.pipeline.return_value.sismember.call_count == 2
+
+    @patch('mailr.suppression.get_suppressed', autospec=True)
+    def test_drop_suppressed_recepients(self, get_suppressed):
+        input_dict = {
+            "from" : "test@test.com",
+            "to" : ["Test <a@test.com>", "b@test.com"],
+            "bcc" : ["b@test.com"],
+            "subject" : "Testing API",
+            "text" : "test"
+        }
+        name_email_tuples = mailr.validate_send_message_input(input_dict)
+        get_suppressed.return_value = set(['b@test.com'])
+
+        assert mailr.drop_suppressed_recepients(input_dict, name_email_tuples) == ['b@test.com']
+        assert input_dict['to'] == ["Test <a@test.com>"]
+        assert 'bcc' not in input_dict
+
+        name_email_tuples = mailr.validate_send_message_input(input_dict)
+        get_suppressed.return_value = set(['a@test.com'])
+        self.assertRaises(InvalidInputException, mailr.drop_suppressed_recepients, input_dict, name_email_tuples)
+
+    @patch('mailr.suppression.unsuppress', autospec=True)
+    def test_remove_suppressions(self, unsuppress):
+        rv = self.app.delete('/suppressions', data = json.dumps({'emails' : ['Test <A@test.com>']}), content_type = 'application/json')
+
+        assert rv.status_code == 200
+        unsuppress.assert_called_once_with(mailr.conn, ['A@test.com'])
+
+    def test_suppression_filter_is_rebuilt_under_another_key(self):
+        connection = Mock()
+        connection.sscan_iter.return_value = ['bounced@test.com']
+        pipeline = connection.pipeline.return_value = MagicMock()
+
+        suppression.rebuild_filter(connection)
+
+        # The filter is swapped in whole, never deleted while in use
+        temp_key = suppression.BLOOM_KEY + ':rebuild'
+        pipeline.delete.assert_called_once_with(temp_key)
+        pipeline.rename.assert_called_once_with(temp_key, suppression.BLOOM_KEY)
+        assert set(call[0][0] for call in pipeline.setbit.call_args_list) == set([temp_key, suppression.BLOOM_KEY])
+
+    ##########################
+    # shards.py tests
+    ##########################
+    @patch('shards.REDIS_URLS', ['redis://first', 'redis://second'])
+    def test_request_ids_encode_shard(self):
+        request_id, shard = shards.new_request_id('long')
+        assert requestids.parse(request_id).shard == shard
+        assert requestids.parse(request_id).retention == 'long'
+        assert shards.get_shard(request_id) == shard
+        assert shards.get_shard(requestids.new(2)) is None
+        assert shards.get_shard('45ccde84-78b2-4c05-9a8c-ef4e0d1d3d0a') == shards.PRIMARY # From before sharding
+
+    @patch('mailr.statusstore.request_exists', autospec=True, return_value=True)
+    @patch('mailr.statusstore.get_chunk_progress', autospec=True, return_value=None)
+    @patch('mailr.statusstore.get_message_info', autospec=True, return_value=None)
+    def test_get_status_goes_to_shard_of_request(self, get_message_info, get_chunk_progress, request_exists):
+        connections = [Mock(), Mock()]
+        data = {
+             "id" : requestids.new(1),
+             "email" : "test@test.com"
+        }
+        with patch('mailr.connections', connections), patch('shards.REDIS_URLS', ['redis://first', 'redis://second']):
+            rv = self.app.post('/status', data = json.dumps(data), content_type = 'application/json')
+            assert rv.status_code == 404
+            assert 'Cannot find message sent to test@test.com' in rv.data
+            assert get_message_info.call_args[0][0] is connections[1]
+            assert request_exists.call_args[0][0] is connections[1]
+
+            # No such shard
+            data['id'] = requestids.new(2)
+            rv = self.app.post('/status', data = json.dumps(data), content_type = 'application/json')
+            assert rv.status_code == 404
+            assert get_message_info.call_count == 1
+
+    ##########################
+    # requestids.py tests
+    ##########################
+    def test_request_ids_sort_by_time(self):
+        request_id = requestids.new(5, 'short', now=1430000000.123)
+        assert len(request_id) == requestids.LENGTH
+        assert requestids.parse(request_id) == (1430000000.123, 5, 'short')
+        assert requestids.parse(requestids.new(now=1430000000.123)).retention == 'default'
+
+        request_ids = [requestids.new(shard, now=1430000000 + i) for i, shard in enumerate((3, 0, 2, 1))]
+        assert sorted(request_ids) == request_ids
+        assert request_ids[1] > requestids.get_time_prefix(1430000001) > request_ids[0]
+
+        assert requestids.parse('45ccde84-78b2-4c05-9a8c-ef4e0d1d3d0a') is None
+        assert requestids.parse(request_id.upper()) is None
+
+    def test_status_record_expiry_is_known_from_id(self):
+        created_at = 1430000000
+        request_id = requestids.new(retention='short', now=created_at)
+        expires_at = created_at + statusstore.MAX_SEND_DELAY + statusstore.RETENTION_TIERS['short']
+        assert not statusstore.is_expired(request_id, now=expires_at)
+        assert statusstore.is_expired(request_id, now=expires_at + 1)
+        assert not statusstore.is_expired('45ccde84-78b2-4c05-9a8c-ef4e0d1d3d0a')
+
+    def test_get_status_rejects_expired_ids_without_redis(self):
+        connections = [Mock()]
+        data = {
+             "id" : requestids.new(retention='short', now=time.time() - statusstore.MAX_SEND_DELAY - 86400),
+             "email" : "test@test.com"
+        }
+        with patch('mailr.connections', connections):
+            rv = self.app.post('/status', data = json.dumps(data), content_type = 'application/json')
+        assert rv.status_code == 404
+        assert 'has expired' in rv.data
+        assert connections[0].mock_calls == []
+
+    def test_request_ids_encode_configured_default_retention(self):
+        with patch('statusstore.DEFAULT_RETENTION_TIER', 'long'):
+            request_id, shard = shards.new_request_id()
+            created_at = requestids.parse(request_id).created_at
+            assert requestids.parse(request_id).retention == 'long'
+
+            # Still kept, although past what the 'default' tier keeps records for
+            assert not statusstore.is_expired(request_id,
+                now=created_at + statusstore.MAX_SEND_DELAY + statusstore.RETENTION_TIERS['default'] + 60)
+
+        assert requestids.parse(shards.new_request_id('short')[0]).retention == 'short'
+
+    def test_save_status_record_indexes_request_ids(self):
+        connection = Mock()
+        pipeline = connection.pipeline.return_value
+        request_id = requestids.new()
+
+        statusstore.save_status_record(connection, request_id, 'MailGunMailer', [{'email_address' : 'a@test.com', 'id' : 'id1'}])
+        pipeline.zadd.assert_called_once_with(statusstore.REQUESTS_KEY, **{request_id : 0})
+        assert pipeline.zremrangebylex.call_args[0][2] < '(' + request_id
+
+        connection.zrangebylex.return_value = [request_id]
+        assert statusstore.get_request_ids(connection, 1430000000, 1430000060, count=10) == [request_id]
+        connection.zrangebylex.assert_called_once_with(statusstore.REQUESTS_KEY,
+            '[' + requestids.get_time_prefix(1430000000), '(' + requestids.get_time_prefix(1430000060), start=0, num=10)
+
+    ##########################
+    # analytics.py tests
+    ##########################
+    def test_analytics_record_send(self):
+        connection = Mock()
+        pipeline = connection.pipeline.return_value
+
+        analytics.record_send(connection, 'Test.com', 3, 'MailGunMailer', accepted_at=1430000000 - 3600, now=1430000000)
+        assert [call[0] for call in pipeline.hincrby.call_args_list] == [
+            ('mailr:analytics:2015042522', 'sent:MailGunMailer:test.com', 3),
+            ('mailr:analytics:2015042521', 'accepted:-:test.com', 3)]
+        assert pipeline.expire.call_args[0][1] == analytics.TTL
+
+        analytics.record_send(connection, 'test.com', 1, now=1430000000)
+        assert pipeline.hincrby.call_args[0] == ('mailr:analytics:2015042522', 'failed:-:test.com', 1)
+
+    def test_analytics_query_sums_shards(self):
+        connections = [Mock(), Mock()]
+        connections[0].pipeline.return_value.execute.return_value = [
+            {'sent:MailGunMailer:test.com' : '2', 'accepted:-:test.com' : '3'}, {}]
+        connections[1].pipeline.return_value.execute.return_value = [
+            {'sent:MailGunMailer:test.com' : '1'}, {'sent:MandrilMailer:other.com' : '4'}]
+
+        hours = analytics.query(connections, 1429999200, 1429999200 + 7200)
+        assert hours == [
+            {'hour' : 1429999200, 'counts' : {'sent' : {'MailGunMailer' : {'test.com' : 3}}, 'accepted' : {'-' : {'test.com' : 3}}}},
+            {'hour' : 1430002800, 'counts' : {'sent' : {'MandrilMailer' : {'other.com' : 4}}}}]
+        assert [call[0][0] for call in connections[0].pipeline.return_value.hgetall.call_args_list] == [
+            'mailr:analytics:2015042522', 'mailr:analytics:2015042523']
+
+        hours = analytics.query(connections, 1429999200, 1429999200 + 7200, sender_domain='Other.com')
+        assert [hour['counts'] for hour in hours] == [{}, {'sent' : {'MandrilMailer' : {'other.com' : 4}}}]
+
+    def test_get_analytics_rejects_long_ranges(self):
+        data = {
+             "start" : 1430000000,
+             "end" : 1430000000 + (analytics.MAX_QUERY_HOURS + 1) * 3600
+        }
+        rv = self.app.post('/analytics', data = json.dumps(data), content_type = 'application/json')
+        assert rv.status_code == 400
+
+    ##########################
+    # autoscale.py tests
+    ##########################
+    def test_autoscale_record_job_splits_busy_time(self):
+        connection = Mock(spec=redis.StrictRedis)
+        autoscale.record_job(connection, 'worker-1', 119.5, 121)
+
+        pipeline = connection.pipeline.return_value
+        assert [call[0] for call in pipeline.hincrbyfloat.call_args_list] == [
+            ('mailr:autoscale:1', 'worker-1:busy', 0.5), ('mailr:autoscale:2', 'worker-1:busy', 1.0)]
+        assert [call[0] for call in pipeline.hincrby.call_args_list] == [('mailr:autoscale:2', 'worker-1:jobs', 1)]
+
+    @patch('autoscale.admission.observe', autospec=True)
+    def test_autoscale_signal_from_heartbeats(self, observe):
+        connection = Mock(spec=redis.StrictRedis)
+        connection.zrangebyscore.return_value = ['worker-1']
+        # The worker's heartbeat, then the 5 buckets of the window (360s to 600s). It's been on a job for 10s.
+        connection.pipeline.return_value.execute.return_value = [{'shard' : '0', 'started_at' : '0', 'busy_since' : '590'},
+            {}, {}, {}, {'worker-1:busy' : '60', 'worker-1:jobs' : '30'}, {}]
+        observe.return_value = (600, 0)
+
+        with patch('autoscale.TARGET_LATENCY', 60), patch('autoscale.TARGET_UTILISATION', 0.8), patch('autoscale.WINDOW', 300):
+            signal = autoscale.get_signal(connection, [[Mock(connection=connection)]], now=600)
+
+        worker = signal['workers'][0]
+        assert worker['busy_ratio'] == round(70 / 240.0, 3)
+        assert worker['throughput'] == 0.125
+        assert signal['shards'][0]['depth'] == 600
+        # A busy worker sends 30 jobs in 70s. The 0.125 jobs per second coming in, at 80% utilisation,
+        # & the 600 waiting, within a minute, take 10.16 jobs per second.
+        assert signal['recommended_workers'] == 24
+
+    @patch('worker.autoscale.record_job', autospec=True)
+    @patch('worker.autoscale.heartbeat', autospec=True)
+    @patch('worker.MailrWorker._run_work_horse', autospec=True)
+    @patch('rq.Worker.heartbeat', autospec=True)
+    def test_worker_stays_registered_during_long_jobs(self, rq_heartbeat, run_work_horse, heartbeat, record_job):
+        mailr_worker = worker.MailrWorker([], connection=Mock(spec=redis.StrictRedis))
+        mailr_worker.execute_job(Mock(timeout=600))
+
+        # Sent before waiting for the work horse, for as long as the job may take
+        assert heartbeat.call_args[0][4] is not None
+        assert heartbeat.call_args[0][5] == 660
+        assert mailr_worker.busy_since is None and mailr_worker.busy_timeout is None
+
+    def test_autoscale_heartbeat_lasts_for_timeout(self):
+        connection = Mock(spec=redis.StrictRedis)
+        autoscale.heartbeat(connection, 'worker-1', 0, 0, 1000, 660, now=1000)
+        pipeline = connection.pipeline.return_value
+        pipeline.zadd.assert_called_once_with(autoscale.WORKERS_KEY, **{'worker-1' : 1660})
+        pipeline.expire.assert_called_once_with(autoscale._get_worker_key('worker-1'), 660)
+
+    def test_autoscale_keeps_workers_without_data(self):
+        with patch('autoscale.MIN_WORKERS', 0):
+            assert autoscale.recommend(0, 0, []) == 0
+            assert autoscale.recommend(5, 10, []) == 1
+
+    ##########################
+    # schemas.py tests
+    ##########################
+    def test_schemas_are_cached_until_changed(self):
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(directory) # Schema files are found wherever the process is started from
+            cache_path = os.path.join(directory, 'schemas.cache.json')
+            with patch('schemas.CACHE_PATH', cache_path), patch('schemas._schemas', {}):
+                loaded = schemas.load()
+                assert sorted(loaded.keys()) == sorted(schemas.NAMES)
+                assert os.path.exists(cache_path)
+
+            with patch('schemas.CACHE_PATH', cache_path), patch('schemas._schemas', {}), patch('schemas.build', autospec=True) as build:
+                assert schemas.load() == loaded
+                assert build.call_count == 0
+
+                # A schema file changed since the cache was written
+                sources = schemas._get_sources()
+                sources['send'][0] += 1
+                with patch('schemas._get_sources', autospec=True, return_value=sources):
+                    schemas._schemas.clear()
+                    schemas.load()
+                assert build.call_count == 1
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+
+    def test_get_mailer_creates_mailers_on_first_use(self):
+        with patch('mailr.available_mailers', {}):
+            mailer = mailr.get_mailer('MandrilMailer')
+            assert isinstance(mailer, MandrilMailer)
+            assert mailr.get_mailer('MandrilMailer') is mailer
+            assert list(mailr.available_mailers.keys()) == ['MandrilMailer']
+
+    ##########################
+    # outbox.py tests
+    ##########################
+    def test_outbox_drains_sealed_segments(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # Small enough for each record to get a segment of its own
+            segment_log = outbox.SegmentLog(directory, segment_bytes=100)
+            for job_id in ('1', '2', '3'):
+                segment_log.append({'id' : job_id, 'queue' : 'high', 'func' : 'mailers.send_message',
+                    'kwargs' : {'to' : ['test@test.com']}, 'result_ttl' : 0})
+            assert len(os.listdir(directory)) == 3
+
+            # The segment still being written to is left alone
+            connection = Mock(spec=redis.StrictRedis)
+            assert outbox.drain([connection], directory) == False
+            pipeline = connection.pipeline.return_value
+            assert [call[0] for call in pipeline.rpush.call_args_list] == [('rq:queue:high', '1'), ('rq:queue:high', '2')]
+            assert len(os.listdir(directory)) == 1
+
+            segment_log.seal()
+            assert outbox.drain([connection], directory) == True
+            assert pipeline.rpush.call_args[0] == ('rq:queue:high', '3')
+            assert os.listdir(directory) == []
+        finally:
+            shutil.rmtree(directory)
+
+    def test_outbox_fsyncs_off_the_gevent_hub(self):
+        directory = tempfile.mkdtemp()
+        fsync_threads = []
+        def fsync(fd):
+            fsync_threads.append(threading.current_thread().ident)
+        try:
+            segment_log = outbox.SegmentLog(directory, fsync=True)
+            with patch('outbox._is_gevent_patched', autospec=True, return_value=True), patch('os.fsync', fsync):
+                segment_log.append({'id' : '1'})
+            assert len(fsync_threads) == 1
+            assert fsync_threads[0] != threading.current_thread().ident
+
+            with patch('os.fsync', fsync):
+                segment_log.append({'id' : '2'})
+            assert fsync_threads[1] == threading.current_thread().ident
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('mailr.outbox.append', autospec=True)
+    @patch('mailr.admission.check', autospec=True)
+    def test_send_message_goes_to_outbox_when_redis_is_down(self, check, append):
+        data = {
+             "from" : "Testing API <test@gmail.com>",
+             "to" : ["test@test.com"],
+             "subject" : "Testing API",
+             "text" : "test"
+        }
+        check.side_effect = redis.exceptions.ConnectionError
+
+        with patch('mailr.suppression.get_suppressed', autospec=True, return_value=set()), patch('outbox._redis_down', [False]):
+            rv = self.app.post('/messages', data = json.dumps(data), content_type = 'application/json')
+            assert outbox.is_redis_down()
+
+            # Redis isn't tried again until it's back
+            rv = self.app.post('/messages', data = json.dumps(data), content_type = 'application/json')
+
+        assert rv.status_code == 202
+        assert json.loads(rv.data)['id'] == append.call_args[1]['job_id']
+        assert check.call_count == 1
+        assert append.call_count == 2
+        assert append.call_args[0][:2] == ('default', 'mailers.send_message')
+
+    @patch('mailr.outbox.append', autospec=True)
+    @patch('mailr.admission.check', autospec=True)
+    def test_send_message_answers_503_when_connections_run_out(self, check, append):
+        data = {
+             "from" : "Testing API <test@gmail.com>",
+             "to" : ["test@test.com"],
+             "subject" : "Testing API",
+             "text" : "test"
+        }
+        check.side_effect = redis.exceptions.ConnectionError(outbox.POOL_EXHAUSTED_MESSAGE)
+
+        with patch('mailr.suppression.get_suppressed', autospec=True, return_value=set()), patch('outbox._redis_down', [False]):
+            rv = self.app.post('/messages', data = json.dumps(data), content_type = 'application/json')
+            # A busy process isn't a Redis outage. Admission control stays in force.
+            assert not outbox.is_redis_down()
+
+        assert rv.status_code == 503
+        assert rv.headers['Retry-After'] == '1'
+        assert append.call_count == 0
+        assert outbox.is_unreachable(redis.exceptions.ConnectionError('Error 111 connecting to localhost:6379. Connection refused.'))
+        assert outbox.is_unreachable(redis.exceptions.TimeoutError('Timeout reading from socket'))
+
+    ##########################
+    # domains.py tests
+    ##########################
+    def test_domain_results_are_cached(self):
+        resolver = Mock(side_effect=lambda domain: domain != 'gmial.com')
+        connection = Mock()
+        pipeline = connection.pipeline.return_value
+        pipeline.execute.side_effect = lambda: ['1' if call[0][0] == 'mailr:domain:cached.com' else None
+            for call in pipeline.get.call_args_list]
+        connection.set.return_value = True
+
+        with patch('domains._local_cache', {}), patch('domains._resolver', [resolver]):
+            result = domains.get_undeliverable_domains(connection, ['gmial.com', 'Test.com', 'cached.com'])
+            assert result == set(['gmial.com'])
+            assert sorted(call[0][0] for call in resolver.call_args_list) == ['gmial.com', 'test.com']
+            connection.set.assert_any_call('mailr:domain:gmial.com', '0', ex=domains.NEGATIVE_TTL)
+            connection.set.assert_any_call('mailr:domain:test.com', '1', ex=domains.TTL)
+
+            # Now cached in this process
+            assert domains.get_undeliverable_domains(connection, ['gmial.com', 'test.com', 'cached.com']) == set(['gmial.com'])
+            assert resolver.call_count == 2
+            assert connection.pipeline.call_count == 1
+
+    def test_slow_domains_are_let_through(self):
+        answered = threading.Event()
+        def resolver(domain):
+            if domain == 'slow.com':
+                answered.wait(5)
+            return False
+        connection = Mock()
+        connection.pipeline.return_value.execute.side_effect = lambda: [None, None]
+        connection.set.return_value = True
+
+        with patch('domains._local_cache', {}), patch('domains._resolver', [resolver]), patch('domains.RESOLVE_DEADLINE', 0.05):
+            started = time.time()
+            assert domains.get_undeliverable_domains(connection, ['slow.com', 'gmial.com']) == set(['gmial.com'])
+            assert time.time() - started < 1
+
+            # The result is still cached once it's in
+            answered.set()
+            time.sleep(0.1)
+            connection.set.assert_any_call('mailr:domain:slow.com', '0', ex=domains.NEGATIVE_TTL)
+            assert domains._local_cache['slow.com'][1] == False
+
+    @patch('mailr.domains.get_undeliverable_domains', autospec=True)
+    def test_check_recepient_domains(self, get_undeliverable_domains):
+        input_dict = {
+            "from" : "test@test.com",
+            "to" : ["Test <a@gmial.com>", "b@test.com"],
+            "subject" : "Testing API",
+            "text" : "test"
+        }
+        name_email_tuples = mailr.validate_send_message_input(input_dict)
+        get_undeliverable_domains.return_value = set(['gmial.com'])
+
+        try:
+            mailr.check_recepient_domains(input_dict, name_email_tuples)
+            assert False
+        except InvalidInputException as e:
+            assert e.payload['invalid_emails'] == ["Test <a@gmial.com>"]
+
+    ##########################
+    # statuscache.py tests
+    ##########################
+    def test_status_cache_hit_does_not_poll_provider(self):
+        connection = Mock()
+        connection.get.return_value = 'sent'
+        mailer = Mock()
+
+        status_info = statuscache.get_message_status(connection, 'reqid', mailer, {'email_address' : 'a@test.com', 'id' : 'id1'})
+
+        assert status_info == {'status' : 'sent'}
+        assert mailer.get_message_status.call_count == 0
+
+    def test_status_cache_ttl_depends_on_status(self):
+        message_info = {'email_address' : 'a@test.com', 'id' : 'id1'}
+        connection = Mock()
+        connection.get.return_value = None
+        connection.set.return_value = True
+        connection.ttl.return_value = 1000
+        mailer = Mock()
+
+        # Terminal statuses are kept as long as the status record
+        mailer.get_message_status.return_value = {'status' : 'failed'}
+        assert statuscache.get_message_status(connection, 'reqid', mailer, message_info) == {'status' : 'failed'}
+        connection.set.assert_called_with('mailr:status:reqid:a@test.com', 'failed', ex=1000)
+
+        # Others only for a short while
+        mailer.get_message_status.return_value = {'status' : 'accepted'}
+        statuscache.get_message_status(connection, 'reqid', mailer, message_info)
+        connection.set.assert_called_with('mailr:status:reqid:a@test.com', 'accepted', ex=statuscache.PENDING_STATUS_TTL)
+
+    @patch('statuscache.suppression.suppress', autospec=True)
+    def test_status_cache_only_suppresses_hard_failures(self, suppress):
+        message_info = {'email_address' : 'a@test.com', 'id' : 'id1'}
+        connection = Mock()
+        connection.get.return_value = None
+        connection.set.return_value = True
+        connection.ttl.return_value = 1000
+        mailer = Mock()
+
+        # e.g. a full mailbox
+        mailer.get_message_status.return_value = {'status' : 'failed'}
+        statuscache.get_message_status(connection, 'reqid', mailer, message_info)
+        assert suppress.call_count == 0
+
+        mailer.get_message_status.return_value = {'status' : 'failed', 'suppress' : True}
+        assert statuscache.get_message_status(connection, 'reqid', mailer, message_info) == {'status' : 'failed'}
+        suppress.assert_called_once_with(connection, ['a@test.com'])
+
+    def test_status_cache_polls_temporary_failures_again(self):
+        message_info = {'email_address' : 'a@test.com', 'id' : 'id1'}
+        connection = Mock()
+        connection.get.return_value = None
+        connection.set.return_value = True
+        connection.ttl.return_value = 1000
+        mailer = Mock()
+
+        # e.g. a full mailbox, which the provider retries
+        mailer.get_message_status.return_value = {'status' : 'failed', 'temporary' : True}
+        assert statuscache.get_message_status(connection, 'reqid', mailer, message_info) == {'status' : 'failed'}
+        connection.set.assert_called_with('mailr:status:reqid:a@test.com', 'failed', ex=statuscache.PENDING_STATUS_TTL)
+
+    @patch('statuscache.time.sleep', autospec=True)
+    def test_status_cache_waits_for_concurrent_poll(self, sleep):
+        connection = Mock()
+        connection.get.side_effect = [None, None, 'sent']
+        connection.set.return_value = False # Another call holds the lock
+        connection.exists.return_value = True
+        mailer = Mock()
+
+        status_info = statuscache.get_message_status(connection, 'reqid', mailer, {'email_address' : 'a@test.com', 'id' : 'id1'})
+
+        assert status_info == {'status' : 'sent'}
+        assert mailer.get_message_status.call_count == 0
+
+    ##########################
+    # metrics.py tests
+    ##########################
+    def test_metrics_render(self):
+        # Metrics register themselves. Keep this one out of the module's registry.
+        with patch('metrics._registry', []):
+            histogram = metrics.Histogram('test_seconds', 'Test histogram', ('provider',), buckets=(0.1, 1))
+            histogram.observe(0.5, 'MailGunMailer')
+            collected = histogram.collect()
+
+            assert collected['test_seconds_bucket{provider="MailGunMailer",le="0.1"}'] == 0
+            assert collected['test_seconds_bucket{provider="MailGunMailer",le="1"}'] == 1
+            assert collected['test_seconds_bucket{provider="MailGunMailer",le="+Inf"}'] == 1
+            assert collected['test_seconds_count{provider="MailGunMailer"}'] == 1
+            assert histogram.collect() == {}
+
+            connection = Mock()
+            connection.hgetall.return_value = dict((series, str(value)) for series, value in collected.items())
+            rendered = metrics.render(connection, metrics.WEB_KEY, {('test_depth', 'Test gauge') : {'test_depth' : 3}})
+
+            assert '# TYPE test_seconds histogram' in rendered
+            assert 'test_seconds_sum{provider="MailGunMailer"} 0.5' in rendered
+            assert '# TYPE test_depth gauge\ntest_depth 3' in rendered
+
+    @patch('mailr.metrics.maybe_flush', autospec=True)
+    def test_metrics_not_flushed_while_redis_is_down(self, maybe_flush):
+        with patch('outbox._redis_down', [True]):
+            mailr.flush_metrics(None)
+        assert maybe_flush.call_count == 0
+
+        maybe_flush.side_effect = redis.ConnectionError
+        with patch('outbox._redis_down', [False]):
+            response = Mock()
+            assert mailr.flush_metrics(response) == response
+        assert maybe_flush.call_count == 1
+
+    ##########################
+    # profiler.py tests
+    ##########################
+    @patch('profiler.threading.Timer', autospec=True)
+    def test_profile_windows_are_per_process(self, timer):
+        directory = tempfile.mkdtemp()
+        try:
+            with patch('profiler.PROFILE_DIR', directory), patch('profiler._window', [None, 0]):
+                profiler.start_window(10)
+                window_id = profiler._window[0]
+                assert window_id.endswith('.{0}'.format(os.getpid()))
+
+                # Another work process of the same worker, which opened its window at the same time
+                other_window_id = window_id.rsplit('.', 1)[0] + '.1'
+                for name, stack in ((window_id, 'mine'), (other_window_id, 'theirs')):
+                    os.makedirs(os.path.join(directory, name))
+                    with open(os.path.join(directory, name, 'samples.1.0'), 'w') as samples_file:
+                        samples_file.write(stack + ' 3\n')
+
+                profiler.merge_window(window_id)
+
+            with open(os.path.join(directory, window_id + '.collapsed')) as collapsed_file:
+                assert collapsed_file.read() == 'mine 3\n'
+            assert os.listdir(os.path.join(directory, other_window_id)) == ['samples.1.0']
+        finally:
+            shutil.rmtree(directory)
+
+    def test_profiler_stats(self):
+        samples = {
+            'rq.worker.perform_job;mailers.send_message;mailers._send_message;requests.api.post' : 6,
+            'rq.worker.perform_job;mailers.send_message;mailers._send_message' : 2,
+            'rq.worker.perform_job;rq.worker.heartbeat' : 2
+        }
+
+        stats = dict((function_stats['function'], function_stats) for function_stats in profiler.get_stats(samples))
+
+        assert 'rq.worker.perform_job' not in stats
+        assert stats['mailers.send_message']['total_percent'] == 100
+        assert stats['mailers.send_message']['self'] == 0
+        assert stats['mailers._send_message']['self'] == 2
+        assert stats['requests.api.post']['total'] == 6
+        assert stats['requests.api.post']['self_percent'] == 75
+        assert profiler.collapse({'a;b' : 2}) == 'a;b 2\n'
         
 
 if __name__ == "__main__":
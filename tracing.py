@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import random
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# Fraction (0 to 1) of requests to /messages that are traced. The decision is made when the request
+# comes in & carried along with the job, so a trace is either complete or not recorded at all.
+SAMPLE_RATE = float(os.getenv('MAILR_TRACE_SAMPLE_RATE', 0))
+
+# Where finished traces go. Either a file that spans are appended to as JSON lines, or a
+# collector listening for them as JSON datagrams, given as udp://host:port. A relative path is taken
+# from the directory of this module, as for the outbox (see outbox.py).
+TRACE_EXPORT = os.getenv('MAILR_TRACE_EXPORT', 'traces.jsonl')
+if not TRACE_EXPORT.startswith('udp://'):
+    TRACE_EXPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), TRACE_EXPORT)
+
+class Span(object):
+    """
+        A timed operation that is part of a trace. Used as a context manager, the span ends when
+        the block does. The spans of a trace are exported together once its root span ends.
+    """
+
+    def __init__(self, name, trace_id, parent_id=None, spans=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.end = None
+
+        # Spans of the trace recorded in this process. Shared with all the spans created from this one.
+        self._spans = spans if spans is not None else []
+        self._spans.append(self)
+
+    def child(self, name, **attributes):
+        """
+            Returns a new span for an operation that is part of this one
+        """
+        return Span(name, self.trace_id, self.span_id, self._spans, attributes)
+
+    def add_child(self, name, start, end, **attributes):
+        """
+            Records an operation that is part of this one & whose start & end times are already known
+        """
+        span = self.child(name, **attributes)
+        span.start, span.end = start, end
+        return span
+
+    def context(self, **extra):
+        """
+            Returns what's needed to continue the trace in another process, e.g. in the job
+            processing the request. Pass it to start() there.
+        """
+        context = {'trace_id' : self.trace_id, 'span_id' : self.span_id}
+        context.update(extra)
+        return context
+
+    def finish(self):
+        self.end = time.time()
+        if self._spans[0] is self:
+            _export(self._spans)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.finish()
+
+    def to_dict(self):
+        return {
+            'trace_id' : self.trace_id,
+            'span_id' : self.span_id,
+            'parent_id' : self.parent_id,
+            'name' : self.name,
+            'start' : self.start,
+            'duration_ms' : round((self.end - self.start) * 1000, 3),
+            'attributes' : self.attributes
+        }
+
+class _NullSpan(object):
+    """
+        Stands in for a span when the request isn't traced, so callers needn't check
+    """
+    def child(self, name, **attributes):
+        return self
+
+    def add_child(self, name, start, end, **attributes):
+        return self
+
+    def context(self, **extra):
+        return None
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+def start(name, context=None, **attributes):
+    """
+        Starts the root span of a trace in this process
+
+        Args:
+            name (str) - Name of the operation
+            context (dict) - Optional; context of the span this one continues from another process,
+                             as returned by Span.context(). When None, a new trace is started if sampled.
+
+        Returns:
+            Span - The root span. NULL_SPAN if the request isn't traced.
+    """
+    if context is not None:
+        return Span(name, context['trace_id'], context['span_id'], attributes=attributes)
+
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        return Span(name, _new_id(128), attributes=attributes)
+
+    return NULL_SPAN
+
+def _export(spans):
+    records = ''.join(json.dumps(span.to_dict()) + '\n' for span in spans if span.end is not None)
+
+    try:
+        if TRACE_EXPORT.startswith('udp://'):
+            host, port = TRACE_EXPORT[len('udp://'):].rsplit(':', 1)
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                udp_socket.sendto(records, (host, int(port)))
+            finally:
+                udp_socket.close()
+        else:
+            # A single write to a file opened for appending isn't interleaved with writes from other processes
+            trace_file = os.open(TRACE_EXPORT, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(trace_file, records)
+            finally:
+                os.close(trace_file)
+    except (IOError, OSError, socket.error):
+        # Tracing mustn't break sending messages
+        logger.exception("Couldn't export trace")
+
+def _new_id(bits):
+    return '{0:0{1}x}'.format(random.getrandbits(bits), bits // 4)
@@ -1,14 +1,175 @@
+import autoscale
+import errno
+import hedging
+import logging
+import mailers
+import metrics
+import multiprocessing
 import os
+import profiler
+import shards
+import signal
+import time
 
 import redis
 from rq import Worker, Queue, Connection
 
-listen = ['default']
+# Functions the jobs run. They're imported although no job runs in this process, so that the work
+# horse forked for each job finds them (& requests, which they use) already imported. Otherwise every
+# job would import them again before it could start.
+job_functions = [mailers.send_message]
 
-redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
-conn = redis.from_url(redis_url)
+# In order of priority. See mailr.queues_by_shard
+listen = ['high', 'default', 'bulk']
+
+# Shards (positions in MAILR_REDIS_URLS, see shards.py) this worker takes jobs from, separated by
+# commas. All of them by default. A work process is started for each shard, so running more
+# workers with the same MAILR_WORKER_SHARDS scales the shards they're assigned.
+worker_shards = [int(shard) for shard in
+    os.getenv('MAILR_WORKER_SHARDS', ','.join(str(shard) for shard in range(len(shards.REDIS_URLS)))).split(',')]
+connections = dict((shard, redis.from_url(shards.REDIS_URLS[shard])) for shard in worker_shards)
+
+# Metrics are kept on the primary shard
+conn = redis.from_url(shards.REDIS_URLS[shards.PRIMARY])
+
+# Port the worker serves its metrics on. Set to 0 to disable, e.g. when running
+# several workers on the same host without giving each one its own port.
+metrics_port = int(os.getenv('MAILR_METRICS_PORT', 9102))
+
+# Set to a number of seconds to profile the jobs run in that long after the worker starts.
+# Profiling can also be started at any time by sending SIGUSR2 to the worker. See profiler.py
+profile_on_start = int(os.getenv('MAILR_PROFILE', 0))
+
+class MailrWorker(Worker):
+    """
+        RQ Worker that flushes the metrics recorded by each job, profiles jobs when asked to & reports
+        how busy it is for autoscaling (see autoscale.py). It takes the next job as soon as the work horse
+        is done with the current one, without waiting for what the job left in the background.
+    """
+
+    def __init__(self, queues, shard=shards.PRIMARY, **kwargs):
+        # Idle workers wait for jobs for default_worker_ttl - 60 seconds between heartbeats
+        kwargs.setdefault('default_worker_ttl', autoscale.HEARTBEAT_INTERVAL + 60)
+        super(MailrWorker, self).__init__(queues, **kwargs)
+        self.shard = shard
+        self.started_at = time.time()
+        self.busy_since = None
+        self.busy_timeout = None
+        self._job_done_fd = None # In the work horse, written to once the job is done
+        self._detached_horses = [] # Work horses that finished their job but may not have exited yet
+
+    def heartbeat(self, timeout=0, pipeline=None):
+        super(MailrWorker, self).heartbeat(timeout, pipeline)
+        if not self.is_horse:
+            autoscale.heartbeat(conn, self.name, self.shard, self.started_at, self.busy_since, self.busy_timeout)
+
+    def register_death(self):
+        super(MailrWorker, self).register_death()
+        autoscale.remove_worker(conn, self.name)
+
+    def execute_job(self, job):
+        # No heartbeats are sent while waiting for the work horse. As RQ does for its own worker key (see
+        # Worker.prepare_job_execution), the worker is kept alive for as long as the job may take.
+        self.busy_since = time.time()
+        self.busy_timeout = (job.timeout or Queue.DEFAULT_TIMEOUT) + 60
+        self.heartbeat()
+        try:
+            return self._run_work_horse(job)
+        finally:
+            autoscale.record_job(conn, self.name, self.busy_since, time.time())
+            self.busy_since = self.busy_timeout = None
+
+    def _run_work_horse(self, job):
+        # As Worker.execute_job, except that the worker only waits for the work horse to be done with the
+        # job, not to exit. It may still have something to finish in the background (see hedging.in_background()).
+        read_fd, write_fd = os.pipe()
+        child_pid = os.fork()
+        if child_pid == 0:
+            os.close(read_fd)
+            self._job_done_fd = write_fd
+            self.main_work_horse(job)
+
+        os.close(write_fd)
+        self._horse_pid = child_pid
+        self.procline('Forked %d at %d' % (child_pid, time.time()))
+        self.set_state('busy')
+        try:
+            while True:
+                try:
+                    os.read(read_fd, 1) # Returns once the job is done, or the work horse exited without saying so
+                    break
+                except OSError as e:
+                    # Interrupted by a signal, e.g. to stop once the job is done
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            os.close(read_fd)
+
+        self._detached_horses.append(child_pid)
+        self._reap_work_horses()
+        self.set_state('idle')
+
+    def _reap_work_horses(self):
+        for pid in list(self._detached_horses):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue # Still finishing
+            except OSError:
+                pass
+            self._detached_horses.remove(pid)
+
+    def perform_job(self, job):
+        # This runs in the work horse, which exits right after the job & what it left in the background
+        sampler = profiler.start_job()
+        try:
+            return super(MailrWorker, self).perform_job(job)
+        finally:
+            if sampler is not None:
+                profiler.finish_job(sampler)
+            metrics.flush(conn, metrics.WORKER_KEY)
+
+            # Let the worker take the next job meanwhile
+            if self._job_done_fd is not None:
+                os.write(self._job_done_fd, '1')
+            if hedging.wait_for_background():
+                metrics.flush(conn, metrics.WORKER_KEY)
+
+def work(shard):
+    """
+        Takes jobs from the queues of the given shard until the worker is stopped
+    """
+    with Connection(connections[shard]):
+        profiler.install_signal_handler()
+        if profile_on_start:
+            profiler.start_window(profile_on_start)
+
+        worker = MailrWorker(list(map(Queue, listen)), shard=shard)
+        worker.work()
 
 if __name__ == '__main__':
-    with Connection(conn):
-        worker = Worker(list(map(Queue, listen)))
-        worker.work()
\ No newline at end of file
+    queues_by_shard = dict((shard, [Queue(name, connection=connections[shard]) for name in listen]) for shard in worker_shards)
+
+    if metrics_port:
+        try:
+            metrics.serve(metrics_port,
+                lambda: metrics.render(conn, metrics.WORKER_KEY, metrics.get_queue_depth_gauge(queues_by_shard)))
+        except IOError as e:
+            logging.getLogger(__name__).warning("Can't serve metrics on port %s: %s", metrics_port, e)
+
+    if len(worker_shards) == 1:
+        work(worker_shards[0])
+    else:
+        processes = [multiprocessing.Process(target=work, args=(shard,)) for shard in worker_shards]
+        for process in processes:
+            process.start()
+
+        # Pass on profiling & shutdown requests to the work processes, which handle them as a single worker would
+        def forward_signal(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signum)
+        signal.signal(signal.SIGUSR2, forward_signal)
+        signal.signal(signal.SIGTERM, forward_signal)
+
+        for process in processes:
+            process.join()